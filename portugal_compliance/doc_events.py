@@ -6,6 +6,11 @@ import json
 from .signing import sign_document
 # Removed direct import of generate_atcud_and_qr, will call helper
 from .doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from .utils.fiscal_fingerprint import (
+    fiscal_fingerprint_matches,
+    get_changed_critical_fields,
+    store_fiscal_fingerprint,
+)
 
 # Mapping from ERPNext DocType to AT Document Type Code (defined in Document Series PT)
 # This needs careful review and expansion based on specific ERPNext usage in Portugal
@@ -40,6 +45,7 @@ def handle_on_submit(doc, method):
     
     # Sign the document (this also updates QR code content hash)
     sign_document(doc, method)
+    store_fiscal_fingerprint(doc)
     
     # Log the submission event
     create_compliance_log("Submit", doc.doctype, doc.name, details=f"Document submitted. Hash: {doc.custom_document_hash}")
@@ -54,44 +60,13 @@ def handle_on_cancel(doc, method):
 def handle_validate_submitted(doc, method):
     """Handles validation attempts on already submitted documents to ensure inviolability."""
     if not doc.is_new() and doc.docstatus == 1:
-        db_doc = frappe.get_doc(doc.doctype, doc.name)
-        critical_fields = [
-            "posting_date", "company", "customer", "grand_total", "net_total", 
-            "total_taxes_and_charges", "naming_series", "currency", "plc_conversion_rate"
-            # Add other fields deemed critical by AT regulations
-        ]
-        changed_fields = []
-        for field in critical_fields:
-            # Handle potential type differences (e.g., float vs Decimal)
-            current_val = doc.get(field)
-            db_val = db_doc.get(field)
-            if type(current_val) != type(db_val):
-                 # Attempt type conversion for comparison if safe (e.g., float to Decimal)
-                 try:
-                     if isinstance(current_val, float) and isinstance(db_val, (int, float)):
-                         db_val = float(db_val)
-                     elif isinstance(db_val, float) and isinstance(current_val, (int, float)):
-                         current_val = float(current_val)
-                     # Add other safe conversions if needed
-                 except: pass # Ignore conversion errors, comparison will likely fail
-            
-            if current_val != db_val:
-                changed_fields.append(field)
-
-        # Basic check on items table changes (more detailed check recommended)
-        if len(doc.get("items", [])) != len(db_doc.get("items", [])):
-             changed_fields.append("items (count)")
+        # Fingerprint stored at submit: recomputed over the in-memory document (utils/fiscal_fingerprint.py)
+        matches = fiscal_fingerprint_matches(doc)
+        if matches is None:
+            # Submitted before fingerprints existed: compare against the stored values
+            changed_fields = get_changed_critical_fields(doc)
         else:
-            # Compare key item fields if count matches
-            item_critical_fields = ["item_code", "qty", "uom", "rate", "amount", "net_rate", "net_amount", "item_tax_template"]
-            for i, item in enumerate(doc.get("items", [])):
-                db_item = db_doc.get("items", [])[i]
-                for field in item_critical_fields:
-                    if item.get(field) != db_item.get(field):
-                        changed_fields.append(f"items[{i}].{field}")
-                        break # Move to next item if change found
-                if f"items[{i}].{field}" in changed_fields: break # Move to next check if change found
-
+            changed_fields = [] if matches else ["fiscal fingerprint"]
         if changed_fields:
             changed_fields_str = ", ".join(changed_fields)
             details = f"Attempt to modify submitted document. Changed fields: {changed_fields_str}"
@@ -6,6 +6,8 @@ from frappe.model.document import Document
 from frappe.utils import get_site_path, get_files_path
 import os
 
+from ...utils.signing_key_cache import invalidate_signing_key_cache
+
 class CertificadoDigitalQualificado(Document):
     def validate(self):
         self.validar_campos_obrigatorios()
@@ -29,6 +31,11 @@ class CertificadoDigitalQualificado(Document):
     def on_update(self):
         if self.ativo:
             self.desativar_outros_certificados_ativos_para_empresa()
+        # A chave em cache pode ter mudado (ficheiro, password, validade ou estado ativo)
+        invalidate_signing_key_cache(company=self.empresa, certificate=self.name)
+
+    def on_trash(self):
+        invalidate_signing_key_cache(company=self.empresa, certificate=self.name)
 
     def desativar_outros_certificados_ativos_para_empresa(self):
         # Garante que apenas um certificado está ativo por empresa
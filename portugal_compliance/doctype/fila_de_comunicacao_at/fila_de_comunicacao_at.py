@@ -0,0 +1,9 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+# import frappe
+from frappe.model.document import Document
+
+class FiladeComunicacaoAT(Document):
+    # As entradas são criadas e processadas por utils/at_outbox.py
+    pass
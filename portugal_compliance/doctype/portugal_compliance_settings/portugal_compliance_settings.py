@@ -5,5 +5,7 @@
 from frappe.model.document import Document
 
 class PortugalComplianceSettings(Document):
-    pass
-
+    def on_update(self):
+        # Caminhos, chave pública da AT e clientes SOAP em cache nos processos (saft/atcud_service.py)
+        from ...saft.atcud_service import invalidate_at_settings_cache
+        invalidate_at_settings_cache()
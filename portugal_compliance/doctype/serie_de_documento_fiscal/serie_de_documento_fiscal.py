@@ -5,9 +5,15 @@ import frappe
 from frappe.model.document import Document
 from frappe.utils import cint, cstr
 
+# Campos escritos diretamente na BD (numeração e cabeça da cadeia de assinaturas): um formulário
+# aberto antes de uma assinatura não pode gravar por cima deles os valores que tinha em memória
+DB_MANAGED_FIELDS = ["numero_sequencial_atual", "ultimo_documento_assinado", "ultimo_hash_assinado", "ultimo_numero_assinado"]
+
 class SerieDeDocumentoFiscal(Document):
     def validate(self):
         self.validar_campos_obrigatorios()
+        if not self.is_new():
+            self.recarregar_campos_geridos_pela_bd()
         # A unicidade do nome (prefixo_serie) é garantida pelo Frappe se autoname="field:prefixo_serie"
         # Se for necessário validar combinações únicas (ex: empresa, tipo_documento, ano_fiscal devem ser únicos para um prefixo)
         # essa lógica adicional pode ser inserida aqui.
@@ -34,27 +40,18 @@ class SerieDeDocumentoFiscal(Document):
         if not self.empresa:
             frappe.throw(frappe._("O campo 'Empresa' é obrigatório."))
 
+    def recarregar_campos_geridos_pela_bd(self):
+        # FOR UPDATE: nenhuma assinatura avança a cabeça entre esta leitura e a gravação
+        values = frappe.db.get_value(self.doctype, self.name, DB_MANAGED_FIELDS, as_dict=True, for_update=True)
+        if values:
+            self.update(values)
+
     def get_next_number(self):
         if not self.ativo:
             frappe.throw(frappe._("A série {0} não está ativa.").format(self.name))
 
-        # Bloqueia o documento para evitar race conditions ao obter o próximo número.
-        # Este é um lock a nível de registo do Frappe.
-        frappe.db.commit() # Garante que transações anteriores são commitadas antes do SELECT FOR UPDATE
-        current_doc = frappe.db.sql("""SELECT numero_sequencial_atual 
-                                        FROM `tabSerie de Documento Fiscal` 
-                                        WHERE name = %s FOR UPDATE""", self.name, as_dict=True)
-        
-        if not current_doc:
-            frappe.throw(frappe._("Série {0} não encontrada.").format(self.name))
-
-        current_number = cint(current_doc[0].numero_sequencial_atual)
-        next_number = current_number + 1
-        
-        frappe.db.set_value("Serie de Documento Fiscal", self.name, "numero_sequencial_atual", next_number, update_modified=False)
+        next_number = allocate_next_number(self.name)
         self.numero_sequencial_atual = next_number # Atualiza o valor no objeto em memória também
-        frappe.db.commit() # Libera o lock
-        
         return next_number
 
     def get_formatted_document_number(self, sequence_number=None):
@@ -81,6 +78,70 @@ class SerieDeDocumentoFiscal(Document):
 
         return f"{self.codigo_validacao_serie_at}-{cstr(sequence_number)}"
 
+# --- Numeração sequencial ---
+
+def allocate_next_number(serie_name):
+    """Reserva o próximo número da série com um único UPDATE atómico e devolve-o.
+
+       Não faz commit: o lock da linha da série é mantido até ao fim da transação do chamador
+       (a mesma em que o documento é inserido). Se essa transação for revertida, o número volta
+       a ficar livre, pelo que a numeração não tem falhas nem duplicados.
+    """
+    if frappe.db.db_type == "postgres":
+        result = frappe.db.sql("""UPDATE "tabSerie de Documento Fiscal"
+                                  SET numero_sequencial_atual = COALESCE(numero_sequencial_atual, 0) + 1
+                                  WHERE name = %s AND ativo = 1
+                                  RETURNING numero_sequencial_atual""", serie_name)
+        next_number = result[0][0] if result else None
+    else:
+        # LAST_INSERT_ID(expr) guarda o novo valor na própria ligação: leitura sem nova consulta à tabela
+        frappe.db.sql("""UPDATE `tabSerie de Documento Fiscal`
+                         SET numero_sequencial_atual = LAST_INSERT_ID(IFNULL(numero_sequencial_atual, 0) + 1)
+                         WHERE name = %s AND ativo = 1""", serie_name)
+        # Sem linha atualizada (ROW_COUNT() = 0), LAST_INSERT_ID() devolveria um valor antigo da ligação
+        last_id, row_count = frappe.db.sql("SELECT LAST_INSERT_ID(), ROW_COUNT()")[0]
+        next_number = last_id if cint(row_count) > 0 else None
+
+    if not next_number:
+        if not frappe.db.exists("Serie de Documento Fiscal", serie_name):
+            frappe.throw(frappe._("Série {0} não encontrada.").format(serie_name))
+        frappe.throw(frappe._("A série {0} não está ativa.").format(serie_name))
+    return cint(next_number)
+
+def validate_fiscal_doctype(doctype_name):
+    """Só DocTypes com o campo 'pt_serie_fiscal' podem ser usados nas consultas sobre séries: o nome
+    do DocType é interpolado no nome da tabela, pelo que um valor vindo de um pedido é validado aqui."""
+    fiscal_doctypes = frappe.get_all("Custom Field", filters={"fieldname": "pt_serie_fiscal"}, pluck="dt")
+    if doctype_name not in fiscal_doctypes:
+        frappe.throw(frappe._("O DocType {0} não tem documentos associados a séries fiscais.").format(doctype_name))
+    return doctype_name
+
+# --- Cabeça da cadeia de assinaturas ---
+# O hash do último documento assinado de cada série é mantido na própria série, pelo que
+# o hash anterior é lido com uma única consulta por chave primária em vez de uma pesquisa
+# ordenada sobre a tabela de documentos.
+
+def get_chain_head(serie_name, for_update=True):
+    """Lê a cabeça da cadeia da série. Com for_update=True a linha da série fica bloqueada
+    até ao fim da transação, serializando as assinaturas dessa série."""
+    lock_clause = "FOR UPDATE" if for_update else ""
+    head = frappe.db.sql("""SELECT name, prefixo_serie, ultimo_documento_assinado,
+                                   ultimo_hash_assinado, ultimo_numero_assinado
+                            FROM `tabSerie de Documento Fiscal`
+                            WHERE name = %s {0}""".format(lock_clause), serie_name, as_dict=True)
+    if not head:
+        frappe.throw(frappe._("Série {0} não encontrada.").format(serie_name))
+    return head[0]
+
+def update_chain_head(serie_name, document_name, document_hash, sequence_number):
+    """Avança a cabeça da cadeia. Deve ser chamada na mesma transação (e sob o mesmo lock)
+    em que a assinatura do documento é gravada."""
+    frappe.db.set_value("Serie de Documento Fiscal", serie_name, {
+        "ultimo_documento_assinado": document_name,
+        "ultimo_hash_assinado": document_hash,
+        "ultimo_numero_assinado": cint(sequence_number)
+    }, update_modified=False)
+
 # Funções Whitelisted para serem chamadas via API ou de scripts de cliente/servidor
 @frappe.whitelist()
 def get_next_sequential_number(serie_name):
@@ -39,11 +39,13 @@ fixtures = [
 
 doc_events = {
     "Sales Invoice": {
-        "on_submit": "portugal_compliance.utils.fiscal_signature.sign_document_and_generate_qr",
+        "on_submit": "portugal_compliance.utils.signing_engine.sign_on_submit",
         "validate": [
             "portugal_compliance.utils.fiscal_validations.validate_sales_invoice_fields",
             "portugal_compliance.utils.fiscal_validations.prevent_modification_of_certified_fields"
         ],
+        # 'validate' não corre na atualização após submissão
+        "before_update_after_submit": "portugal_compliance.utils.fiscal_validations.prevent_modification_after_submit",
         "on_cancel": "portugal_compliance.utils.fiscal_cancellation.prevent_direct_cancellation_of_fiscal_document"
     },
     "Journal Entry": { # Assuming Journal Entry is used for Credit Notes that can cancel Sales Invoices
@@ -54,12 +56,40 @@ doc_events = {
     },
     "Supplier": {
         "validate": "portugal_compliance.utils.fiscal_validations.validate_supplier_nif"
+    },
+    # Caches do ATCUD (códigos de validação e índice de anos fiscais)
+    "Document Series PT": {
+        "on_update": "portugal_compliance.saft.atcud_cache.invalidate_atcud_cache",
+        "on_trash": "portugal_compliance.saft.atcud_cache.invalidate_atcud_cache"
+    },
+    "Fiscal Year": {
+        "on_update": "portugal_compliance.saft.atcud_cache.invalidate_atcud_cache",
+        "on_trash": "portugal_compliance.saft.atcud_cache.invalidate_atcud_cache"
     }
 }
 
 # Scheduled Tasks
 # ---------------_-
 
+scheduler_events = {
+    "all": [
+        # Documentos submetidos sem assinatura (versões anteriores), assinados pela ordem da série
+        "portugal_compliance.utils.series_sequencer.sign_pending_series_documents",
+        # Comunicações com a AT pendentes ou a repetir (utils/at_outbox.py)
+        "portugal_compliance.utils.at_outbox.drain_at_outbox"
+    ],
+    "hourly": [
+        # Totais dos histogramas de latência das chamadas à AT no log (saft/at_metrics.py)
+        "portugal_compliance.saft.at_metrics.persist_at_call_metrics"
+    ],
+    "hourly_long": [
+        # Imagens de QR Code em modo 'Diferido' que os jobs por lote não geraram (qr_image_cache.py)
+        "portugal_compliance.utils.qr_image_cache.render_pending_qr_images",
+        # Reconciliação incremental das séries com o estado na AT (saft/series_reconciliation.py)
+        "portugal_compliance.saft.series_reconciliation.reconcile_series_with_at"
+    ]
+}
+
 # scheduler_events = {
 # "all": [
 # "portugal_compliance.tasks.all"
@@ -121,6 +151,11 @@ doc_events = {
 # before_install = "portugal_compliance.install.before_install"
 # after_install = "portugal_compliance.install.after_install"
 
+# Mantém os índices compostos de conformidade (ver utils/db_indexes.py)
+after_migrate = [
+    "portugal_compliance.utils.db_indexes.ensure_compliance_indexes"
+]
+
 # Desk Notifications (beta)
 # ---------------------------
 # desk_notification_handlers = [
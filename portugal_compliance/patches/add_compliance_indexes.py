@@ -0,0 +1,8 @@
+import frappe
+
+from portugal_compliance.utils.db_indexes import ensure_compliance_indexes
+
+
+def execute():
+    """Cria os índices compostos usados pela assinatura, SAF-T e pré-verificações."""
+    ensure_compliance_indexes()
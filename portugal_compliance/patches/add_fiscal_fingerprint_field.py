@@ -0,0 +1,22 @@
+import frappe
+from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
+
+
+def execute():
+    """Campo da impressão digital fiscal (utils/fiscal_fingerprint.py), junto dos campos de assinatura.
+    Os documentos já submetidos recebem-na com a auditoria em massa (backfill=1)."""
+    create_custom_fields({
+        "Sales Invoice": [
+            {
+                "fieldname": "pt_impressao_digital_fiscal",
+                "label": "Impressão Digital Fiscal",
+                "fieldtype": "Data",
+                "insert_after": "pt_qr_code_imagem",
+                "description": "Hash SHA-256 dos campos fiscais críticos do cabeçalho e das linhas, calculado na submissão.",
+                "read_only": 1,
+                "no_copy": 1,
+                "print_hide": 1,
+            }
+        ]
+    }, ignore_validate=True)
+    frappe.db.commit()
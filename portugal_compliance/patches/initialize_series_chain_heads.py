@@ -0,0 +1,40 @@
+import frappe
+from frappe.utils import cint
+
+from portugal_compliance.saft.utils import get_sequential_number_from_name
+
+
+def execute():
+    """Inicializa a cabeça da cadeia de assinaturas de cada série com o último documento já assinado."""
+    frappe.reload_doc("portugal_compliance", "doctype", "serie_de_documento_fiscal")
+
+    if not frappe.db.has_column("Sales Invoice", "pt_serie_fiscal"):
+        return
+
+    series = frappe.get_all(
+        "Serie de Documento Fiscal",
+        filters={"ultimo_documento_assinado": ["in", ["", None]]},
+        fields=["name", "prefixo_serie", "empresa"]
+    )
+    for serie in series:
+        last_doc = frappe.db.sql("""
+            SELECT name, pt_hash_dados_documento_sha1
+            FROM `tabSales Invoice`
+            WHERE company = %(company)s
+              AND pt_serie_fiscal = %(serie)s
+              AND docstatus = 1
+              AND IFNULL(pt_hash_dados_documento_sha1, '') != ''
+            ORDER BY posting_date DESC, name DESC
+            LIMIT 1
+            """, {"company": serie.empresa, "serie": serie.name}, as_dict=True)
+        if not last_doc:
+            continue
+
+        sequence_number = get_sequential_number_from_name(last_doc[0].name, f"{serie.prefixo_serie}/")
+        frappe.db.set_value("Serie de Documento Fiscal", serie.name, {
+            "ultimo_documento_assinado": last_doc[0].name,
+            "ultimo_hash_assinado": last_doc[0].pt_hash_dados_documento_sha1,
+            "ultimo_numero_assinado": cint(sequence_number)
+        }, update_modified=False)
+
+    frappe.db.commit()
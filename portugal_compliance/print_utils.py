@@ -2,9 +2,8 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
-import qrcode
-import base64
-from io import BytesIO
+
+from portugal_compliance.utils.qr_image_cache import get_qr_image_data_uri
 
 @frappe.whitelist()
 def get_qr_code_base64(doctype, docname):
@@ -13,7 +12,10 @@ def get_qr_code_base64(doctype, docname):
     # if not frappe.has_permission(doctype, "read", docname):
     #     frappe.throw(_("Not permitted to read document"), frappe.PermissionError)
 
-    qr_content = frappe.db.get_value(doctype, docname, "custom_qr_code_content")
+    # pt_qr_code_string is written on signing; custom_qr_code_content comes from the older doc_events flow
+    qr_content = frappe.db.get_value(doctype, docname, "pt_qr_code_string") if frappe.get_meta(doctype).has_field("pt_qr_code_string") else None
+    if not qr_content:
+        qr_content = frappe.db.get_value(doctype, docname, "custom_qr_code_content")
 
     if not qr_content:
         # Return a placeholder or empty string if no content
@@ -21,27 +23,9 @@ def get_qr_code_base64(doctype, docname):
         return ""
 
     try:
-        qr = qrcode.QRCode(
-            version=None, # Auto-detect size
-            error_correction=qrcode.constants.ERROR_CORRECT_M, # Medium error correction
-            box_size=4, # Smaller box size for print formats
-            border=2, # Smaller border
-        )
-        qr.add_data(qr_content)
-        qr.make(fit=True)
-
-        img = qr.make_image(fill_color="black", back_color="white")
-
-        # Save image to buffer
-        buffer = BytesIO()
-        img.save(buffer, format="PNG")
-        buffer.seek(0)
-
-        # Encode as base64
-        base64_encoded = base64.b64encode(buffer.getvalue()).decode("utf-8")
-        return f"data:image/png;base64,{base64_encoded}"
+        # Rendered once, then served from the content-addressed image cache
+        return get_qr_image_data_uri(qr_content)
 
     except Exception as e:
         frappe.log_error(f"Failed to generate QR Code base64 for {doctype} {docname}: {e}", "QR Code Generation")
         return "" # Return empty string on error
-
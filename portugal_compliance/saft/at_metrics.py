@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager
+
+import frappe
+from frappe.utils import cint, flt
+
+# Latency histograms for the AT webservice calls.
+#
+# Every SOAP operation is recorded per phase:
+#     wsdl_load - building the zeep client (WSDL download/parse; once per process and settings)
+#     tls       - opening a new connection to AT (TCP connect + TLS handshake with the client certificate)
+#     request   - the HTTP POST of the SOAP envelope (bytes sent/received, HTTP status)
+#     total     - the whole call as seen by the caller (result, SOAP fault code)
+# The operation of the tls/request phases comes from trace_operation(), set around each call.
+#
+# Histograms are kept in the process and, every FLUSH_INTERVAL seconds of activity, their deltas
+# are added to a redis hash shared by all workers of the site. get_at_call_stats returns either
+# view; persist_at_call_metrics (hourly) writes the site totals to the portugal_compliance log.
+
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+FLUSH_INTERVAL = 60
+REDIS_KEY = "pt_at_call_metrics"
+NO_OPERATION = "client_setup"
+
+_operation = contextvars.ContextVar("pt_at_operation", default=None)
+
+_lock = threading.Lock()
+_totals = {}
+_pending = {}
+_last_flush = [time.monotonic()]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.count = 0
+        self.sum_ms = 0.0
+        self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+        self.results = Counter()
+        self.fault_codes = Counter()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def add(self, ms, result, fault_code, bytes_sent, bytes_received):
+        if ms is not None:
+            self.count += 1
+            self.sum_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+            self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+        if result:
+            self.results[result] += 1
+        if fault_code:
+            self.fault_codes[fault_code] += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+
+    def as_dict(self):
+        return _summary(self.count, self.sum_ms, self.buckets, self.results, self.fault_codes,
+                        self.bytes_sent, self.bytes_received, max_ms=self.max_ms)
+
+
+@contextmanager
+def trace_operation(operation):
+    """Attributes the tls/request phases recorded inside the block to this operation."""
+    token = _operation.set(operation)
+    try:
+        yield
+    finally:
+        _operation.reset(token)
+
+
+def record_phase(phase, seconds=None, operation=None, result=None, fault_code=None, bytes_sent=0, bytes_received=0, site=None):
+    """Adds one observation. seconds=None counts the result without a duration (e.g. a call
+    rejected before reaching AT). site defaults to the current site; threads without a site
+    (e.g. a thread pool sharing a cached client) pass the site the client was created for."""
+    try:
+        current_site = getattr(frappe.local, "site", None)
+        key = (site or current_site, operation or _operation.get() or NO_OPERATION, phase)
+        ms = seconds * 1000 if seconds is not None else None
+        with _lock:
+            for store in (_totals, _pending):
+                histogram = store.get(key)
+                if histogram is None:
+                    histogram = store[key] = Histogram()
+                histogram.add(ms, result, fault_code, cint(bytes_sent), cint(bytes_received))
+            due = time.monotonic() - _last_flush[0] >= FLUSH_INTERVAL
+        # Only a thread bound to the site can reach its redis; the others leave the deltas pending
+        if due and current_site and current_site == key[0]:
+            flush_at_call_metrics()
+    except Exception:
+        # Metrics must never break an AT call
+        frappe.logger("portugal_compliance").warning("Could not record AT call metrics", exc_info=True)
+
+
+def flush_at_call_metrics():
+    """Adds the histograms recorded since the last flush to the site's redis hash."""
+    with _lock:
+        _last_flush[0] = time.monotonic()
+        site = frappe.local.site
+        pending = {key: histogram for key, histogram in _pending.items() if key[0] == site}
+        for key in pending:
+            del _pending[key]
+    if not pending:
+        return
+
+    try:
+        cache = frappe.cache()
+        redis_key = cache.make_key(REDIS_KEY)
+        pipe = cache.pipeline()
+        for (_, operation, phase), histogram in pending.items():
+            prefix = f"{operation}|{phase}|"
+            pipe.hincrby(redis_key, prefix + "count", histogram.count)
+            pipe.hincrbyfloat(redis_key, prefix + "sum_ms", histogram.sum_ms)
+            pipe.hincrby(redis_key, prefix + "bytes_sent", histogram.bytes_sent)
+            pipe.hincrby(redis_key, prefix + "bytes_received", histogram.bytes_received)
+            for index, value in enumerate(histogram.buckets):
+                if value:
+                    pipe.hincrby(redis_key, f"{prefix}b{index}", value)
+            for result, value in histogram.results.items():
+                pipe.hincrby(redis_key, f"{prefix}r:{result}", value)
+            for code, value in histogram.fault_codes.items():
+                pipe.hincrby(redis_key, f"{prefix}f:{code}", value)
+        pipe.execute()
+    except Exception:
+        # Metrics must never break an AT call; the deltas of this flush are dropped
+        frappe.logger("portugal_compliance").warning("Could not flush AT call metrics", exc_info=True)
+
+
+def get_site_metrics():
+    """Histograms of all workers of the site, from redis: {operation: {phase: summary}}."""
+    cache = frappe.cache()
+    # Plain redis commands (pipeline): RedisWrapper.hgetall expects pickled values
+    pipe = cache.pipeline()
+    pipe.hgetall(cache.make_key(REDIS_KEY))
+    raw = pipe.execute()[0] or {}
+    grouped = {}
+    for field, value in raw.items():
+        field, value = frappe.safe_decode(field), frappe.safe_decode(value)
+        operation, phase, name = field.split("|", 2)
+        grouped.setdefault((operation, phase), {})[name] = value
+
+    metrics = {}
+    for (operation, phase), fields in grouped.items():
+        buckets = [cint(fields.get(f"b{index}")) for index in range(len(BUCKETS_MS) + 1)]
+        results = Counter({name[2:]: cint(value) for name, value in fields.items() if name.startswith("r:")})
+        fault_codes = Counter({name[2:]: cint(value) for name, value in fields.items() if name.startswith("f:")})
+        metrics.setdefault(operation, {})[phase] = _summary(
+            cint(fields.get("count")), flt(fields.get("sum_ms")), buckets, results, fault_codes,
+            cint(fields.get("bytes_sent")), cint(fields.get("bytes_received"))
+        )
+    return metrics
+
+
+def get_process_metrics():
+    with _lock:
+        items = [(key, histogram.as_dict()) for key, histogram in _totals.items() if key[0] == frappe.local.site]
+    metrics = {}
+    for (_, operation, phase), summary in items:
+        metrics.setdefault(operation, {})[phase] = summary
+    return metrics
+
+
+def _summary(count, sum_ms, buckets, results, fault_codes, bytes_sent, bytes_received, max_ms=None):
+    summary = {
+        "count": count,
+        "mean_ms": round(sum_ms / count, 2) if count else None,
+        "p50_ms": _bucket_percentile(buckets, count, 0.50),
+        "p95_ms": _bucket_percentile(buckets, count, 0.95),
+        "p99_ms": _bucket_percentile(buckets, count, 0.99),
+        "buckets_ms": {(f"<={bound}" if bound else "inf"): value
+                       for bound, value in zip(BUCKETS_MS + (None,), buckets) if value},
+        "results": dict(results),
+        "fault_codes": dict(fault_codes),
+        "bytes_sent": bytes_sent,
+        "bytes_received": bytes_received,
+    }
+    if max_ms is not None:
+        summary["max_ms"] = round(max_ms, 2)
+    return summary
+
+
+def _bucket_percentile(buckets, count, percentile):
+    """Upper bound of the bucket holding the percentile (None above the last bound)."""
+    if not count:
+        return None
+    target = count * percentile
+    seen = 0
+    for bound, value in zip(BUCKETS_MS + (None,), buckets):
+        seen += value
+        if seen >= target:
+            return bound
+    return None
+
+
+def persist_at_call_metrics():
+    """Scheduled (hourly): writes the site's totals to the portugal_compliance log."""
+    flush_at_call_metrics()
+    metrics = get_site_metrics()
+    if metrics:
+        frappe.logger("portugal_compliance").info({"at_call_metrics": metrics})
+
+
+@frappe.whitelist()
+def get_at_call_stats(scope="site"):
+    """Latency histograms of the AT calls per operation and phase.
+    scope: 'site' (all workers, as of their last flush) or 'process' (this worker only)."""
+    frappe.only_for("System Manager")
+    flush_at_call_metrics()
+    if scope == "process":
+        return {"scope": "process", "pid": os.getpid(), "operations": get_process_metrics()}
+    return {"scope": "site", "operations": get_site_metrics()}
+
+
+@frappe.whitelist()
+def reset_at_call_stats():
+    frappe.only_for("System Manager")
+    with _lock:
+        site = frappe.local.site
+        for store in (_totals, _pending):
+            for key in [key for key in store if key[0] == site]:
+                del store[key]
+    cache = frappe.cache()
+    cache.delete(cache.make_key(REDIS_KEY))
+    return {"status": "reset"}
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""Offline benchmark of the AT series clients against the local SeriesWS stand-in.
+
+Starts saft/at_series_standin.py in a background thread and measures, for the same number of
+registarSerie calls:
+
+    new_client     - a new zeep Client and HTTP session per call (the old behaviour)
+    pooled_client  - the cached client and keep-alive session pool (get_cached_soap_client),
+                     called from 'concurrency' threads
+    async_bulk     - the asyncio bulk path (saft/atcud_bulk_service.py)
+
+and reports calls/s, p50/p95/p99 latency, errors and TCP connections opened on the server.
+Injected latency, errors and faults come from the stand-in options.
+
+    bench --site <site> execute portugal_compliance.saft.at_series_benchmark.run_at_client_benchmark \\
+        --kwargs "{'calls': 500, 'concurrency': 10, 'latency_ms': 20, 'fault_rate': 0.02}"
+
+Nothing is written to the database; the AT settings are not used.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+from frappe.utils import cint
+from zeep import Client, Settings, Transport
+
+from .atcud_bulk_service import _send_all
+from .atcud_service import PerRequestUsernameToken, build_register_request, get_cached_soap_client, parse_series_response
+from .at_series_standin import start_standin_server
+
+# The stand-in only checks that a UsernameToken is present
+BENCHMARK_USERNAME = "benchmark"
+BENCHMARK_ENCRYPTED_PASSWORD = "YmVuY2htYXJr"
+
+
+def run_at_client_benchmark(calls=500, concurrency=10, new_client_calls=50, latency_ms=20, jitter_ms=0,
+                            error_rate=0.0, fault_rate=0.0, http_error_rate=0.0, drop_rate=0.0):
+    calls = cint(calls)
+    concurrency = cint(concurrency)
+    server = start_standin_server(latency_ms=latency_ms, jitter_ms=jitter_ms, error_rate=error_rate,
+                                  fault_rate=fault_rate, http_error_rate=http_error_rate, drop_rate=drop_rate, seed=1)
+    try:
+        report = {"standin": server.get_stats()["config"], "calls": calls, "concurrency": concurrency, "modes": {}}
+        modes = [
+            ("new_client", lambda prefix: _run_new_client(server, prefix, min(cint(new_client_calls), calls))),
+            ("pooled_client", lambda prefix: _run_pooled_client(server, prefix, calls, concurrency)),
+            ("async_bulk", lambda prefix: _run_async_bulk(server, prefix, calls, concurrency)),
+        ]
+        for name, run in modes:
+            server.reset()
+            started = time.perf_counter()
+            latencies, errors = run(name.upper().replace("_", ""))
+            elapsed = time.perf_counter() - started
+            stats = server.get_stats()
+            report["modes"][name] = {
+                "calls": len(latencies),
+                "seconds": round(elapsed, 3),
+                "calls_per_second": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+                "latency_ms": _percentiles(latencies),
+                "errors": errors,
+                "server_connections": stats["connections"],
+                "requests_per_connection": stats["requests_per_connection"],
+                "server_outcomes": stats["outcomes"],
+            }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    print(frappe.as_json(report))
+    return report
+
+
+def _requests(prefix, count):
+    return {
+        f"{prefix}{i}": build_register_request(f"{prefix}{i}", "N", "SI", "FT", 1, "2026-01-01", 9999, "PI")
+        for i in range(count)
+    }
+
+
+def _wsse_factory(username, password):
+    return PerRequestUsernameToken(username, BENCHMARK_ENCRYPTED_PASSWORD)
+
+
+def _timed_call(service, request_data):
+    started = time.perf_counter()
+    try:
+        ok = parse_series_response(service.registarSerie(**request_data))["status"] == "success"
+    except Exception:
+        ok = False
+    return (time.perf_counter() - started) * 1000, ok
+
+
+def _run_new_client(server, prefix, count):
+    latencies, errors = [], 0
+    for request_data in _requests(prefix, count).values():
+        started = time.perf_counter()
+        client = Client(server.wsdl_url, settings=Settings(strict=False), transport=Transport(timeout=30),
+                        wsse=_wsse_factory(BENCHMARK_USERNAME, None))
+        _, ok = _timed_call(client.service, request_data)
+        client.transport.session.close()
+        latencies.append((time.perf_counter() - started) * 1000)
+        errors += not ok
+    return latencies, errors
+
+
+def _run_pooled_client(server, prefix, count, concurrency):
+    service = get_cached_soap_client(server.wsdl_url, BENCHMARK_USERNAME, BENCHMARK_ENCRYPTED_PASSWORD, _wsse_factory,
+                                     endpoint_url=server.url).service
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda request_data: _timed_call(service, request_data), _requests(prefix, count).values()))
+    return [latency for latency, _ in results], sum(not ok for _, ok in results)
+
+
+def _run_async_bulk(server, prefix, count, concurrency):
+    paths = {"cert_path": None, "cert_password": None, "wsdl_path": server.wsdl_url, "endpoint_url": server.url}
+    wsse = _wsse_factory(BENCHMARK_USERNAME, None)
+    results = asyncio.run(_send_all("registarSerie", _requests(prefix, count), concurrency, paths, wsse))
+    return [result["seconds"] * 1000 for result in results.values()], sum(result["status"] != "success" for result in results.values())
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda p: round(values[min(int(len(values) * p), len(values) - 1)], 2)
+    return {"p50": pick(0.50), "p95": pick(0.95), "p99": pick(0.99), "max": round(values[-1], 2)}
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+"""Local stand-in for the AT SeriesWS webservice (registarSerie / consultarSerie / anularSerie).
+
+Lets atcud_service, ATCommunicationService, the bulk calls and the AT outbox run without the
+real AT endpoint, and benchmarks client throughput, connection pooling and retry behaviour
+offline. Series are kept in memory, so registering a series twice is rejected like AT does.
+
+Injected behaviour (all optional):
+    latency_ms / jitter_ms   - delay before every response (uniform jitter)
+    error_rate               - business errors (infoResultOper with an error code, no infoSerie)
+    fault_rate               - SOAP Faults (HTTP 500)
+    http_error_rate          - HTTP 503 without a SOAP body
+    drop_rate                - connection closed without any response
+Series codes starting with "FAULT", "ERRO" or "DROP" always get that outcome, which makes
+single cases reproducible.
+
+Standalone (no site needed):
+    python -m portugal_compliance.saft.at_series_standin --port 8099 --latency-ms 50 --fault-rate 0.05
+
+With TLS and client certificates (to exercise the mTLS session pool):
+    ... --certfile server.pem --cafile ca.pem
+
+Point Portugal Compliance Settings at it: usar_wsdl_personalizado = 1,
+wsdl_path = http://127.0.0.1:8099/SeriesWSService?wsdl, endpoint_url = http://127.0.0.1:8099/SeriesWSService.
+In code, start_standin_server() runs it in a background thread (see saft/at_series_benchmark.py).
+"""
+
+import argparse
+import json
+import os
+import random
+import ssl
+import string
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from lxml import etree
+
+SOAP_ENV_NS = "http://schemas.xmlsoap.org/soap/envelope/"
+AT_NS = "http://at.gov.pt/"
+WSSE_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+SERVICE_PATH = "/SeriesWSService"
+WSDL_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "at_series_standin.wsdl")
+WSDL_ADDRESS_PLACEHOLDER = "http://127.0.0.1:8099/SeriesWSService"
+
+OPERATIONS = ("registarSerie", "consultarSerie", "anularSerie")
+
+# Result codes returned in infoResultOper
+RESULT_OK = {
+    "registarSerie": ("2001", "Serie registada com sucesso."),
+    "consultarSerie": ("2003", "Consulta efetuada com sucesso."),
+    "anularSerie": ("2002", "Serie anulada com sucesso."),
+}
+RESULT_DUPLICATE = ("4001", "A serie ja se encontra registada.")
+RESULT_NOT_FOUND = ("4002", "Serie inexistente.")
+RESULT_ANNULLED = ("4003", "A serie ja se encontra anulada.")
+RESULT_INJECTED = ("4999", "Erro simulado pelo servidor de testes.")
+
+
+class StandinConfig(object):
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, fault_rate=0.0, http_error_rate=0.0,
+                 drop_rate=0.0, require_wsse=True, seed=None):
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.error_rate = float(error_rate)
+        self.fault_rate = float(fault_rate)
+        self.http_error_rate = float(http_error_rate)
+        self.drop_rate = float(drop_rate)
+        self.require_wsse = bool(require_wsse)
+        self.seed = seed
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+
+class SeriesWSStandin(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, config=None, ssl_context=None):
+        super(SeriesWSStandin, self).__init__(address, SeriesWSHandler)
+        self.config = config or StandinConfig()
+        self.scheme = "https" if ssl_context else "http"
+        if ssl_context:
+            self.socket = ssl_context.wrap_socket(self.socket, server_side=True)
+        self._lock = threading.Lock()
+        self._random = random.Random(self.config.seed)
+        self.series = {} # serie -> info dict
+        self.stats = {"connections": 0, "requests": 0, "by_operation": {}, "outcomes": {}}
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"{self.scheme}://{'localhost' if self.scheme == 'https' else host}:{port}{SERVICE_PATH}"
+
+    @property
+    def wsdl_url(self):
+        return self.url + "?wsdl"
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def count(self, group, key=None):
+        with self._lock:
+            if key is None:
+                self.stats[group] += 1
+            else:
+                self.stats[group][key] = self.stats[group].get(key, 0) + 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = json.loads(json.dumps(self.stats))
+        stats["series"] = len(self.series)
+        stats["requests_per_connection"] = round(stats["requests"] / stats["connections"], 2) if stats["connections"] else 0.0
+        stats["config"] = self.config.as_dict()
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self.series.clear()
+            self.stats = {"connections": 0, "requests": 0, "by_operation": {}, "outcomes": {}}
+
+    # --- Operations (called with the request fields as a dict) ---
+
+    def registar_serie(self, fields):
+        serie = fields.get("serie")
+        with self._lock:
+            if serie in self.series:
+                return RESULT_DUPLICATE, None
+            info = {
+                "serie": serie,
+                "tipoSerie": fields.get("tipoSerie"),
+                "classeDoc": fields.get("classeDoc"),
+                "tipoDoc": fields.get("tipoDoc"),
+                "numPrimDocSerie": fields.get("numPrimDocSerie"),
+                "dataInicioPrevUtiliz": fields.get("dataInicioPrevUtiliz"),
+                "codValidacaoSerie": "".join(self._random.choice(string.ascii_uppercase + string.digits) for _ in range(8)),
+                "estado": "A",
+                "dataRegisto": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+            }
+            self.series[serie] = info
+        return RESULT_OK["registarSerie"], info
+
+    def consultar_serie(self, fields):
+        with self._lock:
+            info = self.series.get(fields.get("serie"))
+        if not info:
+            return RESULT_NOT_FOUND, None
+        return RESULT_OK["consultarSerie"], info
+
+    def anular_serie(self, fields):
+        with self._lock:
+            info = self.series.get(fields.get("serie"))
+            if not info:
+                return RESULT_NOT_FOUND, None
+            if info["estado"] == "N":
+                return RESULT_ANNULLED, None
+            info["estado"] = "N"
+        return RESULT_OK["anularSerie"], info
+
+
+class SeriesWSHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, so client connection reuse is visible in the stats
+    server_version = "SeriesWSStandin/1.0"
+
+    def setup(self):
+        super(SeriesWSHandler, self).setup()
+        self.server.count("connections")
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if "wsdl" not in (urlsplit(self.path).query or "").lower():
+            return self._send(404, b"Not found", "text/plain")
+        with open(WSDL_FILE, "rb") as wsdl_file:
+            wsdl = wsdl_file.read().replace(WSDL_ADDRESS_PLACEHOLDER.encode(), self.server.url.encode())
+        self._send(200, wsdl, "text/xml; charset=utf-8")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.server.count("requests")
+        try:
+            envelope = etree.fromstring(body)
+            request = envelope.find(f"{{{SOAP_ENV_NS}}}Body")[0]
+        except Exception:
+            return self._fault("Client", "Malformed SOAP request.")
+
+        operation = etree.QName(request).localname
+        fields = {etree.QName(child).localname: child.text for child in request}
+        self.server.count("by_operation", operation)
+        if operation not in OPERATIONS:
+            return self._fault("Client", f"Unknown operation {operation}.")
+        if self.server.config.require_wsse and envelope.find(f".//{{{WSSE_NS}}}UsernameToken") is None:
+            return self._fault("Client", "Missing WS-Security UsernameToken.")
+
+        self._delay()
+        outcome = self._pick_outcome(fields.get("serie") or "")
+        self.server.count("outcomes", outcome)
+        if outcome == "drop":
+            self.close_connection = True
+            return
+        if outcome == "http_error":
+            return self._send(503, b"Service Unavailable", "text/plain")
+        if outcome == "fault":
+            return self._fault("Server", "Simulated AT fault.")
+        if outcome == "error":
+            return self._respond(operation, RESULT_INJECTED, None)
+
+        handler = {
+            "registarSerie": self.server.registar_serie,
+            "consultarSerie": self.server.consultar_serie,
+            "anularSerie": self.server.anular_serie,
+        }[operation]
+        result, info = handler(fields)
+        self._respond(operation, result, info)
+
+    def _delay(self):
+        config = self.server.config
+        delay = config.latency_ms + (self.server.random() * 2 - 1) * config.jitter_ms
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _pick_outcome(self, serie):
+        for prefix, outcome in (("FAULT", "fault"), ("ERRO", "error"), ("DROP", "drop")):
+            if serie.upper().startswith(prefix):
+                return outcome
+        config = self.server.config
+        roll = self.server.random()
+        for rate, outcome in ((config.drop_rate, "drop"), (config.http_error_rate, "http_error"),
+                              (config.fault_rate, "fault"), (config.error_rate, "error")):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+    def _respond(self, operation, result, info):
+        envelope = etree.Element(f"{{{SOAP_ENV_NS}}}Envelope", nsmap={"S": SOAP_ENV_NS, "ns2": AT_NS})
+        body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+        response = etree.SubElement(body, f"{{{AT_NS}}}{operation}Response")
+        result_oper = etree.SubElement(response, "infoResultOper")
+        etree.SubElement(result_oper, "codResultOper").text = result[0]
+        etree.SubElement(result_oper, "msgResultOper").text = result[1]
+        if info:
+            info_serie = etree.SubElement(response, "infoSerie")
+            for key, value in info.items():
+                if value is not None:
+                    etree.SubElement(info_serie, key).text = str(value)
+        self._send(200, etree.tostring(envelope, xml_declaration=True, encoding="utf-8"), "text/xml; charset=utf-8")
+
+    def _fault(self, code, message):
+        envelope = etree.Element(f"{{{SOAP_ENV_NS}}}Envelope", nsmap={"S": SOAP_ENV_NS})
+        body = etree.SubElement(envelope, f"{{{SOAP_ENV_NS}}}Body")
+        fault = etree.SubElement(body, f"{{{SOAP_ENV_NS}}}Fault")
+        etree.SubElement(fault, "faultcode").text = f"S:{code}"
+        etree.SubElement(fault, "faultstring").text = message
+        self._send(500, etree.tostring(envelope, xml_declaration=True, encoding="utf-8"), "text/xml; charset=utf-8")
+
+    def _send(self, status, payload, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def build_server_ssl_context(certfile, cafile=None):
+    """Server TLS context; with cafile, clients must present a certificate signed by it."""
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH, cafile=cafile)
+    context.load_cert_chain(certfile)
+    context.verify_mode = ssl.CERT_REQUIRED if cafile else ssl.CERT_NONE
+    return context
+
+
+def start_standin_server(host="127.0.0.1", port=0, certfile=None, cafile=None, **config):
+    """Starts the stand-in in a daemon thread and returns the server (see .url, .wsdl_url,
+    .get_stats(), .shutdown()). port=0 picks a free port."""
+    ssl_context = build_server_ssl_context(certfile, cafile) if certfile else None
+    server = SeriesWSStandin((host, int(port)), StandinConfig(**config), ssl_context=ssl_context)
+    threading.Thread(target=server.serve_forever, name="at-series-standin", daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the AT SeriesWS webservice.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--jitter-ms", type=float, default=0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--fault-rate", type=float, default=0.0)
+    parser.add_argument("--http-error-rate", type=float, default=0.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--no-wsse", action="store_true", help="accept requests without a WS-Security header")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--certfile", help="server certificate and key (PEM); enables HTTPS")
+    parser.add_argument("--cafile", help="CA that must have signed the client certificates")
+    args = parser.parse_args()
+
+    ssl_context = build_server_ssl_context(args.certfile, args.cafile) if args.certfile else None
+    server = SeriesWSStandin((args.host, args.port), StandinConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate,
+        fault_rate=args.fault_rate, http_error_rate=args.http_error_rate, drop_rate=args.drop_rate,
+        require_wsse=not args.no_wsse, seed=args.seed
+    ), ssl_context=ssl_context)
+    print(f"SeriesWS stand-in listening on {server.url} (WSDL: {server.wsdl_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.get_stats(), indent=2))
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
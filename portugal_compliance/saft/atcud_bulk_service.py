@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import asyncio
+import time
+
+import frappe
+import httpx
+from frappe.utils import cint, cstr, flt, nowdate
+from zeep import AsyncClient, Settings
+from zeep.exceptions import Fault
+from zeep.transports import AsyncTransport
+
+from .atcud_service import (
+    DOCUMENT_CLASSES,
+    _series_wsse_factory,
+    build_consult_request,
+    build_finalize_request,
+    build_register_request,
+    get_at_subuser_credentials,
+    get_portugal_compliance_paths,
+    get_series_endpoint,
+    get_wsdl_cache,
+    parse_series_response,
+)
+from .at_metrics import record_phase
+from .circuit_breaker import CircuitOpenError, DeadlineExceeded, get_circuit_breaker, is_endpoint_failure
+from .http_session import build_client_ssl_context
+from ..utils.fiscal_signature import DOCUMENT_TYPE_CODES
+
+# Bulk series communication with AT (registarSerie / consultarSerie / anularSerie).
+# At the start of the year hundreds of series are registered; instead of one blocking SOAP call
+# at a time, the requests are sent concurrently over a single zeep AsyncClient (httpx, same client
+# certificate as the synchronous calls), with at most 'concurrency' requests in flight.
+# Every series gets its own result; the validation codes are written back to
+# Serie de Documento Fiscal in one bulk update.
+# Calls go through the endpoint's circuit breaker (saft/circuit_breaker.py): while it is open the
+# remaining series get status "circuit_open" at once instead of waiting for AT.
+#
+# Configuration (site_config.json):
+#     "pt_at_bulk_concurrency": 10
+
+DEFAULT_CONCURRENCY = 10
+MAX_CONCURRENCY = 50
+OPERATION_TIMEOUT = 60
+
+OPERATIONS = {
+    "register": "registarSerie",
+    "consult": "consultarSerie",
+    "finalize": "anularSerie",
+}
+
+SERIE_FIELDS = ["name", "prefixo_serie", "tipo_documento", "ano_fiscal", "numero_sequencial_atual",
+                "codigo_validacao_serie_at", "ativo"]
+
+
+@frappe.whitelist()
+def register_series_bulk(series, data_inicio_prev_utiliz=None, tipo_serie="N", meio_processamento="PI", concurrency=None, deadline=None):
+    """Registers many Serie de Documento Fiscal with AT concurrently and stores their validation codes."""
+    frappe.only_for("System Manager")
+    num_cert_sw_fatur = frappe.db.get_single_value("Portugal Compliance Settings", "numero_certificado_software_at")
+    if not num_cert_sw_fatur:
+        frappe.throw(frappe._("Número do certificado do software (AT) não configurado em Portugal Compliance Settings."))
+
+    requests = {}
+    for serie in _get_series(series):
+        tipo_doc = DOCUMENT_TYPE_CODES.get(serie.tipo_documento)
+        requests[serie.name] = build_register_request(
+            serie.prefixo_serie,
+            tipo_serie,
+            DOCUMENT_CLASSES.get(tipo_doc),
+            tipo_doc,
+            cint(serie.numero_sequencial_atual) + 1,
+            cstr(data_inicio_prev_utiliz or nowdate()),
+            num_cert_sw_fatur,
+            meio_processamento
+        )
+    return _run_and_store("register", requests, concurrency, deadline)
+
+
+@frappe.whitelist()
+def consult_series_bulk(series, concurrency=None, deadline=None):
+    """Consults many series at AT concurrently; validation codes returned by AT are stored."""
+    frappe.only_for("System Manager")
+    requests = {
+        serie.name: build_consult_request(serie.prefixo_serie, serie.ano_fiscal)
+        for serie in _get_series(series)
+    }
+    return _run_and_store("consult", requests, concurrency, deadline)
+
+
+@frappe.whitelist()
+def finalize_series_bulk(series, motivo_anulacao="Encerramento normal", concurrency=None, deadline=None):
+    """Finalizes (anularSerie) many series at AT concurrently; finalized series are deactivated."""
+    frappe.only_for("System Manager")
+    requests = {
+        serie.name: build_finalize_request(serie.prefixo_serie, serie.ano_fiscal, motivo_anulacao)
+        for serie in _get_series(series)
+    }
+    return _run_and_store("finalize", requests, concurrency, deadline)
+
+
+def run_bulk_series_operation(operation, requests, concurrency=None, deadline=None):
+    """Sends {key: request_data} to the AT operation ('register', 'consult' or 'finalize')
+    concurrently and returns {key: result}. Does not write to the database.
+    deadline: time budget in seconds for the whole run; requests not answered in time get
+    status "deadline_exceeded"."""
+    if operation not in OPERATIONS:
+        frappe.throw(frappe._("Operação AT desconhecida: {0}").format(operation))
+    if not requests:
+        return {}
+
+    concurrency = min(cint(concurrency) or cint(frappe.conf.get("pt_at_bulk_concurrency")) or DEFAULT_CONCURRENCY,
+                      MAX_CONCURRENCY)
+    paths = get_portugal_compliance_paths()
+    username, password = get_at_subuser_credentials()
+    # The password is encrypted once for the whole run; each request gets a fresh nonce/timestamp
+    wsse = _series_wsse_factory(username, password)
+
+    return asyncio.run(_send_all(OPERATIONS[operation], requests, concurrency, paths, wsse, deadline))
+
+
+async def _send_all(operation_name, requests, concurrency, paths, wsse, deadline=None):
+    # Same breaker as the synchronous calls (saft/atcud_service.get_series_endpoint)
+    breaker = get_circuit_breaker(get_series_endpoint(paths))
+    deadline_at = time.monotonic() + flt(deadline) if deadline else None
+    ssl_context = build_client_ssl_context(paths["cert_path"], paths["cert_password"])
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    wsdl_client = httpx.Client(verify=ssl_context, timeout=30)
+    http_client = httpx.AsyncClient(verify=ssl_context, limits=limits, timeout=OPERATION_TIMEOUT)
+    try:
+        transport = AsyncTransport(client=http_client, wsdl_client=wsdl_client, cache=get_wsdl_cache())
+        started = time.perf_counter()
+        client = AsyncClient(paths["wsdl_path"], settings=Settings(strict=False, xml_huge_tree=True),
+                             transport=transport, wsse=wsse)
+        record_phase("wsdl_load", time.perf_counter() - started, operation=operation_name, result="loaded")
+        service = client.bind("SeriesWSService", "SeriesWSPort")
+        if paths["endpoint_url"]:
+            service._binding_options["address"] = paths["endpoint_url"]
+        operation = getattr(service, operation_name)
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def send(key, request_data):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    timeout = OPERATION_TIMEOUT
+                    if deadline_at is not None:
+                        timeout = min(deadline_at - time.monotonic(), OPERATION_TIMEOUT)
+                        if timeout <= 0:
+                            raise DeadlineExceeded("Deadline budget exhausted before calling AT.")
+                    breaker.before_call()
+                except (CircuitOpenError, DeadlineExceeded) as e:
+                    result = {"status": e.status, "message": cstr(e)}
+                    record_phase("total", operation=operation_name, result=e.status)
+                else:
+                    success, outcome, fault_code = True, "success", None
+                    try:
+                        result = parse_series_response(await asyncio.wait_for(operation(**request_data), timeout))
+                        # AT answered (success or business error), as opposed to faults and transport errors
+                        result["answered"] = True
+                        if operation_name == OPERATIONS["register"] and result["status"] == "success" and not result["validation_code"]:
+                            result.update(status="error", message=result["message"] or "AT returned no validation code.")
+                    except asyncio.TimeoutError:
+                        success = False
+                        status = "deadline_exceeded" if deadline_at is not None and timeout < OPERATION_TIMEOUT else "error"
+                        outcome = "deadline_exceeded" if status == "deadline_exceeded" else "timeout"
+                        result = {"status": status, "message": f"No answer from AT within {timeout:.1f}s."}
+                    except Fault as f:
+                        success, outcome, fault_code = not is_endpoint_failure(f), "fault", cstr(f.code)
+                        result = {"status": "error", "code": cstr(f.code), "message": cstr(f.message)}
+                    except Exception as e:
+                        success, outcome = False, "error"
+                        result = {"status": "error", "message": cstr(e) or e.__class__.__name__}
+                    elapsed = time.perf_counter() - started
+                    if outcome == "deadline_exceeded":
+                        # The caller's budget ran out: not the endpoint's fault
+                        breaker.cancel()
+                    else:
+                        breaker.record(success, elapsed)
+                    record_phase("total", elapsed, operation=operation_name, result=outcome, fault_code=fault_code)
+                result["serie"] = request_data.get("serie")
+                result["seconds"] = round(time.perf_counter() - started, 3)
+                return key, result
+
+        results = await asyncio.gather(*(send(key, request_data) for key, request_data in requests.items()))
+        return dict(results)
+    finally:
+        await http_client.aclose()
+        wsdl_client.close()
+
+
+def _run_and_store(operation, requests, concurrency, deadline=None):
+    started = time.perf_counter()
+    results = run_bulk_series_operation(operation, requests, concurrency, deadline)
+
+    updates = {}
+    for serie_name, result in results.items():
+        if result["status"] != "success":
+            continue
+        if operation == "finalize":
+            updates[serie_name] = {"ativo": 0}
+        elif result.get("validation_code"):
+            updates[serie_name] = {"codigo_validacao_serie_at": result["validation_code"]}
+    if updates:
+        frappe.db.bulk_update("Serie de Documento Fiscal", updates)
+
+    failed = {name: result for name, result in results.items() if result["status"] != "success"}
+    if failed:
+        frappe.log_error(frappe.as_json(failed), f"AT bulk {OPERATIONS[operation]}: {len(failed)} series failed")
+
+    return {
+        "operation": OPERATIONS[operation],
+        "total": len(results),
+        "succeeded": len(results) - len(failed),
+        "failed": len(failed),
+        "updated": len(updates),
+        "seconds": round(time.perf_counter() - started, 3),
+        "results": results,
+    }
+
+
+def _get_series(series):
+    if isinstance(series, str):
+        series = frappe.parse_json(series) if series.startswith("[") else [series]
+    rows = frappe.get_all("Serie de Documento Fiscal", filters={"name": ["in", list(series)]}, fields=SERIE_FIELDS)
+    missing = set(series) - {row.name for row in rows}
+    if missing:
+        frappe.throw(frappe._("Séries não encontradas: {0}").format(", ".join(sorted(missing))))
+    return rows
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import threading
+from bisect import bisect_right
+
+import frappe
+from frappe.utils import getdate
+
+# Per-process caches used to build the ATCUD without database queries in steady state:
+#  - AT validation codes keyed by (series code, AT document type, fiscal year)
+#  - a sorted interval index of fiscal years, looked up by date with bisect
+# Other processes are told to drop their copy through a version token kept in redis,
+# which is read at most once per request.
+CACHE_VERSION_KEY = "pt_atcud_cache_version"
+
+_lock = threading.Lock()
+_caches = {} # site -> {"version": str, "validation_codes": {}, "fiscal_years": index or None}
+
+
+def get_cached_fiscal_year(posting_date):
+    """Returns the name of the Fiscal Year containing posting_date, or None."""
+    cache = _get_site_cache()
+    index = cache["fiscal_years"]
+    if index is None:
+        index = cache["fiscal_years"] = _build_fiscal_year_index()
+
+    posting_date = getdate(posting_date)
+    position = bisect_right(index["starts"], posting_date) - 1
+    # Walk back over overlapping fiscal years (e.g. company-specific ones) until one contains the date
+    while position >= 0:
+        if posting_date <= index["ends"][position]:
+            return index["names"][position]
+        position -= 1
+    return None
+
+
+def get_cached_validation_code(series_code, doc_type_at_code, fiscal_year):
+    """Returns the AT validation code of a communicated series (None if there is none)."""
+    cache = _get_site_cache()
+    key = (series_code, doc_type_at_code, fiscal_year)
+    validation_codes = cache["validation_codes"]
+    if key not in validation_codes:
+        # Missing codes are cached too: a series communicated later invalidates the cache
+        validation_codes[key] = frappe.db.get_value("Document Series PT", {
+            "series_code": series_code,
+            "document_type": doc_type_at_code,
+            "fiscal_year": fiscal_year,
+            "communication_status": "Communicated"
+        }, "at_validation_code")
+    return validation_codes[key]
+
+
+def invalidate_atcud_cache(doc=None, method=None):
+    """doc_events hook (Document Series PT, Fiscal Year): drops the caches in every process."""
+    with _lock:
+        _caches.pop(frappe.local.site, None)
+    frappe.cache().set_value(CACHE_VERSION_KEY, frappe.generate_hash(length=10))
+    if getattr(frappe.local, "pt_atcud_cache_version", None) is not None:
+        del frappe.local.pt_atcud_cache_version
+
+
+def _get_site_cache():
+    version = _get_cache_version()
+    site = frappe.local.site
+    with _lock:
+        cache = _caches.get(site)
+        if not cache or cache["version"] != version:
+            cache = _caches[site] = {"version": version, "validation_codes": {}, "fiscal_years": None}
+        return cache
+
+
+def _get_cache_version():
+    # One redis read per request; no database access
+    version = getattr(frappe.local, "pt_atcud_cache_version", None)
+    if version is None:
+        version = frappe.cache().get_value(CACHE_VERSION_KEY) or ""
+        frappe.local.pt_atcud_cache_version = version
+    return version
+
+
+def _build_fiscal_year_index():
+    fiscal_years = frappe.get_all(
+        "Fiscal Year",
+        fields=["name", "year_start_date", "year_end_date"],
+        order_by="year_start_date asc"
+    )
+    return {
+        "starts": [getdate(fy.year_start_date) for fy in fiscal_years],
+        "ends": [getdate(fy.year_end_date) for fy in fiscal_years],
+        "names": [fy.name for fy in fiscal_years],
+    }
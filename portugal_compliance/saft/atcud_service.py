@@ -1,10 +1,20 @@
 import frappe
 from frappe.utils import cint, cstr, now_datetime
 from lxml import etree
-from zeep import Client, Settings, Transport
+from lxml.etree import QName
+from zeep import Client, Settings
+from zeep.cache import SqliteCache
 from zeep.wsse.username import UsernameToken
+from zeep.wsse.utils import get_security_header
 from zeep.exceptions import Fault
+from zeep.helpers import serialize_object
+from .at_metrics import record_phase
+from .circuit_breaker import DEFAULT_OPERATION_TIMEOUT, CircuitOpenError, DeadlineExceeded, DeadlineTransport, guarded_call
+from .http_session import close_pooled_sessions, get_pooled_session
+import hashlib
 import os
+import threading
+import time
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.backends import default_backend
@@ -12,9 +22,37 @@ import base64
 import datetime
 
 # --- Constants and Configuration ---
-# These should ideally be configurable via ERPNext settings
+# Paths and the parsed AT public key are cached per process. Saving Portugal Compliance Settings
+# bumps a version token in redis (read once per request) so every process reloads them; the key
+# file is also reloaded when its mtime changes.
+SETTINGS_CACHE_VERSION_KEY = "pt_at_settings_cache_version"
+
+# RSA-OAEP with SHA-1, as required by AT for the WS-Security password
+AT_PASSWORD_PADDING = padding.OAEP(
+    mgf=padding.MGF1(algorithm=hashes.SHA1()),
+    algorithm=hashes.SHA1(),
+    label=None
+)
+
+_settings_cache_lock = threading.Lock()
+_paths_cache = {} # site -> (version, paths)
+_public_key_cache = {} # key file path -> (mtime, public key)
+
 def get_portugal_compliance_paths():
-    """Get secure paths to certificates and WSDL from Portugal Compliance Settings."""
+    """Get secure paths to certificates and WSDL from Portugal Compliance Settings (cached per process)."""
+    site = frappe.local.site
+    version = _get_settings_cache_version()
+    with _settings_cache_lock:
+        cached = _paths_cache.get(site)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    paths = _load_portugal_compliance_paths()
+    with _settings_cache_lock:
+        _paths_cache[site] = (version, paths)
+    return paths
+
+def _load_portugal_compliance_paths():
     usar_personalizado = frappe.db.get_single_value("Portugal Compliance Settings", "usar_wsdl_personalizado")
 
     wsdl_path = (
@@ -23,55 +61,90 @@ def get_portugal_compliance_paths():
         else frappe.get_app_path("portugal_compliance", "wsdl", "Comunicacao_Series.wsdl")
     )
 
-    return {
+    return frappe._dict({
         "cert_path": frappe.db.get_single_value("Portugal Compliance Settings", "cert_path"),
         "cert_password": frappe.db.get_single_value("Portugal Compliance Settings", "cert_password", cache=False),
         "at_public_key_path": frappe.db.get_single_value("Portugal Compliance Settings", "at_public_key_path"),
         "endpoint_url": frappe.db.get_single_value("Portugal Compliance Settings", "endpoint_url"),
         "wsdl_path": wsdl_path
-    }
+    })
+
+def _get_settings_cache_version():
+    # One redis read per request; no database access
+    version = getattr(frappe.local, "pt_at_settings_cache_version", None)
+    if version is None:
+        version = frappe.cache().get_value(SETTINGS_CACHE_VERSION_KEY) or ""
+        frappe.local.pt_at_settings_cache_version = version
+    return version
+
+def invalidate_at_settings_cache():
+    """Called when Portugal Compliance Settings is saved: drops the cached paths, public key,
+    SOAP clients and HTTP sessions in every process."""
+    with _settings_cache_lock:
+        _paths_cache.pop(frappe.local.site, None)
+        _public_key_cache.clear()
+    clear_soap_client_registry()
+    close_pooled_sessions()
+    frappe.cache().set_value(SETTINGS_CACHE_VERSION_KEY, frappe.generate_hash(length=10))
+    if getattr(frappe.local, "pt_at_settings_cache_version", None) is not None:
+        del frappe.local.pt_at_settings_cache_version
 
 # --- Helper Functions ---
 
 def get_at_public_key():
-    """Loads the AT's public key from the .cer file."""
-    paths = get_portugal_compliance_paths()
-    with open(paths["at_public_key_path"], "rb") as key_file:
+    """Loads the AT's public key from the .cer file (parsed once per process, reloaded if the file changes)."""
+    key_path = get_portugal_compliance_paths()["at_public_key_path"]
+    mtime = os.path.getmtime(key_path)
+    with _settings_cache_lock:
+        cached = _public_key_cache.get(key_path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(key_path, "rb") as key_file:
         public_key = serialization.load_pem_public_key(
             key_file.read(),
             backend=default_backend()
         )
+    with _settings_cache_lock:
+        _public_key_cache[key_path] = (mtime, public_key)
     return public_key
 
+def _get_at_public_key_mtime():
+    key_path = get_portugal_compliance_paths().get("at_public_key_path")
+    try:
+        return os.path.getmtime(key_path) if key_path else None
+    except OSError:
+        return None
+
 def encrypt_password_with_at_public_key(password):
     """Encrypts the password using AT's public key (RSA OAEP)."""
     public_key = get_at_public_key()
-    encrypted_password = public_key.encrypt(
-        password.encode("utf-8"),
-        padding.OAEP(
-            mgf=padding.MGF1(algorithm=hashes.SHA1()),
-            algorithm=hashes.SHA1(),
-            label=None
-        )
-    )
+    encrypted_password = public_key.encrypt(password.encode("utf-8"), AT_PASSWORD_PADDING)
     return base64.b64encode(encrypted_password).decode("utf-8")
 
+WSSE_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-secext-1.0.xsd"
+WSU_NS = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-wssecurity-utility-1.0.xsd"
+
 class CustomUsernameToken(UsernameToken):
     """Custom UsernameToken to handle AT's specific password encryption and nonce encoding."""
-    def __init__(self, username, password=None, password_digest=None, nonce=None, created=None, use_digest=False, **kwargs):
-        super().__init__(username, password, password_digest, nonce, created, use_digest, **kwargs)
+    namespace = WSSE_NS
+    wsse_utility_ns = WSU_NS
+    prefix = "UsernameToken"
+    password_digest_uri = "http://docs.oasis-open.org/wss/2004/01/oasis-200401-wss-username-token-profile-1.0#PasswordDigest"
+
+    def __init__(self, username, password=None, password_digest=None, nonce=None, created=None, use_digest=False, encrypted_password=None, **kwargs):
+        super().__init__(username, password=password, password_digest=password_digest, use_digest=use_digest,
+                         nonce=nonce, created=created, **kwargs)
         # AT expects password to be encrypted with their public key and then base64 encoded
         # The UsernameToken from zeep by default base64 encodes the password if it's not a digest.
-        # We need to encrypt it first.
-        if password and not use_digest:
+        # We need to encrypt it first (unless an already encrypted password is given).
+        if encrypted_password:
+            self.password = encrypted_password
+        elif password and not use_digest:
             self.password = encrypt_password_with_at_public_key(password)
 
     def apply(self, envelope, headers):
-        security = etree.Element(
-            QName(self.namespace, "Security"),
-            mustUnderstand="1",
-            actor=self.actor,
-        )
+        security = get_security_header(envelope)
 
         # Timestamp
         timestamp = etree.SubElement(
@@ -120,41 +193,123 @@ class CustomUsernameToken(UsernameToken):
                 token, QName(self.wsse_utility_ns, "Created")
             ).text = created_val
 
-        headers.insert(0, security)
         return envelope, headers
 
-def get_soap_client(username, password):
-    """Initializes and returns the Zeep SOAP client with WS-Security."""
-    paths = get_portugal_compliance_paths()
+class PerRequestUsernameToken:
+    """WS-Security plugin for cached clients: the password is encrypted once, and every call
+    gets a fresh CustomUsernameToken (new nonce and timestamp). Safe to share between threads."""
+    def __init__(self, username, encrypted_password):
+        self.username = username
+        self.encrypted_password = encrypted_password
 
-    settings = Settings(strict=False, xml_huge_tree=True)
-    transport = Transport(timeout=30)
-    transport.client_cert = (paths["cert_path"], paths["cert_password"])
+    def apply(self, envelope, headers):
+        token = CustomUsernameToken(
+            self.username,
+            nonce=os.urandom(16).hex(),
+            created=datetime.datetime.utcnow(),
+            encrypted_password=self.encrypted_password
+        )
+        return token.apply(envelope, headers)
+
+    def verify(self, envelope):
+        return envelope
+
+# --- SOAP client registry ---
+# Building a zeep Client parses the WSDL and imports its schemas. Clients are kept per process,
+# keyed by (WSDL, endpoint, HTTP session, credentials), and remote schema imports are cached on
+# disk (SQLite) so a new worker does not download them again.
+
+WSDL_CACHE_TIMEOUT = 7 * 24 * 3600
+
+_client_registry = {}
+_client_registry_lock = threading.Lock()
+
+def get_wsdl_cache():
+    return SqliteCache(path=frappe.get_site_path("private", "zeep_wsdl_cache.db"), timeout=WSDL_CACHE_TIMEOUT)
+
+def get_cached_soap_client(wsdl, username, password, wsse_factory, endpoint_url=None, client_cert=None, proxies=None, strict=False):
+    """Returns a cached zeep Client and its service (bound to endpoint_url, if given).
+    wsse_factory(username, password) builds the WS-Security plugin when the client is created."""
+    # Keep-alive session (client certificate and proxies) shared by every client; see saft/http_session.py
+    session = get_pooled_session(client_cert=client_cert, proxies=proxies)
+    # The settings version (redis) and the AT key mtime expire clients built by every process
+    # before the settings were saved or the key file was replaced (the WS-Security plugin
+    # encrypts the password with that key)
+    key = (
+        frappe.local.site, _get_settings_cache_version(), _get_at_public_key_mtime(),
+        wsdl, endpoint_url, session, username,
+        hashlib.sha256(cstr(password).encode("utf-8")).hexdigest(), strict
+    )
+    with _client_registry_lock:
+        entry = _client_registry.get(key)
+    if entry:
+        return entry
+
+    # Operation timeout follows the caller's deadline budget; see saft/circuit_breaker.py
+    transport = DeadlineTransport(cache=get_wsdl_cache(), timeout=30, operation_timeout=DEFAULT_OPERATION_TIMEOUT, session=session)
+
+    started = time.monotonic()
+    client = Client(wsdl, settings=Settings(strict=strict, xml_huge_tree=True), transport=transport,
+                    wsse=wsse_factory(username, password))
+    record_phase("wsdl_load", time.monotonic() - started, result="loaded")
+    service = client.service
+    if endpoint_url:
+        service = client.bind("SeriesWSService", "SeriesWSPort")
+        service._binding_options["address"] = endpoint_url
+
+    entry = frappe._dict(client=client, service=service)
+    with _client_registry_lock:
+        # Drop this site's clients from older settings versions or key files
+        for stale_key in [k for k in _client_registry if k[0] == key[0] and k[1:3] != key[1:3]]:
+            del _client_registry[stale_key]
+        _client_registry[key] = entry
+    return entry
+
+def clear_soap_client_registry():
+    with _client_registry_lock:
+        _client_registry.clear()
+
+def _series_wsse_factory(username, password):
+    return PerRequestUsernameToken(username, encrypt_password_with_at_public_key(password))
 
-    wsse = CustomUsernameToken(username, password, nonce=os.urandom(16).hex(), created=datetime.datetime.utcnow())
+def get_soap_client(username, password):
+    """Returns the SeriesWS service proxy, bound to the configured endpoint, with WS-Security."""
+    paths = get_portugal_compliance_paths()
 
-    client = Client(paths["wsdl_path"], settings=settings, transport=transport, wsse=wsse)
-    service = client.bind("SeriesWSService", "SeriesWSPort")
-    service._binding_options["address"] = paths["endpoint_url"]
+    entry = get_cached_soap_client(
+        paths["wsdl_path"],
+        username,
+        password,
+        _series_wsse_factory,
+        endpoint_url=paths["endpoint_url"],
+        client_cert=(paths["cert_path"], paths["cert_password"])
+    )
+    return entry.service
 
-    return client.service
+def get_series_endpoint(paths=None):
+    """Endpoint used to key the circuit breaker of the series webservice."""
+    paths = paths or get_portugal_compliance_paths()
+    return paths["endpoint_url"] or paths["wsdl_path"]
 
 
 # --- API Functions (to be called from ERPNext hooks or UI) ---
 
-@frappe.whitelist()
-def register_serie_at(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_serie, data_inicio_prev_utiliz, num_cert_sw_fatur, meio_processamento=None):
-    """Registers a new document series with AT."""
+def get_at_subuser_credentials():
+    """Returns (username, password) of the AT subuser used by the series webservice."""
     # Fetch username/password from ERPNext settings (Portugal Compliance Settings DocType)
-    # For now, using placeholders - THIS NEEDS TO BE SECURELY FETCHED
     at_username = frappe.db.get_single_value("Portugal Compliance Settings", "at_subuser_username")
     at_password = frappe.db.get_single_value("Portugal Compliance Settings", "at_subuser_password", True) # Get decrypted
 
     if not at_username or not at_password:
         frappe.throw("AT Subuser credentials not configured in Portugal Compliance Settings.")
+    return at_username, at_password
 
-    client_service = get_soap_client(at_username, at_password)
+# --- Request builders (shared by the single and the bulk calls, see saft/atcud_bulk_service.py) ---
+
+# AT document class of each document type code
+DOCUMENT_CLASSES = {"FT": "SI", "FS": "SI", "FR": "SI", "NC": "SI", "ND": "SI", "GT": "MG"}
 
+def build_register_request(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_serie, data_inicio_prev_utiliz, num_cert_sw_fatur, meio_processamento=None):
     request_data = {
         "serie": serie,
         "tipoSerie": tipo_serie,
@@ -166,22 +321,50 @@ def register_serie_at(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_seri
     }
     if meio_processamento:
         request_data["meioProcessamento"] = meio_processamento
+    return request_data
+
+def build_consult_request(serie_code, ano_inicio_serie=None):
+    return {
+        "serie": serie_code,
+        "anoInicioSerie": cint(ano_inicio_serie) or datetime.datetime.now().year
+    }
+
+def build_finalize_request(serie_code, ano_inicio_serie=None, motivo_anulacao="Encerramento normal"):
+    return {
+        "serie": serie_code,
+        "anoInicioSerie": cint(ano_inicio_serie) or datetime.datetime.now().year,
+        "motivoAnulacao": motivo_anulacao
+    }
+
+@frappe.whitelist()
+def register_serie_at(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_serie, data_inicio_prev_utiliz, num_cert_sw_fatur, meio_processamento=None, deadline=None):
+    """Registers a new document series with AT.
+    deadline: time budget for the call in seconds (see saft/circuit_breaker.py)."""
+    at_username, at_password = get_at_subuser_credentials()
+    client_service = get_soap_client(at_username, at_password)
+
+    request_data = build_register_request(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_serie,
+                                          data_inicio_prev_utiliz, num_cert_sw_fatur, meio_processamento)
 
     try:
-        response = client_service.registarSerie(**request_data)
-        if response and response.InfoSerie and response.InfoSerie.codValidacaoSerie:
+        response = guarded_call(get_series_endpoint(), client_service.registarSerie, deadline=deadline, **request_data)
+        result = parse_series_response(response)
+        if result["status"] == "success" and result["validation_code"]:
             # Successfully registered, ATCUD received
-            atcud = response.InfoSerie.codValidacaoSerie
             # Store ATCUD in ERPNext (e.g., against the DocType Series or a custom DocType)
             # frappe.db.set_value("Series", serie_docname, "atcud", atcud)
-            return {"status": "success", "atcud": atcud, "response": response}
-        elif response and response.listaErros:
-            errors = [{"code": err.codErro, "message": err.msgErro} for err in response.listaErros.Erro]
-            frappe.log_error(title="AT Series Registration Error", message=str(errors))
-            return {"status": "error", "errors": errors, "response": response}
+            return {"status": "success", "atcud": result["validation_code"], "response": serialize_object(response)}
+        elif result["status"] == "error":
+            frappe.log_error(title="AT Series Registration Error", message=str(result))
+            # "errors" keeps the original contract ({"code", "message"} per AT error); code/message summarize them
+            return {"status": "error", "errors": result["errors"], "code": result["code"], "message": result["message"],
+                    "response": serialize_object(response)}
         else:
             frappe.log_error(title="AT Series Registration Unexpected Response", message=str(response))
-            return {"status": "error", "message": "Unexpected response from AT.", "response": response}
+            return {"status": "error", "message": "Unexpected response from AT.", "response": serialize_object(response)}
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        # Fail fast: AT is unavailable or the caller's budget ran out
+        return {"status": e.status, "message": str(e)}
     except Fault as f:
         frappe.log_error(title="AT Series Registration SOAP Fault", message=str(f))
         return {"status": "error", "message": str(f)}
@@ -189,49 +372,96 @@ def register_serie_at(serie, tipo_serie, classe_doc, tipo_doc, num_prim_doc_seri
         frappe.log_error(title="AT Series Registration Exception", message=str(e))
         return {"status": "error", "message": str(e)}
 
-def consult_series_at(serie_code):
+def parse_series_response(response):
+    """Normalizes a SeriesWS response: {'status', 'validation_code', 'state', 'code', 'message', 'errors'}.
+    A response is an error if it carries listaErros, or a result code without infoSerie.
+    'errors' lists the listaErros entries as {'code', 'message'}."""
+    if response is None:
+        return {"status": "error", "validation_code": None, "state": None, "code": None, "message": "Empty response from AT.",
+                "errors": []}
+
+    result_info = _first_attr(response, "infoResultOper", "InfoResultOper")
+    serie_info = _first_attr(response, "infoSerie", "InfoSerie")
+    errors = _first_attr(response, "listaErros", "ListaErros")
+
+    validation_code = cstr(_first_attr(serie_info, "codValidacaoSerie")) or None
+    # A - active, N - annulled, F - finalized
+    state = cstr(_first_attr(serie_info, "estado")) or None
+    code = cstr(_first_attr(result_info, "codResultOper")) or None
+    message = cstr(_first_attr(result_info, "msgResultOper")) or None
+
+    error_list = [
+        {"code": cstr(_first_attr(err, "codErro")), "message": cstr(_first_attr(err, "msgErro"))}
+        for err in _first_attr(errors, "Erro", "erro") or []
+    ]
+    if error_list:
+        message = "; ".join(f"{err['code']}: {err['message']}" for err in error_list)
+        return {"status": "error", "validation_code": None, "state": None, "code": code, "message": message, "errors": error_list}
+    if result_info is not None and serie_info is None:
+        return {"status": "error", "validation_code": None, "state": None, "code": code, "message": message, "errors": []}
+    return {"status": "success", "validation_code": validation_code, "state": state, "code": code, "message": message,
+            "errors": []}
+
+def _first_attr(obj, *names):
+    if obj is None:
+        return None
+    for name in names:
+        try:
+            value = obj[name] if isinstance(obj, dict) else getattr(obj, name)
+        except (AttributeError, KeyError):
+            continue
+        if value is not None:
+            return value
+    return None
+
+def consult_series_at(serie_code, deadline=None):
     """
     Calls AT service to consult an existing series.
+    deadline: time budget for the call in seconds.
     """
     paths = get_portugal_compliance_paths()
     service = get_soap_client("TESTEWEBSERVICES", "TESTEwebservice")
 
-    request_data = {
-        "serie": serie_code,
-        "anoInicioSerie": datetime.datetime.now().year
-    }
+    request_data = build_consult_request(serie_code)
 
     try:
-        response = service.consultarSerie(request_data)
+        response = guarded_call(get_series_endpoint(paths), service.consultarSerie, deadline=deadline, **request_data)
         return {
             "status": "success",
             "data": response
         }
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        return {
+            "status": e.status,
+            "message": str(e)
+        }
     except Exception as e:
         return {
             "status": "error",
             "message": str(e)
         }
 
-def finalize_serie_at(serie_code):
+def finalize_serie_at(serie_code, deadline=None):
     """
     Sends request to close the document series with AT.
+    deadline: time budget for the call in seconds.
     """
     paths = get_portugal_compliance_paths()
     service = get_soap_client("TESTEWEBSERVICES", "TESTEwebservice")
 
-    request_data = {
-        "serie": serie_code,
-        "anoInicioSerie": datetime.datetime.now().year,
-        "motivoAnulacao": "Encerramento normal"
-    }
+    request_data = build_finalize_request(serie_code)
 
     try:
-        response = service.anularSerie(request_data)
+        response = guarded_call(get_series_endpoint(paths), service.anularSerie, deadline=deadline, **request_data)
         return {
             "status": "success",
             "data": response
         }
+    except (CircuitOpenError, DeadlineExceeded) as e:
+        return {
+            "status": e.status,
+            "message": str(e)
+        }
     except Exception as e:
         return {
             "status": "error",
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import contextvars
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import frappe
+import requests
+from frappe.utils import cint, flt
+from zeep import Transport
+from zeep.exceptions import Fault
+
+from .at_metrics import record_phase, trace_operation
+
+# Per-endpoint circuit breakers and per-call deadline budgets for the AT webservices.
+#
+# Breaker (one per site and endpoint, in each process):
+#     closed    - calls go through; consecutive failures are counted. A failure is a transport
+#                 error, a timeout, a server-side SOAP Fault or a call slower than slow_call_ms.
+#     open      - after failure_threshold consecutive failures: calls fail at once with
+#                 CircuitOpenError (status "circuit_open") for open_seconds.
+#     half_open - then up to half_open_max_calls probe calls go through; a success closes the
+#                 breaker, a failure opens it again.
+#
+# Deadline: callers pass a budget in seconds (deadline=...). The HTTP timeout of the call is the
+# time left in the budget (capped at DEFAULT_OPERATION_TIMEOUT); an expired budget raises
+# DeadlineExceeded (status "deadline_exceeded") without calling AT.
+#
+# Configuration (site_config.json):
+#     "pt_at_breaker_failure_threshold": 5
+#     "pt_at_breaker_open_seconds": 30
+#     "pt_at_breaker_half_open_max_calls": 1
+#     "pt_at_breaker_slow_call_ms": 10000
+
+DEFAULT_OPERATION_TIMEOUT = 30
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_OPEN_SECONDS = 30
+DEFAULT_HALF_OPEN_MAX_CALLS = 1
+DEFAULT_SLOW_CALL_MS = 10000
+MAX_TRANSITIONS = 50
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_deadline = contextvars.ContextVar("pt_at_call_deadline", default=None)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(Exception):
+    status = "circuit_open"
+
+    def __init__(self, endpoint, retry_after):
+        self.endpoint = endpoint
+        self.retry_after = retry_after
+        super(CircuitOpenError, self).__init__(
+            f"AT endpoint {endpoint} is unavailable (circuit open); retry in {retry_after:.0f}s."
+        )
+
+
+class DeadlineExceeded(Exception):
+    status = "deadline_exceeded"
+
+
+class CircuitBreaker(object):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self._lock = threading.Lock()
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.half_open_calls = 0
+        self.stats = {"calls": 0, "successes": 0, "failures": 0, "slow_calls": 0, "rejected": 0}
+        self.transitions = deque(maxlen=MAX_TRANSITIONS)
+
+    def before_call(self):
+        """Raises CircuitOpenError if the call must not go through."""
+        open_seconds = _conf_float("pt_at_breaker_open_seconds", DEFAULT_OPEN_SECONDS)
+        with self._lock:
+            if self.state == OPEN:
+                elapsed = time.monotonic() - self.opened_at
+                if elapsed < open_seconds:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.endpoint, open_seconds - elapsed)
+                self._transition(HALF_OPEN, "open period elapsed")
+            if self.state == HALF_OPEN:
+                if self.half_open_calls >= _conf_int("pt_at_breaker_half_open_max_calls", DEFAULT_HALF_OPEN_MAX_CALLS):
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(self.endpoint, 0)
+                self.half_open_calls += 1
+            self.stats["calls"] += 1
+
+    def record(self, success, elapsed):
+        slow = elapsed * 1000 > _conf_float("pt_at_breaker_slow_call_ms", DEFAULT_SLOW_CALL_MS)
+        with self._lock:
+            if slow:
+                self.stats["slow_calls"] += 1
+            if success and not slow:
+                self.stats["successes"] += 1
+                self.consecutive_failures = 0
+                if self.state == HALF_OPEN:
+                    self._transition(CLOSED, "probe succeeded")
+                return
+
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            reason = f"slow call ({elapsed:.1f}s)" if slow and success else "call failed"
+            if self.state == HALF_OPEN:
+                self._transition(OPEN, f"probe failed: {reason}")
+            elif self.state == CLOSED and self.consecutive_failures >= _conf_int(
+                    "pt_at_breaker_failure_threshold", DEFAULT_FAILURE_THRESHOLD):
+                self._transition(OPEN, f"{self.consecutive_failures} consecutive failures, last: {reason}")
+
+    def cancel(self):
+        """A call that says nothing about the endpoint's health (the caller's deadline ran out):
+        frees its half-open probe slot without changing the state."""
+        with self._lock:
+            if self.state == HALF_OPEN and self.half_open_calls:
+                self.half_open_calls -= 1
+
+    def reset(self):
+        with self._lock:
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._transition(CLOSED, "manual reset")
+
+    def _transition(self, state, reason):
+        # Called with the lock held
+        self.transitions.append({"at": frappe.utils.now(), "from": self.state, "to": state, "reason": reason})
+        self.state = state
+        self.half_open_calls = 0
+        if state == OPEN:
+            self.opened_at = time.monotonic()
+        frappe.logger("portugal_compliance").warning(f"AT circuit breaker {self.endpoint}: {state} ({reason})")
+
+    def as_dict(self):
+        with self._lock:
+            retry_after = None
+            if self.state == OPEN:
+                retry_after = max(_conf_float("pt_at_breaker_open_seconds", DEFAULT_OPEN_SECONDS)
+                                  - (time.monotonic() - self.opened_at), 0)
+            return {
+                "endpoint": self.endpoint,
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "retry_after": round(retry_after, 1) if retry_after is not None else None,
+                **self.stats,
+                "transitions": list(self.transitions),
+            }
+
+
+def get_circuit_breaker(endpoint):
+    key = (frappe.local.site, endpoint)
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(endpoint)
+        return breaker
+
+
+def is_endpoint_failure(error):
+    """Errors that say something about the endpoint's health (business faults and the caller's
+    own exhausted deadline do not)."""
+    if isinstance(error, DeadlineExceeded):
+        return False
+    if isinstance(error, Fault):
+        return "server" in str(error.code or "").lower()
+    return True
+
+
+def guarded_call(endpoint, function, *args, deadline=None, **kwargs):
+    """Calls function(*args, **kwargs) through the endpoint's breaker, within the deadline
+    budget (seconds). Raises CircuitOpenError or DeadlineExceeded without calling AT.
+    The call is recorded in the AT latency histograms (saft/at_metrics.py)."""
+    operation = getattr(function, "_op_name", None) or getattr(function, "__name__", "call")
+    breaker = get_circuit_breaker(endpoint)
+    with deadline_budget(deadline), trace_operation(operation):
+        try:
+            # An exhausted budget fails here, before AT is called or the breaker is touched
+            get_call_timeout()
+            breaker.before_call()
+        except (CircuitOpenError, DeadlineExceeded) as e:
+            record_phase("total", result=e.status)
+            raise
+        started = time.monotonic()
+        try:
+            result = function(*args, **kwargs)
+        except DeadlineExceeded as e:
+            breaker.cancel()
+            record_phase("total", time.monotonic() - started, result=e.status)
+            raise
+        except Exception as e:
+            elapsed = time.monotonic() - started
+            breaker.record(not is_endpoint_failure(e), elapsed)
+            record_phase("total", elapsed, result=call_result(e), fault_code=_fault_code(e))
+            raise
+    elapsed = time.monotonic() - started
+    breaker.record(True, elapsed)
+    record_phase("total", elapsed, operation=operation, result="success")
+    return result
+
+
+def call_result(error):
+    """Result label of a failed call for the latency histograms."""
+    if isinstance(error, Fault):
+        return "fault"
+    if isinstance(error, (CircuitOpenError, DeadlineExceeded)):
+        return error.status
+    if isinstance(error, (requests.exceptions.Timeout, TimeoutError)):
+        return "timeout"
+    return "error"
+
+
+def _fault_code(error):
+    return str(error.code or "") if isinstance(error, Fault) else None
+
+
+@contextmanager
+def deadline_budget(seconds=None):
+    """Sets the deadline of the AT calls made inside the block (nested budgets only shrink it)."""
+    if seconds is None:
+        yield
+        return
+    deadline = time.monotonic() + flt(seconds)
+    current = _deadline.get()
+    token = _deadline.set(min(deadline, current) if current else deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def get_call_timeout(default=DEFAULT_OPERATION_TIMEOUT):
+    """HTTP timeout for the next call: the time left in the deadline budget, capped at default."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return default
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise DeadlineExceeded("Deadline budget exhausted before calling AT.")
+    return min(remaining, default) if default else remaining
+
+
+class DeadlineTransport(Transport):
+    """zeep Transport whose operation timeout follows the caller's deadline budget.
+    The timeout is read per call (context variable), so a cached client can be shared."""
+
+    def __init__(self, *args, **kwargs):
+        super(DeadlineTransport, self).__init__(*args, **kwargs)
+        # The client may be shared with threads that are not bound to the site
+        self.site = getattr(frappe.local, "site", None)
+
+    def post(self, address, message, headers):
+        timeout = get_call_timeout(self.operation_timeout or DEFAULT_OPERATION_TIMEOUT)
+        started = time.monotonic()
+        try:
+            response = self.session.post(address, data=message, headers=headers, timeout=timeout)
+        except requests.exceptions.Timeout as e:
+            record_phase("request", time.monotonic() - started, result="timeout", bytes_sent=len(message), site=self.site)
+            deadline = _deadline.get()
+            if deadline is not None and deadline <= time.monotonic():
+                raise DeadlineExceeded(f"Deadline budget exhausted while calling {address}.") from e
+            raise
+        except Exception as e:
+            record_phase("request", time.monotonic() - started, result=e.__class__.__name__, bytes_sent=len(message),
+                         site=self.site)
+            raise
+        record_phase("request", time.monotonic() - started, result=f"http_{response.status_code}",
+                     bytes_sent=len(message), bytes_received=len(response.content), site=self.site)
+        return response
+
+
+def _conf_int(key, default):
+    return cint(frappe.conf.get(key)) or default
+
+
+def _conf_float(key, default):
+    return flt(frappe.conf.get(key)) or default
+
+
+@frappe.whitelist()
+def get_circuit_breaker_status():
+    """State, counters and recent transitions of the AT circuit breakers in this process."""
+    frappe.only_for("System Manager")
+    with _breakers_lock:
+        breakers = [breaker for (site, _), breaker in _breakers.items() if site == frappe.local.site]
+    return {"breakers": [breaker.as_dict() for breaker in breakers]}
+
+
+@frappe.whitelist()
+def reset_circuit_breaker(endpoint):
+    frappe.only_for("System Manager")
+    get_circuit_breaker(endpoint).reset()
+    return get_circuit_breaker(endpoint).as_dict()
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import hashlib
+import os
+import ssl
+import tempfile
+import threading
+import time
+
+import frappe
+import requests
+from frappe.utils import cint, cstr
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from .at_metrics import record_phase
+
+# Pooled keep-alive HTTP sessions for the AT webservices.
+# A requests.Session is kept per process for each (site, client certificate, proxies), so SOAP
+# calls reuse open TCP/TLS connections instead of doing a full client-certificate handshake
+# every time. The client certificate is loaded once into an SSLContext (password-protected PEM
+# or PKCS#12). The number of connections per host is bounded: extra threads wait for a free one.
+#
+# Configuration (site_config.json):
+#     "pt_at_http_pool_maxsize": 4   - connections kept open per AT host
+#     "pt_at_http_pool_block": 1     - wait for a free connection instead of opening more
+
+DEFAULT_POOL_MAXSIZE = 4
+DEFAULT_POOL_CONNECTIONS = 4
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+class PoolMetrics(object):
+    """Counters shared by every connection pool of one session."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.errors = 0
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        with self._lock:
+            requests_sent, new_connections, errors = self.requests, self.new_connections, self.errors
+        return {
+            "requests": requests_sent,
+            "new_connections": new_connections,
+            "reused_connections": max(requests_sent - new_connections, 0),
+            "reuse_ratio": round(1 - new_connections / requests_sent, 3) if requests_sent else 0.0,
+            "errors": errors,
+        }
+
+
+def _counting_pool_class(base, metrics, site=None):
+    # urllib3 creates the pools itself, so the metrics are bound to a per-session subclass
+    def _new_conn(self):
+        metrics.increment("new_connections")
+        return base._new_conn(self)
+
+    attributes = {"_new_conn": _new_conn}
+    if issubclass(base, HTTPSConnectionPool):
+        def _validate_conn(self, conn):
+            # New connections are opened here (TCP connect + TLS handshake); see saft/at_metrics.py
+            # conn.is_closed only exists in urllib3 2.x; sock is None until connected in 1.26 and 2.x
+            if getattr(conn, "sock", None) is not None:
+                return base._validate_conn(self, conn)
+            started = time.monotonic()
+            try:
+                base._validate_conn(self, conn)
+            except Exception as e:
+                record_phase("tls", time.monotonic() - started, result=e.__class__.__name__, site=site)
+                raise
+            record_phase("tls", time.monotonic() - started, result="connected", site=site)
+
+        attributes["_validate_conn"] = _validate_conn
+    return type("Counting" + base.__name__, (base,), attributes)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter with a fixed SSLContext (client certificate) and connection counters."""
+
+    def __init__(self, ssl_context=None, metrics=None, site=None, **kwargs):
+        self.ssl_context = ssl_context
+        self.metrics = metrics or PoolMetrics()
+        # Site of the session, for the latency histograms of threads not bound to a site
+        self.site = site
+        super(PooledHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        if self.ssl_context is not None:
+            pool_kwargs["ssl_context"] = self.ssl_context
+        super(PooledHTTPAdapter, self).init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _counting_pool_class(HTTPConnectionPool, self.metrics, self.site),
+            "https": _counting_pool_class(HTTPSConnectionPool, self.metrics, self.site),
+        }
+
+    def send(self, request, **kwargs):
+        self.metrics.increment("requests")
+        try:
+            return super(PooledHTTPAdapter, self).send(request, **kwargs)
+        except Exception:
+            self.metrics.increment("errors")
+            raise
+
+
+def build_client_ssl_context(cert_path, cert_password=None):
+    """SSLContext trusting the same CAs as requests, with the client certificate loaded.
+    Accepts a PEM file (certificate + key, optionally encrypted) or a PKCS#12 file (.pfx/.p12)."""
+    context = ssl.create_default_context(cafile=requests.certs.where())
+    if not cert_path:
+        return context
+
+    password = cstr(cert_password) or None
+    if os.path.splitext(cert_path)[1].lower() in (".pfx", ".p12"):
+        _load_pkcs12_cert_chain(context, cert_path, password)
+    else:
+        context.load_cert_chain(cert_path, password=password)
+    return context
+
+
+def _load_pkcs12_cert_chain(context, cert_path, password):
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.serialization.pkcs12 import load_key_and_certificates
+
+    with open(cert_path, "rb") as cert_file:
+        key, certificate, additional_certificates = load_key_and_certificates(
+            cert_file.read(), password.encode("utf-8") if password else None
+        )
+
+    # SSLContext only loads from files: the key is written re-encrypted to a private temporary
+    # file that is removed as soon as it has been loaded.
+    transient_password = os.urandom(24).hex()
+    pem = key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.BestAvailableEncryption(transient_password.encode("utf-8"))
+    )
+    for cert in [certificate] + list(additional_certificates or []):
+        pem += cert.public_bytes(serialization.Encoding.PEM)
+
+    handle, pem_path = tempfile.mkstemp(suffix=".pem")
+    try:
+        with os.fdopen(handle, "wb") as pem_file:
+            pem_file.write(pem)
+        context.load_cert_chain(pem_path, password=transient_password)
+    finally:
+        os.remove(pem_path)
+
+
+def get_pooled_session(client_cert=None, proxies=None):
+    """Returns the process-wide keep-alive session for this client certificate and proxies.
+    client_cert is (cert_path, cert_password) or None."""
+    cert_path, cert_password = client_cert if client_cert else (None, None)
+    key = (
+        frappe.local.site,
+        cert_path,
+        _file_mtime(cert_path),
+        hashlib.sha256(cstr(cert_password).encode("utf-8")).hexdigest(),
+        tuple(sorted((proxies or {}).items())),
+    )
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+
+        pool_maxsize = cint(frappe.conf.get("pt_at_http_pool_maxsize")) or DEFAULT_POOL_MAXSIZE
+        pool_block = bool(cint(frappe.conf.get("pt_at_http_pool_block", 1)))
+        adapter = PooledHTTPAdapter(
+            ssl_context=build_client_ssl_context(cert_path, cert_password),
+            site=key[0],
+            pool_connections=DEFAULT_POOL_CONNECTIONS,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if proxies:
+            session.proxies.update(proxies)
+
+        # A rotated certificate gets a new session; the old one is closed
+        for old_key in [k for k in _sessions if k[0] == key[0] and k[1] == key[1] and k[4] == key[4]]:
+            _sessions.pop(old_key).close()
+        _sessions[key] = session
+        return session
+
+
+def close_pooled_sessions():
+    """Closes every pooled session of this process (e.g. after the settings change)."""
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+        _sessions.clear()
+    for session in sessions:
+        session.close()
+
+
+def _file_mtime(path):
+    try:
+        return os.path.getmtime(path) if path else None
+    except OSError:
+        return None
+
+
+@frappe.whitelist()
+def get_at_http_session_stats():
+    """Connection reuse per pooled AT session in this process."""
+    frappe.only_for("System Manager")
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+
+    stats = []
+    for (site, cert_path, _, _, proxies), session in sessions:
+        adapter = session.get_adapter("https://")
+        stats.append(dict(
+            site=site,
+            client_cert=cert_path,
+            proxies=bool(proxies),
+            pool_maxsize=adapter._pool_maxsize,
+            pool_block=adapter._pool_block,
+            **adapter.metrics.as_dict()
+        ))
+    return {"pid": os.getpid(), "sessions": stats}
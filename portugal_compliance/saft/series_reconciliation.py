@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+import time
+
+import frappe
+from frappe.utils import add_to_date, cint, cstr, now_datetime
+
+from .atcud_bulk_service import run_bulk_series_operation
+from .atcud_service import build_consult_request
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+
+# Scheduled reconciliation of Serie de Documento Fiscal with the series state held by AT.
+#
+# Every run pages through the active series (keyset pagination by name) and consults them at AT
+# with the bulk client (consultarSerie, bounded concurrency, same circuit breaker as every other
+# AT call). Each answer is compared with the local record:
+#
+#     AT validation code differs from codigo_validacao_serie_at  -> local code replaced
+#     series annulled / finalized at AT (estado N / F)            -> series deactivated (ativo = 0)
+#     series unknown to AT (business error)                       -> alert only
+#
+# Fixes are written with one bulk update per page; the alerts of the whole run go to a single
+# Compliance Audit Log entry (and the error log). Runs are incremental: a series is skipped if it
+# was checked less than pt_at_reconcile_interval_hours ago and has not been modified since.
+# Series AT did not answer for (transport errors, open breaker, exhausted budget) are not marked
+# as checked and are retried on the next run.
+#
+# Configuration (site_config.json):
+#     "pt_at_reconcile_interval_hours": 24
+#     "pt_at_reconcile_page_size": 200
+
+SERIE_DOCTYPE = "Serie de Documento Fiscal"
+
+DEFAULT_INTERVAL_HOURS = 24
+DEFAULT_PAGE_SIZE = 200
+# Wall-clock budget of a run (the job runs in the long queue)
+RUN_TIME_BUDGET = 1200
+
+INACTIVE_STATES = ("N", "F")
+
+
+def reconcile_series_with_at(force=False):
+    """Scheduled job (hourly_long). With force, series checked recently are consulted too."""
+    started = time.monotonic()
+    checked_at = now_datetime()
+    recheck_before = add_to_date(checked_at, hours=-(cint(frappe.conf.get("pt_at_reconcile_interval_hours")) or DEFAULT_INTERVAL_HOURS))
+    page_size = cint(frappe.conf.get("pt_at_reconcile_page_size")) or DEFAULT_PAGE_SIZE
+
+    summary = {"checked": 0, "unchanged": 0, "fixed": 0, "alerts": 0, "unreachable": 0, "pages": 0}
+    alerts = []
+    last_name = ""
+    while True:
+        remaining = RUN_TIME_BUDGET - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+        rows = _get_series_page(last_name, page_size, None if cint(force) else recheck_before)
+        if not rows:
+            break
+        last_name = rows[-1].name
+        summary["pages"] += 1
+
+        requests = {row.name: build_consult_request(row.prefixo_serie, row.ano_fiscal) for row in rows}
+        results = run_bulk_series_operation("consult", requests, deadline=remaining)
+        _apply_page(rows, results, checked_at, summary, alerts)
+        frappe.db.commit()
+
+        if any(result["status"] == "circuit_open" for result in results.values()):
+            # AT is unavailable: the remaining series wait for the next run
+            break
+
+    summary["alerts"] = len(alerts)
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    if alerts:
+        details = "\n".join(alerts)
+        create_compliance_log(
+            "Series Reconciliation",
+            SERIE_DOCTYPE,
+            None,
+            details=f"Reconciliação das séries com a AT: {frappe.as_json(summary, indent=None)}\n{details}"
+        )
+        frappe.log_error(details, f"AT series reconciliation: {len(alerts)} alerts")
+        frappe.db.commit()
+    frappe.logger("portugal_compliance").info(f"AT series reconciliation: {summary}")
+    return summary
+
+
+def _get_series_page(after_name, page_size, recheck_before):
+    conditions = ""
+    if recheck_before:
+        conditions = """AND (ultima_verificacao_at IS NULL
+                             OR ultima_verificacao_at < %(recheck_before)s
+                             OR modified > ultima_verificacao_at)"""
+    return frappe.db.sql(f"""
+        SELECT name, prefixo_serie, ano_fiscal, codigo_validacao_serie_at
+        FROM `tab{SERIE_DOCTYPE}`
+        WHERE ativo = 1 AND name > %(after_name)s {conditions}
+        ORDER BY name
+        LIMIT %(limit)s""", {"after_name": after_name, "recheck_before": recheck_before, "limit": page_size}, as_dict=True)
+
+
+def _apply_page(rows, results, checked_at, summary, alerts):
+    """Compares the AT answers with the local series and writes checks and fixes in bulk."""
+    checked, fixed = {}, {}
+    for row in rows:
+        result = results.get(row.name) or {}
+        if not result.get("answered"):
+            summary["unreachable"] += 1
+            continue
+
+        update = {"ultima_verificacao_at": checked_at, "estado_serie_at": cstr(result.get("state"))}
+        notes = []
+        if result["status"] != "success":
+            notes.append(f"Série desconhecida ou recusada pela AT: {result.get('message')} ({result.get('code')})")
+            alerts.append(f"{row.name}: {notes[-1]}")
+        else:
+            validation_code = result.get("validation_code")
+            if validation_code and validation_code != row.codigo_validacao_serie_at:
+                update["codigo_validacao_serie_at"] = validation_code
+                notes.append(f"Código de validação corrigido: {row.codigo_validacao_serie_at or '-'} -> {validation_code}")
+                if row.codigo_validacao_serie_at:
+                    # Documents already issued carry an ATCUD with the old code
+                    alerts.append(f"{row.name}: {notes[-1]}")
+            if result.get("state") in INACTIVE_STATES:
+                update["ativo"] = 0
+                notes.append(f"Série inativa na AT (estado {result['state']}): desativada")
+                alerts.append(f"{row.name}: {notes[-1]}")
+
+        update["resultado_verificacao_at"] = "\n".join(notes) or "Em conformidade com a AT."
+        summary["checked"] += 1
+        if "codigo_validacao_serie_at" in update or "ativo" in update:
+            fixed[row.name] = update
+        else:
+            checked[row.name] = update
+            if not notes:
+                summary["unchanged"] += 1
+    summary["fixed"] += len(fixed)
+
+    if fixed:
+        # modified = checked_at, so the fixed series are not considered changed on the next run
+        frappe.db.bulk_update(SERIE_DOCTYPE, fixed, modified=checked_at)
+    if checked:
+        frappe.db.bulk_update(SERIE_DOCTYPE, checked, update_modified=False)
+
+
+@frappe.whitelist()
+def reconcile_series_now(force=False):
+    """Queues a reconciliation run (e.g. after fixing series by hand)."""
+    frappe.only_for("System Manager")
+    frappe.enqueue(
+        "portugal_compliance.saft.series_reconciliation.reconcile_series_with_at",
+        queue="long",
+        force=cint(force),
+        deduplicate=True,
+        job_id=f"pt_at_series_reconciliation::{frappe.local.site}"
+    )
+    return {"status": "queued"}
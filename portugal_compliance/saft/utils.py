@@ -4,6 +4,8 @@ import frappe
 from frappe import _
 import re
 
+from .atcud_cache import get_cached_fiscal_year, get_cached_validation_code
+
 
 def format_date(date_obj):
     """Formats date as YYYY-MM-DD."""
@@ -153,23 +155,15 @@ def get_atcud(doc_series_code, doc_type_at_code, doc_posting_date, doc_sequentia
         frappe.log_error("Missing data for ATCUD generation", f"Series: {doc_series_code}, Type: {doc_type_at_code}, Date: {doc_posting_date}, Number: {doc_sequential_number}")
         return None # Or raise error
 
-    # Determine the fiscal year based on the document's posting date
-    fiscal_year = frappe.db.get_value("Fiscal Year", {
-        "year_start_date": ("<=", doc_posting_date),
-        "year_end_date": (">=", doc_posting_date)
-    }, "name")
+    # Determine the fiscal year based on the document's posting date (cached interval index)
+    fiscal_year = get_cached_fiscal_year(doc_posting_date)
 
     if not fiscal_year:
         frappe.log_error("Could not determine Fiscal Year for ATCUD", f"Date: {doc_posting_date}")
         return None # Or raise error
 
-    # Get the validation code from the communicated series
-    validation_code = frappe.db.get_value("Document Series PT", {
-        "series_code": doc_series_code,
-        "document_type": doc_type_at_code,
-        "fiscal_year": fiscal_year,
-        "communication_status": "Communicated"
-    }, "at_validation_code")
+    # Get the validation code from the communicated series (cached per series, type and fiscal year)
+    validation_code = get_cached_validation_code(doc_series_code, doc_type_at_code, fiscal_year)
 
     if not validation_code:
         # Log the error, but might still proceed without ATCUD depending on requirements
@@ -182,6 +176,39 @@ def get_atcud(doc_series_code, doc_type_at_code, doc_posting_date, doc_sequentia
     atcud = f"{validation_code}-{doc_sequential_number}"
     return atcud
 
+# Compiled per-prefix patterns, built once per naming_series / prefixo_serie
+_NUMERIC_TAIL_PATTERN = re.compile(r"(\d+)$")
+_PREFIX_PATTERN_CACHE_SIZE = 1024
+_prefix_patterns = {}
+
+
+def _get_prefix_pattern(series_prefix):
+    pattern = _prefix_patterns.get(series_prefix)
+    if pattern is None:
+        if len(_prefix_patterns) >= _PREFIX_PATTERN_CACHE_SIZE:
+            _prefix_patterns.clear()
+        pattern = _prefix_patterns[series_prefix] = re.compile(f"^{re.escape(series_prefix)}(\\d+)$")
+    return pattern
+
+
+def _parse_sequential_number(doc_name, series_prefix):
+    # Fast path for the common "PREFIX/00001" format: a prefix check and a digit check, no regex
+    if doc_name.startswith(series_prefix):
+        tail = doc_name[len(series_prefix):]
+        if tail.isdigit() and tail.isascii():
+            return tail
+
+    match = _get_prefix_pattern(series_prefix).match(doc_name)
+    if match:
+        return match.group(1)  # return as string (with leading zeros)
+
+    # Fallback: try to extract numeric tail after last dash or slash
+    number_match = _NUMERIC_TAIL_PATTERN.search(doc_name)
+    if number_match:
+        return number_match.group(1)
+    return None
+
+
 def get_sequential_number_from_name(doc_name, series_prefix):
     """
     Extracts the sequential number from a document name using its naming series prefix.
@@ -191,27 +218,42 @@ def get_sequential_number_from_name(doc_name, series_prefix):
         return None
 
     try:
-        # Escape series prefix for regex pattern
-        escaped_prefix = re.escape(series_prefix)
-        pattern_string = f"^{escaped_prefix}(\\d+)$"
-        match = re.match(pattern_string, doc_name)
-
-        if match:
-            return match.group(1)  # return as string (with leading zeros)
-
-        # Fallback: try to extract numeric tail after last dash or slash
-        number_match = re.search(r"(\d+)$", doc_name)
-        if number_match:
-            return number_match.group(1)
-
-        frappe.log_error("Could not extract sequential number", f"Name: {doc_name}, Prefix: {series_prefix}")
-        return None
+        number = _parse_sequential_number(doc_name, series_prefix)
+        if number is None:
+            frappe.log_error("Could not extract sequential number", f"Name: {doc_name}, Prefix: {series_prefix}")
+        return number
 
     except Exception as e:
         frappe.log_error(f"Error extracting sequential number: {e}", f"Name: {doc_name}, Prefix: {series_prefix}")
         return None
 
 
+def get_sequential_numbers_from_names(doc_names, series_prefix):
+    """
+    Batch variant for backfills and audits: returns the sequential numbers (strings, or None)
+    in the same order as doc_names. Failures are logged once for the whole batch.
+    """
+    if not series_prefix:
+        return [None] * len(doc_names)
+
+    prefix_length = len(series_prefix)
+    # Names in the common format are handled in one pass of string slicing
+    tails = [name[prefix_length:] if name and name.startswith(series_prefix) else None for name in doc_names]
+    numbers = [
+        tail if tail is not None and tail.isdigit() and tail.isascii()
+        else (_parse_sequential_number(name, series_prefix) if name else None)
+        for name, tail in zip(doc_names, tails)
+    ]
+
+    failed = [name for name, number in zip(doc_names, numbers) if number is None]
+    if failed:
+        frappe.log_error(
+            "\n".join(str(name) for name in failed[:100]),
+            f"Could not extract sequential number for {len(failed)} names (Prefix: {series_prefix})"
+        )
+    return numbers
+
+
 def validate_taxonomy_codes(accounts=None):
     """
     Checks if all accounts have a custom taxonomy code mapped.
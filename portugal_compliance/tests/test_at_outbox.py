@@ -0,0 +1,120 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import cint, get_datetime, now_datetime
+
+from portugal_compliance.saft.circuit_breaker import CircuitOpenError
+from portugal_compliance.utils import at_outbox
+from portugal_compliance.utils.at_outbox import OUTBOX_DOCTYPE, enqueue_at_operation, process_outbox_entry
+
+OUTBOX = "portugal_compliance.utils.at_outbox"
+TEST_OPERATION = "test_operation"
+TESTS = "portugal_compliance.tests.test_at_outbox"
+
+# Comportamento do processador de teste: None (sucesso) ou exceção a levantar
+handler_error = None
+failed_entries = []
+
+
+def process_test_operation(entry, payload):
+    if handler_error:
+        raise handler_error
+    return {"echo": payload.get("valor")}
+
+def mark_test_operation_failed(entry, error):
+    failed_entries.append((entry.name, error))
+
+
+class TestATOutbox(FrappeTestCase):
+    def setUp(self):
+        global handler_error
+        handler_error = None
+        failed_entries.clear()
+        # Sem jobs nem commits: cada teste é revertido no fim
+        patches = [
+            patch.dict(at_outbox.OUTBOX_HANDLERS, {TEST_OPERATION: {
+                "process": f"{TESTS}.process_test_operation",
+                "on_failure": f"{TESTS}.mark_test_operation_failed",
+            }}),
+            patch(f"{OUTBOX}._schedule_drain"),
+            patch(f"{OUTBOX}.create_compliance_log"),
+            patch.object(frappe.db, "commit"),
+            patch.object(frappe.db, "rollback"),
+        ]
+        for p in patches:
+            p.start()
+            self.addCleanup(p.stop)
+
+    def enqueue(self, valor=1, max_attempts=3):
+        name = enqueue_at_operation(TEST_OPERATION, {"valor": valor}, endpoint="https://at.teste/series")
+        frappe.db.set_value(OUTBOX_DOCTYPE, name, "max_tentativas", max_attempts)
+        return name
+
+    def process(self, name):
+        frappe.db.set_value(OUTBOX_DOCTYPE, name, "estado", "Em Processamento")
+        process_outbox_entry(name)
+        return frappe.get_doc(OUTBOX_DOCTYPE, name)
+
+    def test_same_operation_is_queued_once(self):
+        self.assertEqual(self.enqueue(1), self.enqueue(1))
+        self.assertNotEqual(self.enqueue(1), self.enqueue(2))
+
+    def test_completed_entry_is_not_queued_again(self):
+        name = self.enqueue()
+        self.assertEqual(self.process(name).estado, "Concluída")
+        self.assertEqual(self.enqueue(), name)
+        self.assertEqual(frappe.db.get_value(OUTBOX_DOCTYPE, name, "estado"), "Concluída")
+
+    def test_failed_entry_is_requeued_with_the_same_key(self):
+        name = self.enqueue()
+        frappe.db.set_value(OUTBOX_DOCTYPE, name, {"estado": "Falhada", "tentativas": 3})
+        self.assertEqual(self.enqueue(), name)
+        entry = frappe.db.get_value(OUTBOX_DOCTYPE, name, ["estado", "tentativas"], as_dict=True)
+        self.assertEqual(entry.estado, "Pendente")
+        self.assertEqual(cint(entry.tentativas), 0)
+
+    def test_unknown_operation_is_refused(self):
+        self.assertRaises(frappe.ValidationError, enqueue_at_operation, "operacao_inexistente", {})
+
+    def test_success_stores_the_result(self):
+        entry = self.process(self.enqueue(7))
+        self.assertEqual(entry.estado, "Concluída")
+        self.assertEqual(cint(entry.tentativas), 1)
+        self.assertEqual(frappe.parse_json(entry.resultado), {"echo": 7})
+
+    def test_failures_back_off_exponentially(self):
+        global handler_error
+        handler_error = Exception("AT indisponível")
+        name = self.enqueue(max_attempts=5)
+        for attempt, delay in ((1, at_outbox.BACKOFF_BASE_SECONDS), (2, 2 * at_outbox.BACKOFF_BASE_SECONDS)):
+            started = now_datetime()
+            entry = self.process(name)
+            self.assertEqual(entry.estado, "Pendente")
+            self.assertEqual(cint(entry.tentativas), attempt)
+            self.assertEqual(entry.ultimo_erro, "AT indisponível")
+            wait = (get_datetime(entry.proxima_tentativa) - started).total_seconds()
+            self.assertAlmostEqual(wait, delay, delta=5)
+
+    def test_entry_fails_after_max_attempts(self):
+        global handler_error
+        handler_error = Exception("Pedido rejeitado")
+        name = self.enqueue(max_attempts=2)
+        self.process(name)
+        entry = self.process(name)
+        self.assertEqual(entry.estado, "Falhada")
+        self.assertEqual(cint(entry.tentativas), 2)
+        self.assertEqual(failed_entries, [(name, "Pedido rejeitado")])
+
+    def test_open_circuit_postpones_without_spending_an_attempt(self):
+        global handler_error
+        handler_error = CircuitOpenError("https://at.teste/series", 120)
+        started = now_datetime()
+        entry = self.process(self.enqueue())
+        self.assertEqual(entry.estado, "Pendente")
+        self.assertEqual(cint(entry.tentativas), 0)
+        wait = (get_datetime(entry.proxima_tentativa) - started).total_seconds()
+        self.assertAlmostEqual(wait, 120, delta=5)
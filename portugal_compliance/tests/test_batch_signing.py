@@ -0,0 +1,58 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from portugal_compliance.utils.fiscal_signature import sign_documents_batch
+from portugal_compliance.utils.signing_engine import check_chain_continuity
+
+FISCAL_SIGNATURE = "portugal_compliance.utils.fiscal_signature"
+
+
+def make_head(number, prefix="FT2025"):
+    return frappe._dict({
+        "name": prefix,
+        "prefixo_serie": prefix,
+        "ultimo_documento_assinado": f"{prefix}/{number:05d}",
+        "ultimo_hash_assinado": f"HASH{number}",
+        "ultimo_numero_assinado": number,
+    })
+
+def make_documents(*numbers, prefix="FT2025"):
+    return [frappe._dict({"name": f"{prefix}/{number:05d}"}) for number in numbers]
+
+
+class TestChainContinuity(FrappeTestCase):
+    def test_consecutive_batch_after_head(self):
+        check_chain_continuity(make_documents(4, 5, 6), make_head(3))
+
+    def test_first_document_must_follow_head(self):
+        self.assertRaises(frappe.ValidationError, check_chain_continuity, make_documents(5, 6), make_head(3))
+
+    def test_document_behind_head_rejected(self):
+        self.assertRaises(frappe.ValidationError, check_chain_continuity, make_documents(3), make_head(3))
+
+    def test_gap_inside_batch_rejected(self):
+        self.assertRaises(frappe.ValidationError, check_chain_continuity, make_documents(4, 6), make_head(3))
+
+    def test_skipped_range_before_first_document(self):
+        check_chain_continuity(make_documents(7, 8), make_head(3), skipped_range=range(4, 7))
+
+    def test_skipped_range_must_cover_the_whole_gap(self):
+        self.assertRaises(frappe.ValidationError, check_chain_continuity, make_documents(7), make_head(3),
+                          skipped_range=range(5, 7))
+
+
+class TestSignDocumentsBatch(FrappeTestCase):
+    def test_empty_batch(self):
+        self.assertEqual(sign_documents_batch([]), {"signed": 0})
+
+    def test_submit_permission_checked_before_loading(self):
+        with patch("frappe.has_permission", side_effect=frappe.PermissionError) as has_permission, \
+                patch(f"{FISCAL_SIGNATURE}.get_documents_for_signing") as get_documents:
+            self.assertRaises(frappe.PermissionError, sign_documents_batch, '["FT2025/00004"]')
+        has_permission.assert_called_once_with("Sales Invoice", "submit", doc="FT2025/00004", throw=True)
+        get_documents.assert_not_called()
@@ -0,0 +1,140 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+from unittest.mock import Mock, patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from zeep.exceptions import Fault
+
+from portugal_compliance.saft import circuit_breaker
+from portugal_compliance.saft.circuit_breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExceeded,
+    guarded_call,
+)
+
+BREAKER_MODULE = "portugal_compliance.saft.circuit_breaker"
+BREAKER_CONF = {
+    "pt_at_breaker_failure_threshold": 3,
+    "pt_at_breaker_open_seconds": 30,
+    "pt_at_breaker_half_open_max_calls": 1,
+    "pt_at_breaker_slow_call_ms": 1000,
+}
+
+
+class TestCircuitBreaker(FrappeTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        # Relógio controlado pelo teste (só no módulo do breaker)
+        clock = Mock(monotonic=lambda: self.now)
+        for p in (patch.dict(frappe.conf, BREAKER_CONF), patch(f"{BREAKER_MODULE}.time", clock)):
+            p.start()
+            self.addCleanup(p.stop)
+        self.breaker = CircuitBreaker("https://at.teste/series")
+
+    def fail(self, times=1):
+        for _ in range(times):
+            self.breaker.before_call()
+            self.breaker.record(False, 0.1)
+
+    def open_breaker(self):
+        self.fail(BREAKER_CONF["pt_at_breaker_failure_threshold"])
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.fail()
+        self.assertEqual(self.breaker.state, OPEN)
+
+    def test_success_resets_the_failure_count(self):
+        self.fail(2)
+        self.breaker.before_call()
+        self.breaker.record(True, 0.1)
+        self.fail(2)
+        self.assertEqual(self.breaker.state, CLOSED)
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(3):
+            self.breaker.before_call()
+            self.breaker.record(True, 2.0)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertEqual(self.breaker.stats["slow_calls"], 3)
+
+    def test_open_breaker_rejects_calls_until_the_open_period_ends(self):
+        self.open_breaker()
+        self.now += 10
+        with self.assertRaises(CircuitOpenError) as raised:
+            self.breaker.before_call()
+        self.assertAlmostEqual(raised.exception.retry_after, 20)
+        self.assertEqual(self.breaker.stats["rejected"], 1)
+
+        self.now += 20
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+    def test_half_open_allows_one_probe(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.before_call()
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+    def test_successful_probe_closes(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.record(True, 0.1)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertEqual([t["to"] for t in self.breaker.transitions], [OPEN, HALF_OPEN, CLOSED])
+
+    def test_failed_probe_opens_again(self):
+        self.open_breaker()
+        self.now += 30
+        self.fail()
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertRaises(CircuitOpenError, self.breaker.before_call)
+
+    def test_cancelled_probe_frees_its_slot(self):
+        self.open_breaker()
+        self.now += 30
+        self.breaker.before_call()
+        self.breaker.cancel()
+        self.breaker.before_call()
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+
+    def test_reset_closes(self):
+        self.open_breaker()
+        self.breaker.reset()
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.breaker.before_call()
+
+
+class TestGuardedCall(FrappeTestCase):
+    def setUp(self):
+        self.endpoint = f"https://at.teste/{frappe.generate_hash(length=8)}"
+        p = patch.dict(frappe.conf, BREAKER_CONF)
+        p.start()
+        self.addCleanup(p.stop)
+
+    def test_endpoint_failures_open_the_breaker(self):
+        call = Mock(side_effect=ConnectionError("recusada"), __name__="registarSerie")
+        for _ in range(3):
+            self.assertRaises(ConnectionError, guarded_call, self.endpoint, call)
+        self.assertRaises(CircuitOpenError, guarded_call, self.endpoint, call)
+        self.assertEqual(call.call_count, 3)
+
+    def test_business_faults_do_not_open_the_breaker(self):
+        call = Mock(side_effect=Fault("Série já existe", code="soap:Client"), __name__="registarSerie")
+        for _ in range(4):
+            self.assertRaises(Fault, guarded_call, self.endpoint, call)
+        self.assertEqual(circuit_breaker.get_circuit_breaker(self.endpoint).state, CLOSED)
+
+    def test_exhausted_deadline_does_not_call_at(self):
+        call = Mock(__name__="registarSerie")
+        self.assertRaises(DeadlineExceeded, guarded_call, self.endpoint, call, deadline=0)
+        call.assert_not_called()
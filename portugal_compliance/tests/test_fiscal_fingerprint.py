@@ -0,0 +1,50 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import now_datetime
+
+from portugal_compliance.utils.fiscal_fingerprint import FINGERPRINT_FIELD, get_document_fingerprint
+from portugal_compliance.utils.fiscal_validations import prevent_modification_after_submit
+
+HOOK = "portugal_compliance.utils.fiscal_validations.prevent_modification_after_submit"
+
+
+class TestFiscalFingerprint(FrappeTestCase):
+    def make_submitted_invoice(self):
+        """Fatura submetida em memória, com a impressão digital "gravada" na cache de doc.flags
+        usada por get_stored_fiscal_values (sem tocar na BD)."""
+        doc = frappe.get_doc({
+            "doctype": "Sales Invoice",
+            "name": "FT-TESTE-00001",
+            "posting_date": "2025-01-15",
+            "customer": "Cliente Teste",
+            "currency": "EUR",
+            "net_total": 100,
+            "total_taxes_and_charges": 23,
+            "grand_total": 123,
+            "items": [{"name": "item-teste-1", "item_code": "ART-1", "qty": 2, "rate": 50, "amount": 100,
+                       "net_rate": 50, "net_amount": 100}]
+        })
+        doc.docstatus = 1
+        doc.modified = now_datetime()
+        doc.flags.pt_stored_fiscal_values = (doc.modified, frappe._dict({FINGERPRINT_FIELD: get_document_fingerprint(doc)}))
+        return doc
+
+    def test_hook_registered_on_update_after_submit(self):
+        hooks = frappe.get_hooks("doc_events").get("Sales Invoice", {})
+        self.assertIn(HOOK, hooks.get("before_update_after_submit", []))
+
+    def test_unchanged_document_passes(self):
+        prevent_modification_after_submit(self.make_submitted_invoice(), "before_update_after_submit")
+
+    def test_changed_header_field_rejected_after_submit(self):
+        doc = self.make_submitted_invoice()
+        doc.grand_total = 1.23
+        self.assertRaises(frappe.ValidationError, prevent_modification_after_submit, doc, "before_update_after_submit")
+
+    def test_changed_item_field_rejected_after_submit(self):
+        doc = self.make_submitted_invoice()
+        doc.items[0].qty = 3
+        self.assertRaises(frappe.ValidationError, prevent_modification_after_submit, doc, "before_update_after_submit")
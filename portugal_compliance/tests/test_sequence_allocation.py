@@ -0,0 +1,95 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Teste de carga da numeração sequencial das séries (allocate_next_number).
+
+Vários processos, cada um com a sua ligação à base de dados, reservam números na mesma série
+em simultâneo; parte das transações é revertida de propósito. No fim, os números confirmados
+têm de ser exatamente 1..N, sem falhas nem duplicados, e o contador da série tem de ser N.
+
+Os processos só veem a série depois do commit, pelo que o teste cria uma série temporária
+confirmada e remove-a no fim.
+"""
+
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import cint, getdate, nowdate
+
+from portugal_compliance.doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import allocate_next_number
+
+WORKERS = 8
+ALLOCATIONS = 50
+ROLLBACK_RATIO = 0.1
+HOLD_MS = 2
+
+
+class TestSequenceAllocation(FrappeTestCase):
+    def setUp(self):
+        self.serie_name = create_temporary_serie()
+
+    def tearDown(self):
+        frappe.delete_doc("Serie de Documento Fiscal", self.serie_name, ignore_permissions=True, force=True)
+        frappe.db.commit()
+
+    def test_concurrent_allocation_has_no_gaps_or_duplicates(self):
+        executor = ProcessPoolExecutor(
+            max_workers=WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(frappe.local.site, frappe.local.sites_path)
+        )
+        with executor:
+            futures = [executor.submit(_allocate_numbers, self.serie_name, ALLOCATIONS, ROLLBACK_RATIO, HOLD_MS, seed)
+                       for seed in range(WORKERS)]
+            results = [future.result() for future in futures]
+
+        committed = sorted(number for result in results for number in result["committed"])
+        counter = cint(frappe.db.get_value("Serie de Documento Fiscal", self.serie_name, "numero_sequencial_atual"))
+
+        self.assertTrue(committed)
+        self.assertEqual(len(committed), len(set(committed)), "números duplicados")
+        self.assertEqual(committed, list(range(1, counter + 1)), "números em falta")
+
+    def test_inactive_serie_is_refused(self):
+        frappe.db.set_value("Serie de Documento Fiscal", self.serie_name, "ativo", 0)
+        self.assertRaises(frappe.ValidationError, allocate_next_number, self.serie_name)
+
+
+def _allocate_numbers(serie_name, allocations, rollback_ratio, hold_ms, seed):
+    rng = random.Random(seed)
+    committed = []
+    for _ in range(allocations):
+        number = allocate_next_number(serie_name)
+        # Simula o resto da submissão (inserção do documento) com o lock da série detido
+        if hold_ms:
+            time.sleep(hold_ms / 1000.0)
+        if rng.random() < rollback_ratio:
+            frappe.db.rollback()
+        else:
+            frappe.db.commit()
+            committed.append(number)
+    return {"committed": committed}
+
+def create_temporary_serie():
+    company = frappe.defaults.get_global_default("company") or frappe.db.get_value("Company", {}, "name")
+    serie = frappe.get_doc({
+        "doctype": "Serie de Documento Fiscal",
+        "tipo_documento": "Fatura",
+        "prefixo_serie": f"TESTE{frappe.generate_hash(length=8).upper()}",
+        "ano_fiscal": getdate(nowdate()).year,
+        "empresa": company,
+        "ativo": 1,
+        "numero_sequencial_atual": 0,
+    })
+    serie.insert(ignore_permissions=True)
+    frappe.db.commit()
+    return serie.name
+
+def _init_worker(site, sites_path):
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
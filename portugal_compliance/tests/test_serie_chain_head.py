@@ -0,0 +1,60 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+from frappe.utils import cint, getdate, nowdate
+
+from portugal_compliance.doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import (
+    get_chain_head,
+    update_chain_head,
+)
+
+SERIE_DOCTYPE = "Serie de Documento Fiscal"
+
+
+class TestSerieChainHead(FrappeTestCase):
+    def setUp(self):
+        self.serie = make_serie()
+
+    def test_get_chain_head_reads_the_signed_head(self):
+        update_chain_head(self.serie.name, f"{self.serie.prefixo_serie}/00003", "HASH3", 3)
+        head = get_chain_head(self.serie.name, for_update=True)
+        self.assertEqual(head.prefixo_serie, self.serie.prefixo_serie)
+        self.assertEqual(head.ultimo_documento_assinado, f"{self.serie.prefixo_serie}/00003")
+        self.assertEqual(head.ultimo_hash_assinado, "HASH3")
+        self.assertEqual(cint(head.ultimo_numero_assinado), 3)
+
+    def test_get_chain_head_of_missing_serie(self):
+        self.assertRaises(frappe.ValidationError, get_chain_head, "SERIE-INEXISTENTE", for_update=False)
+
+    def test_form_save_keeps_the_fields_managed_by_the_database(self):
+        # Formulário aberto antes de a cadeia avançar (valores antigos em memória)
+        stale = frappe.get_doc(SERIE_DOCTYPE, self.serie.name)
+        update_chain_head(self.serie.name, f"{self.serie.prefixo_serie}/00007", "HASH7", 7)
+        frappe.db.set_value(SERIE_DOCTYPE, self.serie.name, "numero_sequencial_atual", 7, update_modified=False)
+
+        stale.codigo_validacao_serie_at = "TESTE123"
+        stale.save(ignore_permissions=True)
+
+        values = frappe.db.get_value(SERIE_DOCTYPE, self.serie.name,
+                                     ["numero_sequencial_atual", "ultimo_documento_assinado", "ultimo_hash_assinado",
+                                      "ultimo_numero_assinado"], as_dict=True)
+        self.assertEqual(cint(values.numero_sequencial_atual), 7)
+        self.assertEqual(values.ultimo_documento_assinado, f"{self.serie.prefixo_serie}/00007")
+        self.assertEqual(values.ultimo_hash_assinado, "HASH7")
+        self.assertEqual(cint(values.ultimo_numero_assinado), 7)
+
+
+def make_serie():
+    """Série temporária (revertida no fim de cada teste)."""
+    company = frappe.defaults.get_global_default("company") or frappe.db.get_value("Company", {}, "name")
+    return frappe.get_doc({
+        "doctype": SERIE_DOCTYPE,
+        "tipo_documento": "Fatura",
+        "prefixo_serie": f"TESTE{frappe.generate_hash(length=8).upper()}",
+        "ano_fiscal": getdate(nowdate()).year,
+        "empresa": company,
+        "ativo": 1,
+        "numero_sequencial_atual": 0,
+    }).insert(ignore_permissions=True)
@@ -0,0 +1,81 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+from unittest.mock import patch
+
+import frappe
+from frappe.tests.utils import FrappeTestCase
+
+from portugal_compliance.utils.series_sequencer import DocumentBehindChainHead, sign_in_chain_order
+
+SEQUENCER = "portugal_compliance.utils.series_sequencer"
+PREFIX = "FT2025"
+
+
+def make_head(number, signed=True):
+    return frappe._dict({
+        "name": PREFIX,
+        "prefixo_serie": PREFIX,
+        "ultimo_documento_assinado": f"{PREFIX}/{number:05d}" if signed else None,
+        "ultimo_hash_assinado": f"HASH{number}" if signed else None,
+        "ultimo_numero_assinado": number if signed else 0,
+    })
+
+def make_invoice(number):
+    return frappe._dict({"doctype": "Sales Invoice", "name": f"{PREFIX}/{number:05d}", "pt_serie_fiscal": PREFIX})
+
+
+class TestSeriesOrdering(FrappeTestCase):
+    """sign_in_chain_order com a cabeça da cadeia e os documentos anteriores simulados."""
+
+    def sign(self, doc, head, predecessors=()):
+        with patch(f"{SEQUENCER}.get_chain_head", return_value=head) as get_chain_head, \
+                patch(f"{SEQUENCER}.lock_pending_predecessors", return_value=list(predecessors)) as lock_predecessors, \
+                patch(f"{SEQUENCER}.sign_documents") as sign_documents, \
+                patch(f"{SEQUENCER}.log_skipped_gap") as log_gap, \
+                patch(f"{SEQUENCER}.flag_document_behind_head") as flag_behind:
+            self.mocks = frappe._dict({
+                "get_chain_head": get_chain_head,
+                "lock_predecessors": lock_predecessors,
+                "sign_documents": sign_documents,
+                "log_gap": log_gap,
+                "flag_behind": flag_behind,
+            })
+            sign_in_chain_order(doc)
+
+    def test_next_document_is_signed_under_the_series_lock(self):
+        doc = make_invoice(4)
+        self.sign(doc, make_head(3))
+        self.mocks.lock_predecessors.assert_called_once_with("Sales Invoice", PREFIX, f"{PREFIX}/", 3, 4)
+        self.assertEqual(self.mocks.get_chain_head.call_args.kwargs, {"for_update": True})
+        self.mocks.sign_documents.assert_called_once_with([doc], "Sales Invoice", skipped_range=range(4, 4))
+        self.mocks.log_gap.assert_not_called()
+
+    def test_first_document_of_the_chain(self):
+        doc = make_invoice(1)
+        self.sign(doc, make_head(0, signed=False))
+        self.mocks.sign_documents.assert_called_once_with([doc], "Sales Invoice", skipped_range=None)
+
+    def test_gap_is_skipped_and_logged(self):
+        doc = make_invoice(7)
+        self.sign(doc, make_head(3))
+        self.mocks.log_gap.assert_called_once_with(PREFIX, 4, 6, doc.name, f"{PREFIX}/00003")
+        self.mocks.sign_documents.assert_called_once_with([doc], "Sales Invoice", skipped_range=range(4, 7))
+
+    def test_document_behind_head_is_refused_and_flagged(self):
+        doc = make_invoice(4)
+        self.assertRaises(DocumentBehindChainHead, self.sign, doc, make_head(5))
+        self.mocks.flag_behind.assert_called_once()
+        self.mocks.sign_documents.assert_not_called()
+
+    def test_unsigned_submitted_predecessor_blocks_signing(self):
+        predecessor = frappe._dict({"name": f"{PREFIX}/00004", "docstatus": 1, "pt_hash_dados_documento_sha1": None})
+        self.assertRaises(frappe.ValidationError, self.sign, make_invoice(5), make_head(3), [predecessor])
+        self.mocks.sign_documents.assert_not_called()
+
+    def test_draft_predecessor_does_not_block_signing(self):
+        predecessor = frappe._dict({"name": f"{PREFIX}/00004", "docstatus": 0, "pt_hash_dados_documento_sha1": None})
+        doc = make_invoice(5)
+        self.sign(doc, make_head(3), [predecessor])
+        self.mocks.log_gap.assert_called_once_with(PREFIX, 4, 4, doc.name, f"{PREFIX}/00003")
+        self.mocks.sign_documents.assert_called_once_with([doc], "Sales Invoice", skipped_range=range(4, 5))
@@ -2,13 +2,18 @@
 from __future__ import unicode_literals
 import frappe
 from frappe import _
-from zeep import Client, Settings, Transport
 from zeep.exceptions import Fault
 from zeep.wsse.username import UsernameToken
-import os
 
 # Import for Compliance Audit Log
 from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from ..saft.circuit_breaker import CircuitOpenError, guarded_call
+from ..saft.atcud_service import DOCUMENT_CLASSES, build_register_request, get_cached_soap_client, get_series_endpoint, parse_series_response
+from .at_outbox import enqueue_at_operation
+
+def _plain_username_token(username, password):
+    # WSSE UsernameToken for authentication
+    return UsernameToken(username, password, use_digest=False)
 
 class ATCommunicationService:
     def __init__(self):
@@ -31,16 +36,17 @@ class ATCommunicationService:
         if self.https_proxy:
             proxies["https"] = self.https_proxy
         
-        transport = Transport(proxies=proxies) if proxies else Transport()
-        
-        # Zeep settings - consider strict=False if WSDL has minor issues, but strict=True is safer
-        zeep_settings = Settings(strict=True, xml_huge_tree=True)
-        
-        # WSSE UsernameToken for authentication
-        wsse = UsernameToken(self.username, self.password, use_digest=False) # AT typically uses plain password over HTTPS
-
         try:
-            self.series_client = Client(self.series_wsdl_url, wsse=wsse, transport=transport, settings=zeep_settings)
+            # Client (WSDL parsed once) shared by every instance in this process; see saft/atcud_service.py
+            # Zeep settings - consider strict=False if WSDL has minor issues, but strict=True is safer
+            self.series_client = get_cached_soap_client(
+                self.series_wsdl_url,
+                self.username,
+                self.password,
+                _plain_username_token, # AT typically uses plain password over HTTPS
+                proxies=proxies,
+                strict=True
+            ).client
             # You might need to specify the service and port if the WSDL has multiple
             # self.series_service = self.series_client.service.YourSeriesServiceNameSoap11 # Adjust as per WSDL
         except Exception as e:
@@ -49,67 +55,35 @@ class ATCommunicationService:
             create_compliance_log("Error", "Portugal Compliance Settings", self.settings_doc.name, details=msg)
             frappe.throw(msg)
 
-    def register_series(self, series_data):
+    def register_series(self, series_data, deadline=None):
         """
-        Communicates a new document series to AT.
-        series_data should be a dictionary matching the expected input structure of the AT webservice.
-        Example series_data structure (needs to be confirmed with actual WSDL):
+        Communicates a new document series to AT (registarSerie).
+        series_data holds the registarSerie fields, as built by saft.atcud_service.build_register_request:
         {
             "serie": "A",
+            "tipoSerie": "N",
+            "classeDoc": "SI",
             "tipoDoc": "FT",
-            "numInicial": "1",
-            "numFinal": "999999",
-            "dataInicioPrevistaUtil": "2025-01-01",
-            "meioProcessamento": "PF" # Programa de Faturação
-            # ... other fields as required by AT
+            "numPrimDocSerie": 1,
+            "dataInicioPrevUtiliz": "2025-01-01",
+            "numCertSWFatur": 1234,
+            "meioProcessamento": "PF"
         }
-        Returns the validation code from AT or raises an exception.
+        deadline: time budget for the call in seconds (see saft/circuit_breaker.py).
+        Returns (validation code, message) from AT or raises an exception; CircuitOpenError is
+        raised as is while the AT endpoint is unavailable.
         """
         try:
-            # The method name (e.g., "RegistaSerie") and parameter names must match the WSDL
-            # response = self.series_service.RegistaSerie(**series_data) # Adjust method and parameters
-            
-            # Placeholder for actual call - replace with correct method and parameters from WSDL
-            # This is a MOCK response structure, replace with actual structure from AT
-            # response = self.series_client.service.RegistaSerie(
-            #     serie=series_data.get("serie"),
-            #     tipoDoc=series_data.get("tipoDoc"),
-            #     numInicial=series_data.get("numInicial"),
-            #     numFinal=series_data.get("numFinal"),
-            #     dataInicioPrevistaUtil=series_data.get("dataInicioPrevistaUtil"),
-            #     meioProcessamento=series_data.get("meioProcessamento")
-            # )
-
-            # --- MOCK IMPLEMENTATION --- 
-            # This section needs to be replaced with the actual SOAP call using self.series_client.service
-            # For now, simulate a successful response for development purposes
-            frappe.log_info(f"MOCK AT Series Registration Call for: {series_data}", "AT Communication")
-            if series_data.get("serie") == "FAIL": # For testing error handling
-                raise Fault(message="Simulated AT Error: Invalid Series Data", code="Client.ValidationError")
-            
-            mock_validation_code = f"MOCK_VALID_{frappe.generate_hash(length=8).upper()}"
-            response_message = f"Serie {series_data.get('serie')} comunicada com sucesso."
-            # --- END MOCK IMPLEMENTATION ---
-
-            # Assuming response has attributes like 'codValidacao' and 'mensagem'
-            # validation_code = response.codValidacao
-            # message = response.mensagem
-            validation_code = mock_validation_code # MOCK
-            message = response_message # MOCK
-
-            create_compliance_log(
-                "AT Series Communication", 
-                "Document Series PT", 
-                series_data.get("serie"), # Assuming series_code is part of series_data or passed differently
-                details=f"Series registration successful. Validation Code: {validation_code}. Message: {message}"
-            )
-            return validation_code, message
-
+            # Same breaker as saft/atcud_service.py for the series endpoint
+            response = guarded_call(get_series_endpoint(), self.series_client.service.registarSerie,
+                                    deadline=deadline, **series_data)
+        except CircuitOpenError:
+            raise
         except Fault as f:
             error_details = f"SOAP Fault during series registration for {series_data.get('serie')}: {f.message} (Code: {f.code})"
             frappe.log_error(error_details, "AT Communication Service")
             create_compliance_log(
-                "AT Series Communication Error", 
+                "AT Communication Failed", 
                 "Document Series PT", 
                 series_data.get("serie"),
                 details=error_details
@@ -119,53 +93,90 @@ class ATCommunicationService:
             error_details = f"Error during series registration for {series_data.get('serie')}: {e}"
             frappe.log_error(frappe.get_traceback(), "AT Communication Service")
             create_compliance_log(
-                "AT Series Communication Error", 
+                "AT Communication Failed", 
                 "Document Series PT", 
                 series_data.get("serie"),
                 details=error_details
             )
             frappe.throw(_("An unexpected error occurred during AT series communication: {0}").format(e))
 
+        result = parse_series_response(response)
+        if result["status"] != "success" or not result["validation_code"]:
+            error_details = f"AT rejected series registration for {series_data.get('serie')}: {result['message']} (Code: {result['code']})"
+            frappe.log_error(error_details, "AT Communication Service")
+            create_compliance_log(
+                "AT Communication Failed",
+                "Document Series PT",
+                series_data.get("serie"),
+                details=error_details
+            )
+            frappe.throw(_("AT Communication Error: {0}").format(result["message"] or _("No validation code returned.")))
+
+        validation_code = result["validation_code"]
+        message = result["message"]
+        create_compliance_log(
+            "Series Communicated", 
+            "Document Series PT", 
+            series_data.get("serie"),
+            details=f"Series registration successful. Validation Code: {validation_code}. Message: {message}"
+        )
+        return validation_code, message
+
     # Add other methods for AnulaSerie, ConsultaSerie as needed, following a similar pattern.
 
 # Whitelisted function to be called from client-side scripts (e.g., from Document Series PT doctype)
 @frappe.whitelist()
 def communicate_serie_to_at(doc_series_name):
+    """Queues the series communication in the AT outbox (utils/at_outbox.py) and returns at once
+    with the tracking id; a background worker calls AT and retries with backoff on failure."""
+    series_doc = frappe.get_doc("Document Series PT", doc_series_name)
+
+    # Prepare data for AT webservice from series_doc
+    # This mapping needs to be precise according to AT requirements
+    tipo_doc = series_doc.document_type_at_code # Ensure this field exists and is correct
+    series_data_for_at = build_register_request(
+        serie=series_doc.name, # Assuming series name is the code
+        tipo_serie="N", # Normal
+        classe_doc=DOCUMENT_CLASSES.get(tipo_doc, "SI"),
+        tipo_doc=tipo_doc,
+        num_prim_doc_serie=series_doc.starting_no,
+        data_inicio_prev_utiliz=series_doc.valid_from.strftime("%Y-%m-%d"), # Ensure field exists
+        num_cert_sw_fatur=frappe.db.get_single_value("Portugal Compliance Settings", "numero_certificado_software_at"),
+        meio_processamento="PF" # Programa de Faturação (Software)
+    )
+
+    tracking_id = enqueue_at_operation(
+        "communicate_document_series",
+        series_data_for_at,
+        reference_doctype="Document Series PT",
+        reference_name=doc_series_name,
+        endpoint=frappe.db.get_single_value("Portugal Compliance Settings", "at_series_communication_endpoint")
+    )
+    frappe.msgprint(_("Series {0} queued for communication to AT (tracking id {1}).").format(doc_series_name, tracking_id))
+    return {"status": "queued", "tracking_id": tracking_id}
+
+def process_document_series_communication(entry, series_data_for_at):
+    """AT outbox handler: registers the series with AT and stores the validation code.
+    Raising makes the outbox retry the entry later."""
+    series_doc = frappe.get_doc("Document Series PT", entry.reference_name)
+    if series_doc.get("custom_at_validation_code"):
+        # Already communicated (e.g. by an earlier attempt or by hand): do not register it twice
+        return {"validation_code": series_doc.custom_at_validation_code, "message": "Already communicated."}
+
+    at_service = ATCommunicationService()
+    validation_code, message = at_service.register_series(series_data_for_at)
+
+    # Update Document Series PT with validation code and status
+    series_doc.custom_at_validation_code = validation_code
+    series_doc.custom_series_status_at = "Comunicada"
+    series_doc.save(ignore_permissions=True) # Save with system permissions
+    return {"validation_code": validation_code, "message": message}
+
+def mark_document_series_communication_failed(entry, error):
+    """AT outbox handler: called once the entry has run out of attempts."""
     try:
-        series_doc = frappe.get_doc("Document Series PT", doc_series_name)
-        
-        # Prepare data for AT webservice from series_doc
-        # This mapping needs to be precise according to AT requirements
-        series_data_for_at = {
-            "serie": series_doc.name, # Assuming series name is the code
-            "tipoDoc": series_doc.document_type_at_code, # Ensure this field exists and is correct
-            "numInicial": str(series_doc.starting_no),
-            "numFinal": str(series_doc.ending_no), # This might not be required by AT, or might be a large default
-            "dataInicioPrevistaUtil": series_doc.valid_from.strftime("%Y-%m-%d"), # Ensure field exists
-            "meioProcessamento": "PF" # Programa de Faturação (Software)
-            # Add any other required fields from series_doc
-        }
-
-        at_service = ATCommunicationService()
-        validation_code, message = at_service.register_series(series_data_for_at)
-
-        # Update Document Series PT with validation code and status
-        series_doc.custom_at_validation_code = validation_code
-        series_doc.custom_series_status_at = "Comunicada"
-        series_doc.save(ignore_permissions=True) # Save with system permissions
-
-        frappe.msgprint(_("Series {0} communicated successfully to AT. Validation Code: {1}").format(doc_series_name, validation_code))
-        return {"status": "success", "validation_code": validation_code, "message": message}
-
-    except Exception as e:
-        frappe.log_error(frappe.get_traceback(), "Communicate Series to AT API")
-        # Update status in Document Series PT to reflect error
-        try:
-            series_doc = frappe.get_doc("Document Series PT", doc_series_name)
-            series_doc.custom_series_status_at = "Erro na Comunicação"
-            series_doc.save(ignore_permissions=True)
-        except Exception as e_save:
-            frappe.log_error(f"Failed to update series status after communication error: {e_save}", "Communicate Series to AT API")
-            
-        frappe.throw(_("Failed to communicate series to AT: {0}").format(e))
-
+        series_doc = frappe.get_doc("Document Series PT", entry.reference_name)
+        series_doc.custom_series_status_at = "Erro na Comunicação"
+        series_doc.save(ignore_permissions=True)
+    except Exception as e_save:
+        frappe.log_error(f"Failed to update series status after communication error: {e_save}", "Communicate Series to AT API")
@@ -0,0 +1,282 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Fila persistente (outbox) das comunicações com a AT.
+
+Os pedidos interativos não chamam a AT: gravam uma entrada em 'Fila de Comunicacao AT' e
+devolvem logo o identificador da entrada. Os workers em segundo plano (tarefa agendada e um
+job lançado após o commit do pedido) esvaziam a fila:
+
+    - cada entrada tem uma chave de idempotência: a mesma operação sobre o mesmo documento
+      só entra na fila uma vez enquanto não falhar definitivamente;
+    - as falhas são repetidas com espera exponencial (30s, 1min, 2min, ... até 1h) até
+      'max_tentativas'; depois a entrada fica 'Falhada';
+    - o número de pedidos em curso é limitado por endpoint da AT;
+    - uma entrada reservada por um worker que morreu volta à fila quando a reserva expira;
+    - com o circuit breaker do endpoint aberto (saft/circuit_breaker.py) a entrada é adiada
+      sem contar como tentativa;
+    - o resultado final (sucesso ou falha definitiva) fica no Compliance Audit Log.
+
+Configuração (site_config.json):
+    "pt_at_outbox_endpoint_concurrency": 2     (ou {"<endpoint>": n, ...})
+    "pt_at_outbox_max_attempts": 8
+
+Os processadores de cada operação estão em OUTBOX_HANDLERS: 'process' recebe a entrada e o
+pedido e devolve o resultado (dict) ou levanta uma exceção para nova tentativa; 'on_failure'
+(opcional) é chamado quando a entrada falha definitivamente.
+"""
+
+import hashlib
+import time
+
+import frappe
+from frappe.utils import add_to_date, cint, cstr, now_datetime
+
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from ..saft.circuit_breaker import CircuitOpenError
+
+OUTBOX_DOCTYPE = "Fila de Comunicacao AT"
+
+DEFAULT_ENDPOINT_CONCURRENCY = 2
+DEFAULT_MAX_ATTEMPTS = 8
+BACKOFF_BASE_SECONDS = 30
+BACKOFF_MAX_SECONDS = 3600
+# Tempo máximo de uma tentativa antes de a entrada poder ser retomada por outro worker
+LEASE_SECONDS = 300
+# Tempo máximo de cada execução de drain_at_outbox (a tarefa agendada corre de novo a seguir)
+DRAIN_TIME_BUDGET = 240
+CLAIM_LOCK_SECONDS = 10
+
+# operação -> processadores (caminhos pontuados, importados apenas quando necessário)
+OUTBOX_HANDLERS = {
+    "communicate_document_series": {
+        "process": "portugal_compliance.utils.at_communication_service.process_document_series_communication",
+        "on_failure": "portugal_compliance.utils.at_communication_service.mark_document_series_communication_failed",
+    },
+}
+
+def enqueue_at_operation(operation, payload, reference_doctype=None, reference_name=None, endpoint=None, idempotency_key=None):
+    """Coloca uma operação na fila e devolve o identificador da entrada (tracking id).
+    Se já existir uma entrada com a mesma chave que não tenha falhado, devolve essa."""
+    if operation not in OUTBOX_HANDLERS:
+        frappe.throw(frappe._("Operação AT desconhecida: {0}").format(operation))
+
+    idempotency_key = idempotency_key or get_idempotency_key(operation, reference_doctype, reference_name, payload)
+    existing = frappe.db.get_value(OUTBOX_DOCTYPE, {"chave_idempotencia": idempotency_key}, ["name", "estado"], as_dict=True)
+    if existing and existing.estado != "Falhada":
+        return existing.name
+    if existing:
+        # Falhada definitivamente: um novo pedido volta a tentar com a mesma chave
+        frappe.db.set_value(OUTBOX_DOCTYPE, existing.name, {
+            "estado": "Pendente",
+            "tentativas": 0,
+            "proxima_tentativa": now_datetime(),
+            "em_processamento_ate": None,
+            "ultimo_erro": None,
+        })
+        _schedule_drain()
+        return existing.name
+
+    entry = frappe.get_doc({
+        "doctype": OUTBOX_DOCTYPE,
+        "operacao": operation,
+        "estado": "Pendente",
+        "reference_doctype": reference_doctype,
+        "reference_name": reference_name,
+        "endpoint": cstr(endpoint),
+        "chave_idempotencia": idempotency_key,
+        "tentativas": 0,
+        "max_tentativas": cint(frappe.conf.get("pt_at_outbox_max_attempts")) or DEFAULT_MAX_ATTEMPTS,
+        "proxima_tentativa": now_datetime(),
+        "payload": frappe.as_json(payload),
+    })
+    entry.insert(ignore_permissions=True)
+    _schedule_drain()
+    return entry.name
+
+def get_idempotency_key(operation, reference_doctype, reference_name, payload):
+    data = frappe.as_json([operation, reference_doctype, reference_name, payload], indent=None)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+def _schedule_drain():
+    # Processamento logo após o commit do pedido, sem esperar pela tarefa agendada
+    frappe.enqueue(
+        "portugal_compliance.utils.at_outbox.drain_at_outbox",
+        queue="short",
+        enqueue_after_commit=True,
+        deduplicate=True,
+        job_id=f"pt_at_outbox_drain::{frappe.local.site}"
+    )
+
+@frappe.whitelist()
+def get_at_outbox_status(tracking_id):
+    """Estado de uma entrada da fila (para o cliente acompanhar o pedido)."""
+    entry = frappe.db.get_value(OUTBOX_DOCTYPE, tracking_id, [
+        "name", "operacao", "estado", "reference_doctype", "reference_name", "tentativas",
+        "max_tentativas", "proxima_tentativa", "concluido_em", "resultado", "ultimo_erro"
+    ], as_dict=True)
+    if not entry:
+        frappe.throw(frappe._("Entrada {0} não encontrada na fila de comunicação AT.").format(tracking_id))
+    if entry.reference_doctype and entry.reference_name:
+        frappe.has_permission(entry.reference_doctype, "read", entry.reference_name, throw=True)
+    else:
+        frappe.only_for("System Manager")
+    entry.resultado = frappe.parse_json(entry.resultado) if entry.resultado else None
+    return entry
+
+def drain_at_outbox():
+    """Tarefa agendada (e job após cada pedido): processa as entradas vencidas, respeitando o
+    limite de pedidos em curso por endpoint, até não haver trabalho ou acabar o tempo."""
+    deadline = time.monotonic() + DRAIN_TIME_BUDGET
+    while time.monotonic() < deadline:
+        claimed = _claim_entries()
+        if not claimed:
+            break
+        for name in claimed:
+            process_outbox_entry(name)
+
+def _claim_entries():
+    """Reserva (estado 'Em Processamento' e prazo da reserva) as entradas vencidas que cabem no
+    limite de cada endpoint. Faz commit para que os outros workers vejam a reserva."""
+    now = now_datetime()
+    endpoints = frappe.db.sql_list(f"""
+        SELECT DISTINCT endpoint
+        FROM `tab{OUTBOX_DOCTYPE}`
+        WHERE (estado = 'Pendente' AND proxima_tentativa <= %(now)s)
+           OR (estado = 'Em Processamento' AND em_processamento_ate < %(now)s)""", {"now": now})
+
+    claimed = []
+    for endpoint in endpoints:
+        # A contagem dos pedidos em curso e a reserva têm de ser atómicas entre workers
+        if not _acquire_claim_lock(endpoint):
+            continue
+        try:
+            in_flight = frappe.db.sql(f"""
+                SELECT COUNT(*)
+                FROM `tab{OUTBOX_DOCTYPE}`
+                WHERE endpoint = %(endpoint)s AND estado = 'Em Processamento' AND em_processamento_ate >= %(now)s""",
+                {"endpoint": endpoint, "now": now})[0][0]
+            free_slots = get_endpoint_concurrency(endpoint) - cint(in_flight)
+            if free_slots <= 0:
+                continue
+
+            names = frappe.db.sql_list(f"""
+                SELECT name
+                FROM `tab{OUTBOX_DOCTYPE}`
+                WHERE endpoint = %(endpoint)s
+                  AND ((estado = 'Pendente' AND proxima_tentativa <= %(now)s)
+                       OR (estado = 'Em Processamento' AND em_processamento_ate < %(now)s))
+                ORDER BY proxima_tentativa, creation
+                LIMIT %(limit)s""", {"endpoint": endpoint, "now": now, "limit": free_slots})
+            if not names:
+                continue
+
+            frappe.db.sql(f"""
+                UPDATE `tab{OUTBOX_DOCTYPE}`
+                SET estado = 'Em Processamento', em_processamento_ate = %(lease)s
+                WHERE name IN %(names)s""", {"lease": add_to_date(now, seconds=LEASE_SECONDS), "names": tuple(names)})
+            frappe.db.commit()
+            claimed.extend(names)
+        finally:
+            _release_claim_lock(endpoint)
+    return claimed
+
+def get_endpoint_concurrency(endpoint):
+    limits = frappe.conf.get("pt_at_outbox_endpoint_concurrency")
+    if isinstance(limits, dict):
+        return cint(limits.get(endpoint) or limits.get("default")) or DEFAULT_ENDPOINT_CONCURRENCY
+    return cint(limits) or DEFAULT_ENDPOINT_CONCURRENCY
+
+def _claim_lock_key(endpoint):
+    return frappe.cache().make_key(f"pt_at_outbox_claim::{endpoint}")
+
+def _acquire_claim_lock(endpoint):
+    return bool(frappe.cache().set(_claim_lock_key(endpoint), 1, ex=CLAIM_LOCK_SECONDS, nx=True))
+
+def _release_claim_lock(endpoint):
+    frappe.cache().delete(_claim_lock_key(endpoint))
+
+def process_outbox_entry(name):
+    """Executa uma tentativa de uma entrada reservada e grava o resultado (com commit)."""
+    entry = frappe.get_doc(OUTBOX_DOCTYPE, name)
+    if entry.estado != "Em Processamento":
+        return
+
+    attempt = cint(entry.tentativas) + 1
+    try:
+        handler = frappe.get_attr(OUTBOX_HANDLERS[entry.operacao]["process"])
+        result = handler(entry, frappe.parse_json(entry.payload) if entry.payload else {})
+    except CircuitOpenError as e:
+        # A AT está indisponível: adia a entrada sem gastar uma tentativa
+        frappe.db.rollback()
+        _postpone(entry, e.retry_after, cstr(e))
+    except Exception as e:
+        frappe.db.rollback()
+        _record_failure(entry, attempt, cstr(e) or e.__class__.__name__)
+    else:
+        frappe.db.set_value(OUTBOX_DOCTYPE, name, {
+            "estado": "Concluída",
+            "tentativas": attempt,
+            "concluido_em": now_datetime(),
+            "em_processamento_ate": None,
+            "resultado": frappe.as_json(result),
+            "ultimo_erro": None,
+        }, update_modified=False)
+        create_compliance_log(
+            "Series Communicated",
+            entry.reference_doctype,
+            entry.reference_name,
+            details=f"Operação AT '{entry.operacao}' concluída (tentativa {attempt}, fila {name}): {frappe.as_json(result)}"
+        )
+    frappe.db.commit()
+
+def _postpone(entry, seconds, error):
+    frappe.db.set_value(OUTBOX_DOCTYPE, entry.name, {
+        "estado": "Pendente",
+        "proxima_tentativa": add_to_date(now_datetime(), seconds=max(cint(seconds), 1)),
+        "em_processamento_ate": None,
+        "ultimo_erro": error,
+    }, update_modified=False)
+
+def _record_failure(entry, attempt, error):
+    if attempt >= cint(entry.max_tentativas):
+        frappe.db.set_value(OUTBOX_DOCTYPE, entry.name, {
+            "estado": "Falhada",
+            "tentativas": attempt,
+            "em_processamento_ate": None,
+            "ultimo_erro": error,
+        }, update_modified=False)
+        create_compliance_log(
+            "AT Communication Failed",
+            entry.reference_doctype,
+            entry.reference_name,
+            details=f"Operação AT '{entry.operacao}' falhou definitivamente após {attempt} tentativas (fila {entry.name}): {error}"
+        )
+        on_failure = OUTBOX_HANDLERS[entry.operacao].get("on_failure")
+        if on_failure:
+            frappe.get_attr(on_failure)(entry, error)
+        return
+
+    delay = min(BACKOFF_BASE_SECONDS * 2 ** (attempt - 1), BACKOFF_MAX_SECONDS)
+    frappe.db.set_value(OUTBOX_DOCTYPE, entry.name, {
+        "estado": "Pendente",
+        "tentativas": attempt,
+        "proxima_tentativa": add_to_date(now_datetime(), seconds=delay),
+        "em_processamento_ate": None,
+        "ultimo_erro": error,
+    }, update_modified=False)
+
+@frappe.whitelist()
+def retry_at_outbox_entry(tracking_id):
+    """Volta a colocar na fila, para execução imediata, uma entrada pendente ou falhada."""
+    frappe.only_for("System Manager")
+    if frappe.db.get_value(OUTBOX_DOCTYPE, tracking_id, "estado") not in ("Pendente", "Falhada"):
+        frappe.throw(frappe._("Só é possível repetir entradas pendentes ou falhadas."))
+    frappe.db.set_value(OUTBOX_DOCTYPE, tracking_id, {
+        "estado": "Pendente",
+        "tentativas": 0,
+        "proxima_tentativa": now_datetime(),
+        "em_processamento_ate": None,
+    })
+    _schedule_drain()
+    return tracking_id
@@ -0,0 +1,132 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import frappe
+
+# Índices compostos para os caminhos de acesso da conformidade fiscal.
+# A ordem das colunas segue os filtros de igualdade primeiro e a ordenação/intervalo no fim.
+COMPLIANCE_INDEXES = {
+    "Sales Invoice": {
+        # Assinatura / verificação da cadeia: company + série + docstatus, ordenado por data e nome
+        "pt_serie_fiscal_cadeia_idx": ["company", "pt_serie_fiscal", "docstatus", "posting_date", "name"],
+        # SAF-T e pré-verificações: company + docstatus, intervalo de datas
+        "pt_company_docstatus_data_idx": ["company", "docstatus", "posting_date"],
+    },
+    "Fila de Comunicacao AT": {
+        # Reserva das entradas vencidas por endpoint (utils/at_outbox.py)
+        "pt_fila_endpoint_estado_idx": ["endpoint", "estado", "proxima_tentativa"],
+    }
+}
+
+# Consultas críticas e o índice que cada uma deve usar (verificado com EXPLAIN)
+HOT_QUERIES = [
+    {
+        "name": "hash_documento_anterior",
+        "doctype": "Sales Invoice",
+        "index": "pt_serie_fiscal_cadeia_idx",
+        "query": """SELECT name, pt_hash_dados_documento_sha1
+            FROM `tabSales Invoice`
+            WHERE company = %(company)s
+              AND pt_serie_fiscal = %(pt_serie_fiscal)s
+              AND docstatus = 1
+              AND ((posting_date < %(posting_date)s) OR (posting_date = %(posting_date)s AND name < %(name)s))
+            ORDER BY posting_date DESC, name DESC
+            LIMIT 1""",
+    },
+    {
+        "name": "cadeia_da_serie",
+        "doctype": "Sales Invoice",
+        "index": "pt_serie_fiscal_cadeia_idx",
+        "query": """SELECT name, pt_hash_dados_documento_sha1
+            FROM `tabSales Invoice`
+            WHERE company = %(company)s
+              AND pt_serie_fiscal = %(pt_serie_fiscal)s
+              AND docstatus = 1
+            ORDER BY posting_date, name""",
+    },
+    {
+        "name": "saft_faturas_do_periodo",
+        "doctype": "Sales Invoice",
+        "index": "pt_company_docstatus_data_idx",
+        "query": """SELECT name
+            FROM `tabSales Invoice`
+            WHERE company = %(company)s
+              AND docstatus = 1
+              AND posting_date BETWEEN %(from_date)s AND %(to_date)s""",
+    },
+]
+
+
+def ensure_compliance_indexes():
+    """Cria (ou recria, se as colunas mudaram) os índices de COMPLIANCE_INDEXES.
+    Chamado pelo patch add_compliance_indexes e em cada migrate (after_migrate)."""
+    if frappe.db.db_type != "mariadb":
+        return
+
+    for doctype, indexes in COMPLIANCE_INDEXES.items():
+        table = f"tab{doctype}"
+        for index_name, columns in indexes.items():
+            if not all(frappe.db.has_column(doctype, column) for column in columns if column != "name"):
+                # Os campos personalizados ainda não existem (ex: patch de campos ainda não aplicado)
+                continue
+
+            existing_columns = get_index_columns(table, index_name)
+            if existing_columns == columns:
+                continue
+            if existing_columns:
+                frappe.db.sql_ddl(f"ALTER TABLE `{table}` DROP INDEX `{index_name}`")
+
+            column_list = ", ".join(f"`{column}`" for column in columns)
+            # INPLACE/LOCK=NONE: a tabela continua disponível para escrita durante a criação do índice
+            frappe.db.sql_ddl(
+                f"ALTER TABLE `{table}` ADD INDEX `{index_name}` ({column_list}), ALGORITHM=INPLACE, LOCK=NONE"
+            )
+
+
+def get_index_columns(table, index_name):
+    """Colunas (por ordem) de um índice existente, ou lista vazia se não existir."""
+    rows = frappe.db.sql(f"SHOW INDEX FROM `{table}` WHERE Key_name = %s", index_name, as_dict=True)
+    return [row.Column_name for row in sorted(rows, key=lambda row: row.Seq_in_index)]
+
+
+@frappe.whitelist()
+def check_compliance_query_plans(company=None):
+    """Executa EXPLAIN sobre cada consulta crítica e confirma que o índice esperado é usado."""
+    frappe.only_for("System Manager")
+
+    values = _get_sample_values(company)
+    report = []
+    for hot_query in HOT_QUERIES:
+        plan = frappe.db.sql(f"EXPLAIN {hot_query['query']}", values, as_dict=True)
+        table_plan = next((row for row in plan if row.table == f"tab{hot_query['doctype']}"), {})
+        used_index = table_plan.get("key")
+        report.append({
+            "query": hot_query["name"],
+            "expected_index": hot_query["index"],
+            "used_index": used_index,
+            "possible_keys": table_plan.get("possible_keys"),
+            "access_type": table_plan.get("type"),
+            "estimated_rows": table_plan.get("rows"),
+            "extra": table_plan.get("Extra"),
+            "ok": used_index == hot_query["index"],
+        })
+    return {"ok": all(row["ok"] for row in report), "queries": report}
+
+
+def _get_sample_values(company=None):
+    # Valores reais tornam o plano do otimizador representativo
+    serie = frappe.db.get_value(
+        "Serie de Documento Fiscal",
+        {"empresa": company} if company else {},
+        ["name", "empresa"],
+        as_dict=True
+    ) or frappe._dict()
+    today = frappe.utils.today()
+    return {
+        "company": company or serie.get("empresa") or frappe.defaults.get_global_default("company"),
+        "pt_serie_fiscal": serie.get("name"),
+        "posting_date": today,
+        "name": "",
+        "from_date": frappe.utils.add_years(today, -1),
+        "to_date": today,
+    }
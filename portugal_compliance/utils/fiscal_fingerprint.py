@@ -0,0 +1,299 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Impressão digital fiscal dos documentos submetidos.
+
+Na submissão é calculado um hash SHA-256 sobre uma serialização canónica dos campos críticos do
+cabeçalho e das linhas (valores numéricos com precisão fixa, datas em ISO, linhas pela ordem de
+idx) e gravado em 'pt_impressao_digital_fiscal', junto dos campos de assinatura. As validações
+posteriores recalculam o hash sobre o documento em memória e comparam-no com o valor gravado,
+lido numa única consulta (sem recarregar o documento nem as tabelas filhas).
+
+A auditoria em massa (audit_fiscal_fingerprints) percorre séries inteiras em lotes (paginação
+por nome) e recalcula as impressões digitais; com backfill=1 grava-as nos documentos
+submetidos antes desta funcionalidade.
+"""
+
+import hashlib
+import json
+import time
+from decimal import Decimal
+
+import frappe
+from frappe.utils import cint, cstr, flt, getdate
+
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import validate_fiscal_doctype
+
+FINGERPRINT_FIELD = "pt_impressao_digital_fiscal"
+# Muda sempre que a lista de campos ou a serialização mudar
+FINGERPRINT_VERSION = "v1"
+
+# Campos que não podem mudar depois da submissão
+CRITICAL_HEADER_FIELDS = [
+    "posting_date", "company", "customer", "grand_total", "net_total",
+    "total_taxes_and_charges", "naming_series", "currency", "plc_conversion_rate"
+    # Add other fields deemed critical by AT regulations
+]
+CRITICAL_ITEM_FIELDS = ["item_code", "qty", "uom", "rate", "amount", "net_rate", "net_amount", "item_tax_template"]
+
+# Campos que, depois de preenchidos pela assinatura, não podem mudar
+CERTIFIED_FIELDS = [
+    "pt_atcud",
+    "pt_hash_dados_documento_sha1",
+    "pt_assinatura_digital_rsa",
+    "pt_assinatura_4_caracteres",
+    "pt_qr_code_string",
+    "pt_qr_code_imagem"
+]
+
+NUMERIC_FIELDTYPES = ("Currency", "Float", "Int", "Percent", "Check")
+DEFAULT_BATCH_SIZE = 500
+MAX_MISMATCHES_PER_SERIE = 100
+REPORT_CACHE_TTL = 7 * 24 * 3600
+
+# --- Cálculo ---
+
+def get_fingerprint_layout(doctype_name):
+    """Campos do cabeçalho e das linhas que existem no DocType, com o tipo de cada um."""
+    meta = frappe.get_meta(doctype_name)
+    header = [(field, meta.get_field(field).fieldtype) for field in CRITICAL_HEADER_FIELDS if meta.has_field(field)]
+
+    items_doctype, items = None, []
+    items_field = meta.get_field("items")
+    if items_field and items_field.options:
+        items_doctype = items_field.options
+        item_meta = frappe.get_meta(items_doctype)
+        items = [(field, item_meta.get_field(field).fieldtype) for field in CRITICAL_ITEM_FIELDS if item_meta.has_field(field)]
+    return frappe._dict(header_fields=header, items_doctype=items_doctype, item_fields=items)
+
+def compute_fiscal_fingerprint(doctype_name, header, items, layout=None):
+    """Impressão digital de um documento: 'header' é o documento (ou uma linha lida da BD) e
+    'items' as suas linhas pela ordem de idx."""
+    layout = layout or get_fingerprint_layout(doctype_name)
+    canonical = [
+        FINGERPRINT_VERSION,
+        doctype_name,
+        header.get("name"),
+        [_canonical_value(header.get(field), fieldtype) for field, fieldtype in layout.header_fields],
+        [
+            [item.get("name")] + [_canonical_value(item.get(field), fieldtype) for field, fieldtype in layout.item_fields]
+            for item in items
+        ]
+    ]
+    data = json.dumps(canonical, ensure_ascii=False, separators=(",", ":"))
+    return f"{FINGERPRINT_VERSION}:{hashlib.sha256(data.encode('utf-8')).hexdigest()}"
+
+def _canonical_value(value, fieldtype):
+    if fieldtype in NUMERIC_FIELDTYPES:
+        # float, int e Decimal (da BD) têm a mesma representação
+        return "{:.9f}".format(flt(value, 9))
+    if fieldtype == "Date":
+        return cstr(getdate(value)) if value else ""
+    return cstr(value)
+
+def get_document_fingerprint(doc):
+    return compute_fiscal_fingerprint(doc.doctype, doc, doc.get("items") or [])
+
+def store_fiscal_fingerprint(doc):
+    """Hook de submissão: calcula a impressão digital sobre o documento em memória e grava-a."""
+    if not frappe.get_meta(doc.doctype).has_field(FINGERPRINT_FIELD):
+        return
+    fingerprint = get_document_fingerprint(doc)
+    doc.set(FINGERPRINT_FIELD, fingerprint)
+    frappe.db.set_value(doc.doctype, doc.name, FINGERPRINT_FIELD, fingerprint, update_modified=False)
+
+# --- Validação ---
+
+def get_stored_fiscal_values(doc):
+    """Impressão digital e campos certificados gravados, numa única consulta. O resultado fica
+    em doc.flags para as outras validações do mesmo save."""
+    cached = doc.flags.pt_stored_fiscal_values
+    if cached and cached[0] == doc.modified:
+        return cached[1]
+
+    meta = frappe.get_meta(doc.doctype)
+    fields = [field for field in [FINGERPRINT_FIELD, "pt_estado_documento_fiscal"] + CERTIFIED_FIELDS if meta.has_field(field)]
+    values = frappe._dict()
+    if fields:
+        values = frappe.db.get_value(doc.doctype, doc.name, fields, as_dict=True) or frappe._dict()
+    doc.flags.pt_stored_fiscal_values = (doc.modified, values)
+    return values
+
+def fiscal_fingerprint_matches(doc):
+    """True/False conforme o documento em memória corresponde à impressão digital gravada;
+    None se o documento não tiver impressão digital (submetido antes desta funcionalidade ou
+    gravada com outra versão)."""
+    stored = get_stored_fiscal_values(doc).get(FINGERPRINT_FIELD)
+    if not stored or not stored.startswith(f"{FINGERPRINT_VERSION}:"):
+        return None
+    return stored == get_document_fingerprint(doc)
+
+def get_changed_critical_fields(doc):
+    """Campos críticos que diferem dos valores gravados, para documentos sem impressão digital.
+    Usa duas consultas de projeção (colunas do cabeçalho e das linhas) em vez de recarregar o
+    documento."""
+    layout = get_fingerprint_layout(doc.doctype)
+    changed_fields = []
+
+    header_fields = [field for field, _ in layout.header_fields]
+    if header_fields:
+        db_values = frappe.db.get_value(doc.doctype, doc.name, header_fields, as_dict=True) or {}
+        changed_fields.extend(field for field in header_fields if _values_differ(doc.get(field), db_values.get(field)))
+
+    if layout.items_doctype:
+        item_fields = [field for field, _ in layout.item_fields]
+        db_items = {
+            row.name: row for row in frappe.get_all(
+                layout.items_doctype,
+                filters={"parent": doc.name, "parenttype": doc.doctype, "parentfield": "items"},
+                fields=["name"] + item_fields
+            )
+        }
+        items = doc.get("items") or []
+        if len(items) != len(db_items) or any(item.name not in db_items for item in items):
+            changed_fields.append("items (rows)")
+        else:
+            for i, item in enumerate(items):
+                db_item = db_items[item.name]
+                changed_fields.extend(f"items[{i}].{field}" for field in item_fields
+                                      if _values_differ(item.get(field), db_item.get(field)))
+    return changed_fields
+
+def _values_differ(current_val, db_val):
+    # Números podem vir como float, int ou Decimal; datas como date ou string
+    if isinstance(current_val, (int, float, Decimal)) or isinstance(db_val, (int, float, Decimal)):
+        return flt(current_val, 9) != flt(db_val, 9)
+    return cstr(current_val) != cstr(db_val)
+
+# --- Auditoria em massa ---
+
+@frappe.whitelist()
+def enqueue_fiscal_fingerprint_audit(company=None, series=None, backfill=0, doctype_name="Sales Invoice"):
+    """Agenda a auditoria num worker 'long' e devolve o identificador do relatório."""
+    frappe.only_for("System Manager")
+    validate_fiscal_doctype(doctype_name)
+    report_id = frappe.generate_hash(length=12)
+    frappe.enqueue(
+        "portugal_compliance.utils.fiscal_fingerprint.audit_fiscal_fingerprints",
+        queue="long",
+        timeout=6 * 3600,
+        company=company,
+        series=frappe.parse_json(series) if isinstance(series, str) and series.startswith("[") else series,
+        backfill=cint(backfill),
+        doctype_name=doctype_name,
+        report_id=report_id
+    )
+    return {"report_id": report_id}
+
+@frappe.whitelist()
+def get_fiscal_fingerprint_audit_report(report_id):
+    frappe.only_for("System Manager")
+    return frappe.cache().get_value(f"pt_fiscal_fingerprint_audit:{report_id}")
+
+def audit_fiscal_fingerprints(company=None, series=None, backfill=0, doctype_name="Sales Invoice",
+                              batch_size=DEFAULT_BATCH_SIZE, report_id=None):
+    """Recalcula as impressões digitais dos documentos submetidos das séries indicadas (ou de
+    todas) e devolve as divergências. Com backfill, grava as que faltam."""
+    started = time.perf_counter()
+    layout = get_fingerprint_layout(doctype_name)
+    filters = {}
+    if company:
+        filters["empresa"] = company
+    if series:
+        filters["name"] = ["in", series if isinstance(series, (list, tuple)) else [series]]
+    series_rows = frappe.get_all("Serie de Documento Fiscal", filters=filters, fields=["name", "prefixo_serie"])
+
+    results = [audit_serie(doctype_name, row.name, layout, cint(backfill), cint(batch_size) or DEFAULT_BATCH_SIZE)
+               for row in series_rows]
+
+    elapsed = time.perf_counter() - started
+    total_documents = sum(result["documents"] for result in results)
+    total_mismatches = sum(result["mismatch_count"] for result in results)
+    report = {
+        "report_id": report_id,
+        "doctype": doctype_name,
+        "company": company,
+        "series": results,
+        "documents": total_documents,
+        "mismatches": total_mismatches,
+        "missing": sum(result["missing"] for result in results),
+        "backfilled": sum(result["backfilled"] for result in results),
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(total_documents / elapsed, 1) if elapsed else 0.0,
+        "status": "OK" if not total_mismatches else "MISMATCHES_FOUND"
+    }
+
+    create_compliance_log(
+        "Signature Verification", "DocType", doctype_name,
+        details=f"Impressões digitais fiscais: {total_documents} documentos em {len(results)} séries; "
+                f"{total_mismatches} divergências; {report['missing']} sem impressão digital; "
+                f"{report['backfilled']} gravadas."
+    )
+    frappe.db.commit()
+    if report_id:
+        frappe.cache().set_value(f"pt_fiscal_fingerprint_audit:{report_id}", report, expires_in_sec=REPORT_CACHE_TTL)
+    return report
+
+def audit_serie(doctype_name, serie_name, layout, backfill=0, batch_size=DEFAULT_BATCH_SIZE):
+    """Percorre os documentos submetidos de uma série em lotes: uma consulta para os cabeçalhos e
+    outra para as linhas de cada lote."""
+    started = time.perf_counter()
+    header_columns = ", ".join(f"`{field}`" for field, _ in layout.header_fields)
+    header_columns = f", {header_columns}" if header_columns else ""
+    item_columns = ", ".join(f"`{field}`" for field, _ in layout.item_fields)
+    item_columns = f", {item_columns}" if item_columns else ""
+
+    documents = missing = backfilled = mismatch_count = 0
+    mismatches = []
+    last_name = ""
+    while True:
+        docs = frappe.db.sql(f"""
+            SELECT name, `{FINGERPRINT_FIELD}`{header_columns}
+            FROM `tab{doctype_name}`
+            WHERE pt_serie_fiscal = %(serie)s AND docstatus = 1 AND name > %(after)s
+            ORDER BY name
+            LIMIT %(limit)s""", {"serie": serie_name, "after": last_name, "limit": batch_size}, as_dict=True)
+        if not docs:
+            break
+        last_name = docs[-1].name
+
+        items_by_parent = {}
+        if layout.items_doctype:
+            for item in frappe.db.sql(f"""
+                    SELECT parent, name{item_columns}
+                    FROM `tab{layout.items_doctype}`
+                    WHERE parenttype = %(doctype)s AND parentfield = 'items' AND parent IN %(parents)s
+                    ORDER BY parent, idx""", {"doctype": doctype_name, "parents": tuple(doc.name for doc in docs)}, as_dict=True):
+                items_by_parent.setdefault(item.parent, []).append(item)
+
+        to_backfill = {}
+        for doc in docs:
+            documents += 1
+            fingerprint = compute_fiscal_fingerprint(doctype_name, doc, items_by_parent.get(doc.name, []), layout)
+            stored = doc.get(FINGERPRINT_FIELD)
+            if not stored or not stored.startswith(f"{FINGERPRINT_VERSION}:"):
+                missing += 1
+                if backfill:
+                    to_backfill[doc.name] = {FINGERPRINT_FIELD: fingerprint}
+            elif stored != fingerprint:
+                mismatch_count += 1
+                if len(mismatches) < MAX_MISMATCHES_PER_SERIE:
+                    mismatches.append({"document": doc.name, "expected": fingerprint, "stored": stored})
+
+        if to_backfill:
+            frappe.db.bulk_update(doctype_name, to_backfill, update_modified=False)
+            frappe.db.commit()
+            backfilled += len(to_backfill)
+
+    elapsed = time.perf_counter() - started
+    return {
+        "serie": serie_name,
+        "documents": documents,
+        "missing": missing,
+        "backfilled": backfilled,
+        "mismatch_count": mismatch_count,
+        "mismatches": mismatches,
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(documents / elapsed, 1) if elapsed else 0.0
+    }
@@ -4,33 +4,24 @@
 import frappe
 import hashlib
 import base64
-from datetime import datetime
+from datetime import timedelta
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
-from cryptography.hazmat.primitives.serialization import load_pkcs12
-from cryptography.hazmat.backends import default_backend
-import qrcode
-import io
+
+from frappe.utils import cint
+
+from .qr_image_cache import get_qr_image_url, is_qr_image_deferred
+from .signing_key_cache import get_signing_key
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import get_chain_head, update_chain_head
+from ..saft.utils import get_sequential_number_from_name
 
 # --- Funções de Assinatura Digital ---
 
 def get_active_certificate_details(company):
-    """Obtém os detalhes do certificado digital ativo para a empresa."""
-    active_cert_name = frappe.call("portugal_compliance.portugal_compliance.doctype.certificado_digital_qualificado.certificado_digital_qualificado.get_active_certificate_for_company", company=company)
-    if not active_cert_name:
-        frappe.throw(frappe._("Nenhum certificado digital ativo encontrado para a empresa {0}.").format(company))
-    
-    cert_doc = frappe.get_doc("Certificado Digital Qualificado", active_cert_name)
-    pfx_data, pfx_password = cert_doc.get_certificate_data()
-    
-    password_bytes = pfx_password.encode("utf-8") if pfx_password else None
-        
-    private_key, certificate, _ = load_pkcs12(
-        pfx_data, 
-        password_bytes,
-        default_backend()
-    )
-    return private_key, certificate
+    """Obtém os detalhes do certificado digital ativo para a empresa.
+       A chave decifrada é mantida em cache por processo (ver utils/signing_key_cache.py).
+    """
+    return get_signing_key(company)
 
 def create_signature_string(invoice_date_obj, invoice_time_str, invoice_number, invoice_total_float, previous_invoice_hash_str):
     """Cria a string de dados a ser assinada, conforme requisitos da AT.
@@ -87,7 +78,7 @@ def generate_qr_code_string(atcud, nif_emitter, nif_acquirer, country_emitter, c
         f"E:{country_acquirer}",
         f"F:{doc_type_code}",
         f"G:{doc_status}",
-        f"H:{doc_date_obj.strftime("%Y%m%d")}",
+        f"H:{doc_date_obj.strftime('%Y%m%d')}",
         f"I1:{doc_number}",
         f"I2:{fmt_taxable}",
         f"I3:{fmt_vat}",
@@ -98,29 +89,24 @@ def generate_qr_code_string(atcud, nif_emitter, nif_acquirer, country_emitter, c
     ]
     return "*".join(qr_fields)
 
-def generate_qr_code_image_bytes(qr_string):
-    """Gera uma imagem QR Code a partir da string e retorna como bytes PNG."""
-    qr = qrcode.QRCode(
-        version=None, # Auto-detect version
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=4, # Smaller box size for smaller image
-        border=2,
-    )
-    qr.add_data(qr_string)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format="PNG")
-    return img_byte_arr.getvalue()
+# --- Funções de utilidade para o hash da fatura anterior e a cabeça da cadeia da série ---
 
-# --- Função de utilidade para obter o hash da fatura anterior ---
+def get_previous_document_data_hash(current_doc, head=None):
+    """Obtém o hash SHA-1 da string de dados do documento fiscal imediatamente anterior na mesma série.
+       O hash é lido da cabeça da cadeia guardada na 'Serie de Documento Fiscal' (consulta por chave
+       primária); a linha da série fica bloqueada até ao fim da transação de submissão.
+    """
+    if head is None:
+        head = get_chain_head(current_doc.pt_serie_fiscal, for_update=True)
+    if head.ultimo_hash_assinado:
+        return head.ultimo_hash_assinado
 
-def get_previous_document_data_hash(current_doc):
-    """Obtém o hash SHA-1 da string de dados do documento fiscal imediatamente anterior na mesma série."""
-    # Uses posting_date and name for ordering within the series.
-    # Assumes current_doc has pt_serie_fiscal, company, posting_date, name, and doctype fields.
-    
+    # Cabeça ainda não inicializada (série sem documentos assinados ou criada antes deste campo existir):
+    # procura o último documento assinado na tabela. Após a primeira assinatura a cabeça passa a ser usada.
+    return get_previous_document_data_hash_from_documents(current_doc)
+
+def get_previous_document_data_hash_from_documents(current_doc):
+    """Procura o hash do documento anterior diretamente na tabela de documentos (ordenação por data e nome)."""
     # Find the last submitted document in the same series strictly before the current one.
     # Order by posting_date desc, then by name desc to get the immediate predecessor.
     last_docs = frappe.db.sql(f"""
@@ -147,76 +133,85 @@ def get_previous_document_data_hash(current_doc):
     else:
         return "0" # As per AT requirement for the first document in a series
 
+def advance_series_chain_head(doc, head, document_hash):
+    """Coloca o documento no topo da cadeia da sua série (mesma transação da assinatura)."""
+    sequence_number = get_sequential_number_from_name(doc.name, f"{head.prefixo_serie}/")
+    update_chain_head(doc.pt_serie_fiscal, doc.name, document_hash, cint(sequence_number))
+
+# Tipo de documento da série -> código AT (QR Code, comunicação de séries)
+DOCUMENT_TYPE_CODES = {
+    "Fatura": "FT",
+    "Nota de Crédito": "NC",
+    "Nota de Débito": "ND",
+    "Guia de Remessa": "GT",
+    "Fatura Simplificada": "FS",
+    "Fatura-Recibo": "FR"
+    # Add other mappings as necessary
+}
+
 def get_document_type_code_for_qr(serie_fiscal_doc_name):
-    serie_doc = frappe.get_doc("Serie de Documento Fiscal", serie_fiscal_doc_name)
-    mapping = {
-        "Fatura": "FT",
-        "Nota de Crédito": "NC",
-        "Nota de Débito": "ND",
-        "Guia de Remessa": "GT",
-        "Fatura Simplificada": "FS",
-        "Fatura-Recibo": "FR"
-        # Add other mappings as necessary
-    }
-    return mapping.get(serie_doc.tipo_documento, "XX") # XX for unknown/error
+    tipo_documento = frappe.get_cached_value("Serie de Documento Fiscal", serie_fiscal_doc_name, "tipo_documento")
+    return DOCUMENT_TYPE_CODES.get(tipo_documento, "XX") # XX for unknown/error
 
-# --- Função principal para assinar um documento e gerar QR Code ---
-@frappe.whitelist()
-def sign_document_and_generate_qr(doc_name, doctype_name):
-    doc = frappe.get_doc(doctype_name, doc_name)
-    company = doc.company
+def format_posting_time(posting_time):
+    """Devolve a hora do documento como string HH:MM:SS (aceita str, time ou timedelta vindo da BD)."""
+    if not posting_time:
+        return "00:00:00"
+    if isinstance(posting_time, str) and len(posting_time.split(":")) == 3:
+        return posting_time
+    if hasattr(posting_time, "strftime"): # if it is a time object
+        return posting_time.strftime("%H:%M:%S")
+    if isinstance(posting_time, timedelta):
+        total_seconds = int(posting_time.total_seconds())
+        return "{:02d}:{:02d}:{:02d}".format(total_seconds // 3600, (total_seconds % 3600) // 60, total_seconds % 60)
+    return str(posting_time)
 
-    if not doc.pt_serie_fiscal:
-        frappe.throw(frappe._("Campo 'Série Fiscal' (pt_serie_fiscal) não preenchido no documento {0}.").format(doc_name))
+def get_signing_context(company, serie_fiscal):
+    """Dados comuns a todos os documentos de uma série (lidos uma vez por assinatura ou lote)."""
+    doc_type_code_qr = get_document_type_code_for_qr(serie_fiscal)
+    if doc_type_code_qr == "XX":
+        frappe.throw(frappe._("Mapeamento do tipo de documento para código QR não encontrado para a série {0}.").format(serie_fiscal))
 
-    # 1. Obter detalhes do certificado
-    private_key, _ = get_active_certificate_details(company)
+    software_cert_number = frappe.db.get_single_value("Portugal Compliance Settings", "numero_certificado_software_at")
+    if not software_cert_number:
+        frappe.throw(frappe._("Número do certificado do software (AT) não configurado em Portugal Compliance Settings."))
 
-    # 2. Obter hash do documento anterior
-    previous_hash = get_previous_document_data_hash(doc)
+    return frappe._dict({
+        "company_tax_id": frappe.db.get_value("Company", company, "tax_id"),
+        "doc_type_code_qr": doc_type_code_qr,
+        "software_cert_number": software_cert_number
+    })
+
+def prepare_signature_data(doc, previous_hash):
+    """Constrói a string de dados a assinar e o respetivo hash SHA-1 (usado no encadeamento)."""
+    # ATCUD should be pre-filled on the document via Serie de Documento Fiscal logic
+    if not doc.get("pt_atcud"):
+        frappe.throw(frappe._("ATCUD (pt_atcud) não encontrado no documento {0}.").format(doc.name))
 
     # 3. Construir a string de dados para assinatura
-    # Ensure posting_time is a string in HH:MM:SS format
-    posting_time_str = doc.get_formatted("posting_time") if doc.posting_time else "00:00:00"
-    if isinstance(doc.posting_time, str) and len(doc.posting_time.split(":")) == 3:
-        posting_time_str = doc.posting_time
-    elif hasattr(doc.posting_time, "strftime") : # if it is a time object
-        posting_time_str = doc.posting_time.strftime("%H:%M:%S")
-    
     data_to_sign_bytes = create_signature_string(
         doc.posting_date, 
-        posting_time_str, 
+        format_posting_time(doc.posting_time), 
         doc.name, # Document number (e.g., FT ABC/00001)
         doc.grand_total, 
         previous_hash
     )
     
     # 4. Calcular o hash SHA-1 da string de dados (para encadeamento e para os 4 caracteres)
-    current_doc_data_hash_sha1 = hashlib.sha1(data_to_sign_bytes).hexdigest()
+    return data_to_sign_bytes, hashlib.sha1(data_to_sign_bytes).hexdigest()
 
-    # 5. Assinar os dados com RSA-SHA256
-    rsa_signature_bytes = sign_data_rsa_sha256(private_key, data_to_sign_bytes)
+def build_signature_values(doc, data_to_sign_bytes, current_doc_data_hash_sha1, rsa_signature_bytes, context):
+    """Calcula os 4 caracteres e a string do QR Code e devolve os campos de assinatura, sem acesso à BD.
+       'doc' pode ser um Document ou uma linha (frappe._dict) com os mesmos campos.
+    """
     rsa_signature_b64 = base64.b64encode(rsa_signature_bytes).decode("utf-8")
 
     # 6. Obter os 4 caracteres (do hash SHA1 da string de dados)
     signature_4_chars = get_data_hash_4_chars(data_to_sign_bytes)
 
     # 7. Gerar string do QR Code
-    company_tax_id = frappe.db.get_value("Company", company, "tax_id")
     # Assume customer_tax_id is stored in 'tax_id' field on the invoice document for the customer
     customer_tax_id = doc.get("tax_id") or doc.get("customer_tax_id") or "999999990" 
-    
-    doc_type_code_qr = get_document_type_code_for_qr(doc.pt_serie_fiscal)
-    if doc_type_code_qr == "XX":
-        frappe.throw(frappe._("Mapeamento do tipo de documento para código QR não encontrado para a série {0}.").format(doc.pt_serie_fiscal))
-
-    # ATCUD should be pre-filled on the document via Serie de Documento Fiscal logic
-    if not doc.pt_atcud:
-        frappe.throw(frappe._("ATCUD (pt_atcud) não encontrado no documento {0}.").format(doc_name))
-
-    software_cert_number = frappe.db.get_single_value("Portugal Compliance Settings", "numero_certificado_software_at")
-    if not software_cert_number:
-        frappe.throw(frappe._("Número do certificado do software (AT) não configurado em Portugal Compliance Settings."))
 
     # Taxable amount and VAT amount for QR code
     # Assuming doc.net_total is the sum of item net amounts (taxable base)
@@ -228,11 +223,11 @@ def sign_document_and_generate_qr(doc_name, doctype_name):
 
     qr_string = generate_qr_code_string(
         atcud=doc.pt_atcud,
-        nif_emitter=company_tax_id,
+        nif_emitter=context.company_tax_id,
         nif_acquirer=customer_tax_id,
         country_emitter="PT",
         country_acquirer="PT", # Needs logic if customer is foreign
-        doc_type_code=doc_type_code_qr,
+        doc_type_code=context.doc_type_code_qr,
         doc_status="N", # N: Normal, A: Anulado, S: Autofaturação (needs logic for A)
         doc_date_obj=doc.posting_date,
         doc_number=doc.name,
@@ -240,29 +235,106 @@ def sign_document_and_generate_qr(doc_name, doctype_name):
         vat_amount_float=qr_vat_amount,
         gross_total_float=doc.grand_total,
         signature_hash_4_chars=signature_4_chars,
-        software_cert_number=software_cert_number
+        software_cert_number=context.software_cert_number
     )
 
-    # 8. Gerar imagem do QR Code e anexar ao documento
-    qr_image_content_bytes = generate_qr_code_image_bytes(qr_string)
-    qr_file = frappe.new_doc("File")
-    qr_file.file_name = f"{doc.name.replace('/', '_')}_qrcode.png"
-    qr_file.is_private = 0 # Public so it can be embedded in prints
-    qr_file.content = qr_image_content_bytes
-    qr_file.attached_to_doctype = doctype_name
-    qr_file.attached_to_name = doc_name
-    qr_file.save(ignore_permissions=True)
-
-    # 9. Salvar os dados da assinatura e hashes no documento
-    update_values = {
+    return {
         "pt_hash_dados_documento_sha1": current_doc_data_hash_sha1,
         "pt_assinatura_digital_rsa": rsa_signature_b64,
         "pt_assinatura_4_caracteres": signature_4_chars,
-        "pt_qr_code_string": qr_string,
-        "pt_qr_code_imagem": qr_file.file_url
+        "pt_qr_code_string": qr_string
     }
-    frappe.db.set_value(doctype_name, doc_name, update_values)
-    
+
+def attach_qr_code_image(doctype_name, doc_name, qr_string):
+    """Devolve o URL da imagem do QR Code na cache endereçada pelo conteúdo (ver utils/qr_image_cache.py).
+       Em modo 'Diferido' não gera nada: a imagem é criada na impressão ou pela tarefa agendada.
+    """
+    if is_qr_image_deferred():
+        return None
+    return get_qr_image_url(qr_string)
+
+# --- Função principal para assinar um documento e gerar QR Code ---
+# A orquestração (bloqueio da série, encadeamento, backend de assinatura e gravação) é feita pelo
+# motor de assinatura (utils/signing_engine.py); as funções abaixo são os pontos de entrada.
+
+@frappe.whitelist()
+def sign_document_and_generate_qr(doc_name, doctype_name):
+    from .signing_engine import sign_documents
+
+    doc = frappe.get_doc(doctype_name, doc_name)
+    doc.check_permission("submit")
+    if doc.get("pt_hash_dados_documento_sha1"):
+        # Já assinado (ex: pela submissão): assinar de novo partiria a cadeia da série
+        return {field: doc.get(field) for field in (
+            "pt_hash_dados_documento_sha1", "pt_assinatura_digital_rsa", "pt_assinatura_4_caracteres",
+            "pt_qr_code_string", "pt_qr_code_imagem")}
+    update_values = sign_documents([doc], doctype_name)[doc.name]
+
     frappe.msgprint(frappe._("Documento {0} assinado e QR Code gerado com sucesso.").format(doc_name))
     return update_values
 
+# --- Assinatura em lote (importações, fecho de sessões POS) ---
+
+SIGNING_FIELDS = ["name", "company", "docstatus", "pt_serie_fiscal", "pt_atcud", "pt_hash_dados_documento_sha1",
+                  "posting_date", "posting_time", "grand_total", "net_total", "tax_id"]
+
+@frappe.whitelist()
+def sign_documents_batch(doc_names, doctype_name="Sales Invoice"):
+    """Assina uma lista ordenada de documentos submetidos da mesma série numa única transação.
+
+       A série é bloqueada uma vez, a cadeia SHA-1 e as assinaturas RSA são calculadas em memória
+       e todos os campos de assinatura são gravados com um único bulk update.
+    """
+    from .signing_engine import sign_documents
+
+    if isinstance(doc_names, str):
+        doc_names = frappe.parse_json(doc_names)
+    if not doc_names:
+        return {"signed": 0}
+    for doc_name in doc_names:
+        frappe.has_permission(doctype_name, "submit", doc=doc_name, throw=True)
+
+    documents = get_documents_for_signing(doctype_name, doc_names)
+    sign_documents(documents, doctype_name)
+
+    last_doc = documents[-1]
+    return {
+        "signed": len(documents),
+        "serie": last_doc.pt_serie_fiscal,
+        "last_document": last_doc.name,
+        "last_hash": last_doc.pt_hash_dados_documento_sha1
+    }
+
+def get_documents_for_signing(doctype_name, doc_names):
+    """Carrega (numa consulta) e valida os documentos de um lote, mantendo a ordem pedida."""
+    fields = list(SIGNING_FIELDS)
+    if frappe.get_meta(doctype_name).has_field("customer_tax_id"):
+        fields.append("customer_tax_id")
+
+    rows = {row.name: row for row in frappe.get_all(doctype_name, filters={"name": ["in", doc_names]}, fields=fields)}
+    missing = [name for name in doc_names if name not in rows]
+    if missing:
+        frappe.throw(frappe._("Documentos não encontrados: {0}").format(", ".join(missing)))
+
+    documents = [rows[name] for name in doc_names]
+    first_doc = documents[0]
+    if not first_doc.pt_serie_fiscal:
+        frappe.throw(frappe._("Campo 'Série Fiscal' (pt_serie_fiscal) não preenchido no documento {0}.").format(first_doc.name))
+
+    prefixo_serie = frappe.db.get_value("Serie de Documento Fiscal", first_doc.pt_serie_fiscal, "prefixo_serie")
+    last_number = None
+    for doc in documents:
+        if doc.pt_serie_fiscal != first_doc.pt_serie_fiscal or doc.company != first_doc.company:
+            frappe.throw(frappe._("Todos os documentos do lote devem pertencer à série {0} da empresa {1} ({2}).").format(
+                first_doc.pt_serie_fiscal, first_doc.company, doc.name))
+        if doc.docstatus != 1:
+            frappe.throw(frappe._("O documento {0} não está submetido.").format(doc.name))
+        if doc.pt_hash_dados_documento_sha1:
+            frappe.throw(frappe._("O documento {0} já se encontra assinado.").format(doc.name))
+
+        number = cint(get_sequential_number_from_name(doc.name, f"{prefixo_serie}/"))
+        if last_number is not None and number <= last_number:
+            frappe.throw(frappe._("Os documentos do lote devem estar por ordem crescente de número ({0}).").format(doc.name))
+        last_number = number
+
+    return documents
@@ -4,6 +4,14 @@
 import frappe
 import re
 
+from .fiscal_fingerprint import (
+    CERTIFIED_FIELDS,
+    fiscal_fingerprint_matches,
+    get_changed_critical_fields,
+    get_stored_fiscal_values,
+)
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+
 # --- Funções de Validação Específicas de Portugal ---
 
 def validate_nif(nif, is_company=False):
@@ -142,27 +150,39 @@ def prevent_modification_of_certified_fields(doc, method):
     Esta é uma salvaguarda adicional à imutabilidade do docstatus=1.
     """
     if not doc.is_new():
-        # Obter o estado anterior do documento da base de dados
-        db_doc = frappe.get_doc(doc.doctype, doc.name) # Obtém a versão da BD
-        
-        # Campos que, se já preenchidos (indicando certificação anterior), não devem mudar
-        certified_fields_immutable = [
-            "pt_atcud", 
-            "pt_hash_dados_documento_sha1", 
-            "pt_assinatura_digital_rsa", 
-            "pt_assinatura_4_caracteres", 
-            "pt_qr_code_string", 
-            "pt_qr_code_imagem"
-        ]
-        
-        for field in certified_fields_immutable:
-            if db_doc.get(field) and db_doc.get(field) != doc.get(field):
+        # Valores gravados (campos certificados e impressão digital) numa única consulta,
+        # sem recarregar o documento nem as tabelas filhas
+        stored = get_stored_fiscal_values(doc)
+
+        for field in CERTIFIED_FIELDS:
+            if stored.get(field) and stored.get(field) != doc.get(field):
                 frappe.throw(frappe._("O campo fiscal certificado ") + field + frappe._(" não pode ser alterado após a sua geração inicial."))
 
         # Se o documento original já estava fiscalmente anulado, não permitir "desanular" por modificação.
-        if db_doc.get("pt_estado_documento_fiscal") == "Anulado" and doc.get("pt_estado_documento_fiscal") != "Anulado":
+        if stored.get("pt_estado_documento_fiscal") == "Anulado" and doc.get("pt_estado_documento_fiscal") != "Anulado":
             frappe.throw(frappe._("Um documento fiscalmente anulado não pode ter o seu estado de anulação revertido manualmente."))
 
+        # Campos críticos do cabeçalho e das linhas: impressão digital gravada na submissão
+        if doc.docstatus == 1 and fiscal_fingerprint_matches(doc) is False:
+            create_compliance_log("Update Attempt (Submitted)", doc.doctype, doc.name,
+                                  details="Impressão digital fiscal não corresponde ao documento gravado.")
+            frappe.throw(frappe._("Os campos fiscais de um documento submetido não podem ser alterados."))
+
+def prevent_modification_after_submit(doc, method):
+    """
+    Hook before_update_after_submit: o 'validate' não corre na atualização de um documento
+    submetido, por isso as mesmas verificações são repetidas aqui. Documentos submetidos antes
+    da impressão digital fiscal são comparados campo a campo com os valores gravados.
+    """
+    prevent_modification_of_certified_fields(doc, method)
+
+    if fiscal_fingerprint_matches(doc) is None:
+        changed_fields = get_changed_critical_fields(doc)
+        if changed_fields:
+            create_compliance_log("Update Attempt (Submitted)", doc.doctype, doc.name,
+                                  details=f"Campos críticos alterados: {', '.join(changed_fields)}")
+            frappe.throw(frappe._("Os campos fiscais de um documento submetido não podem ser alterados."))
+
 # --- DocType de Apoio: Motivo de Isenção IVA (Exemplo) ---
 # Se for necessário, criar um DocType "Motivo Isencao IVA PT" com campos:
 # - codigo_motivo (ex: M01, M02, ...)
@@ -0,0 +1,146 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import base64
+import hashlib
+import io
+import os
+import time
+
+import frappe
+import qrcode
+from frappe.utils import add_days, nowdate
+
+# Cache das imagens de QR Code endereçada pelo conteúdo: o nome do ficheiro é o SHA-256 da string
+# do QR Code. As imagens ficam nos ficheiros públicos do site sem registos em 'tabFile'; a mesma
+# string gera sempre o mesmo ficheiro, pelo que reimpressões e reprocessamentos não duplicam nada.
+QR_CACHE_FOLDER = "pt_qr"
+
+MODO_AO_SUBMETER = "Ao Submeter"
+MODO_DIFERIDO = "Diferido"
+
+PENDING_BATCH_SIZE = 2000
+# A varredura agendada só procura documentos recentes (posting_date é indexado) e corre em lotes
+# até terminar ou esgotar o tempo
+PENDING_LOOKBACK_DAYS = 7
+PENDING_RUN_BUDGET = 1200
+
+
+def generate_qr_code_image_bytes(qr_string):
+    """Gera uma imagem QR Code a partir da string e retorna como bytes PNG."""
+    qr = qrcode.QRCode(
+        version=None, # Auto-detect version
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=4, # Smaller box size for smaller image
+        border=2,
+    )
+    qr.add_data(qr_string)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+
+    img_byte_arr = io.BytesIO()
+    img.save(img_byte_arr, format="PNG")
+    return img_byte_arr.getvalue()
+
+
+def get_qr_image_mode():
+    """Modo de geração da imagem configurado em Portugal Compliance Settings."""
+    return frappe.db.get_single_value("Portugal Compliance Settings", "modo_imagem_qr_code") or MODO_AO_SUBMETER
+
+
+def is_qr_image_deferred():
+    return get_qr_image_mode() == MODO_DIFERIDO
+
+
+def get_qr_image_url(qr_string):
+    """Garante que a imagem da string existe na cache e devolve o seu URL público."""
+    relative_path = _get_relative_path(qr_string)
+    _ensure_cached(qr_string, relative_path)
+    return f"/files/{relative_path}"
+
+
+def get_qr_image_bytes(qr_string):
+    """Bytes PNG da imagem da string, lidos da cache (renderizados apenas na primeira vez)."""
+    relative_path = _get_relative_path(qr_string)
+    full_path = _ensure_cached(qr_string, relative_path)
+    with open(full_path, "rb") as f:
+        return f.read()
+
+
+def get_qr_image_data_uri(qr_string):
+    return "data:image/png;base64," + base64.b64encode(get_qr_image_bytes(qr_string)).decode("utf-8")
+
+
+def enqueue_qr_image_render(doctype_name, doc_names):
+    """Modo diferido: agenda, para depois do commit, a geração das imagens de um lote assinado."""
+    frappe.enqueue(
+        "portugal_compliance.utils.qr_image_cache.render_qr_images",
+        queue="short",
+        doctype_name=doctype_name,
+        doc_names=list(doc_names),
+        enqueue_after_commit=True
+    )
+
+
+def render_qr_images(doctype_name, doc_names):
+    """Gera as imagens dos documentos indicados que ainda não a têm."""
+    rows = frappe.db.sql(f"""
+        SELECT name, pt_qr_code_string
+        FROM `tab{doctype_name}`
+        WHERE name IN %(names)s
+          AND IFNULL(pt_qr_code_string, '') != ''
+          AND IFNULL(pt_qr_code_imagem, '') = ''""", {"names": tuple(doc_names)}, as_dict=True)
+    return _save_rendered_images(doctype_name, rows)
+
+
+def render_pending_qr_images(doctype_name="Sales Invoice", batch_size=PENDING_BATCH_SIZE, lookback_days=PENDING_LOOKBACK_DAYS):
+    """Tarefa agendada (rede de segurança dos jobs por lote): gera as imagens dos documentos
+    recentes assinados em modo diferido, em lotes, até não haver mais ou esgotar o tempo."""
+    if not frappe.db.has_column(doctype_name, "pt_qr_code_imagem"):
+        return 0
+
+    started = time.monotonic()
+    since = add_days(nowdate(), -lookback_days)
+    rendered = 0
+    last_name = ""
+    while time.monotonic() - started < PENDING_RUN_BUDGET:
+        rows = frappe.db.sql(f"""
+            SELECT name, pt_qr_code_string, pt_qr_code_imagem
+            FROM `tab{doctype_name}`
+            WHERE posting_date >= %(since)s AND docstatus = 1 AND name > %(after)s
+            ORDER BY name
+            LIMIT %(limit)s""", {"since": since, "after": last_name, "limit": batch_size}, as_dict=True)
+        if not rows:
+            break
+        last_name = rows[-1].name
+        rendered += _save_rendered_images(doctype_name, [row for row in rows if row.pt_qr_code_string and not row.pt_qr_code_imagem])
+    return rendered
+
+
+def _save_rendered_images(doctype_name, rows):
+    if not rows:
+        return 0
+    doc_updates = {row.name: {"pt_qr_code_imagem": get_qr_image_url(row.pt_qr_code_string)} for row in rows}
+    frappe.db.bulk_update(doctype_name, doc_updates, update_modified=False)
+    frappe.db.commit()
+    return len(doc_updates)
+
+
+def _get_relative_path(qr_string):
+    content_hash = hashlib.sha256(qr_string.encode("utf-8")).hexdigest()
+    # Subpasta pelos 2 primeiros caracteres para não acumular milhões de ficheiros numa só pasta
+    return f"{QR_CACHE_FOLDER}/{content_hash[:2]}/{content_hash}.png"
+
+
+def _ensure_cached(qr_string, relative_path):
+    full_path = frappe.get_site_path("public", "files", relative_path)
+    if os.path.exists(full_path):
+        return full_path
+
+    os.makedirs(os.path.dirname(full_path), exist_ok=True)
+    # Escrita atómica: outro processo pode estar a gerar a mesma imagem ao mesmo tempo
+    tmp_path = f"{full_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(generate_qr_code_image_bytes(qr_string))
+    os.replace(tmp_path, full_path)
+    return full_path
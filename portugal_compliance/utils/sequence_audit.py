@@ -0,0 +1,158 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import frappe
+from frappe.utils import cint
+
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import validate_fiscal_doctype
+
+# Número máximo de anomalias detalhadas por série no relatório (os totais são sempre contados)
+MAX_DETAILS_PER_SERIE = 100
+
+# --- Auditoria da numeração das séries (falhas, duplicados, datas fora de ordem, ATCUD) ---
+# Uma única passagem sobre a tabela de documentos: o número sequencial é extraído do nome em SQL
+# e LAG() sobre cada série (ordenada por número) compara cada documento com o anterior. Só as
+# linhas anómalas saem da base de dados, lidas em streaming.
+
+ANOMALY_QUERY = """
+    SELECT serie, name, seq, prev_seq, prev_name, posting_date, prev_date, pt_atcud, expected_atcud
+    FROM (
+        SELECT
+            doc.pt_serie_fiscal AS serie,
+            doc.name,
+            doc.posting_date,
+            doc.pt_atcud,
+            doc.seq,
+            CASE WHEN doc.validation_code IS NULL OR doc.seq IS NULL THEN NULL
+                 ELSE CONCAT(doc.validation_code, '-', doc.seq) END AS expected_atcud,
+            LAG(doc.seq) OVER w AS prev_seq,
+            LAG(doc.name) OVER w AS prev_name,
+            LAG(doc.posting_date) OVER w AS prev_date
+        FROM (
+            SELECT
+                si.pt_serie_fiscal, si.name, si.posting_date, si.pt_atcud,
+                NULLIF(s.codigo_validacao_serie_at, '') AS validation_code,
+                CASE WHEN LEFT(si.name, CHAR_LENGTH(s.prefixo_serie) + 1) = CONCAT(s.prefixo_serie, '/')
+                          AND SUBSTRING(si.name, CHAR_LENGTH(s.prefixo_serie) + 2) REGEXP '^[0-9]+$'
+                     THEN CAST(SUBSTRING(si.name, CHAR_LENGTH(s.prefixo_serie) + 2) AS SIGNED)
+                END AS seq
+            FROM `tab{doctype}` si
+            INNER JOIN `tabSerie de Documento Fiscal` s ON s.name = si.pt_serie_fiscal
+            WHERE si.docstatus IN (1, 2) {conditions}
+        ) doc
+        -- Nomes fora do formato PREFIXO/NÚMERO ficam numa partição à parte e não quebram a cadeia
+        WINDOW w AS (PARTITION BY doc.pt_serie_fiscal, doc.seq IS NULL ORDER BY doc.seq, doc.name)
+    ) chain
+    WHERE seq IS NULL
+       OR (prev_seq IS NULL AND seq <> 1)
+       OR seq - prev_seq > 1
+       OR seq = prev_seq
+       OR posting_date < prev_date
+       OR (expected_atcud IS NOT NULL AND IFNULL(pt_atcud, '') <> '' AND pt_atcud <> expected_atcud)
+"""
+
+SUMMARY_QUERY = """
+    SELECT s.name AS serie, s.prefixo_serie, s.numero_sequencial_atual,
+           COUNT(si.name) AS documents, MAX(
+               CASE WHEN LEFT(si.name, CHAR_LENGTH(s.prefixo_serie) + 1) = CONCAT(s.prefixo_serie, '/')
+                    THEN CAST(SUBSTRING(si.name, CHAR_LENGTH(s.prefixo_serie) + 2) AS SIGNED) END
+           ) AS max_seq
+    FROM `tabSerie de Documento Fiscal` s
+    LEFT JOIN `tab{doctype}` si ON si.pt_serie_fiscal = s.name AND si.docstatus IN (1, 2)
+    WHERE 1 = 1 {conditions}
+    GROUP BY s.name, s.prefixo_serie, s.numero_sequencial_atual
+"""
+
+@frappe.whitelist()
+def get_sequence_audit_report(company=None, series=None, doctype_name="Sales Invoice", max_details_per_serie=MAX_DETAILS_PER_SERIE):
+    """Relatório compacto de falhas, duplicados, datas fora de ordem e ATCUD inconsistentes por série,
+       comparado com o contador 'numero_sequencial_atual' de cada série."""
+    frappe.only_for("System Manager")
+    validate_fiscal_doctype(doctype_name)
+    max_details_per_serie = cint(max_details_per_serie)
+    if isinstance(series, str) and series.startswith("["):
+        series = frappe.parse_json(series)
+
+    values = {}
+    doc_conditions = []
+    serie_conditions = []
+    if company:
+        values["company"] = company
+        doc_conditions.append("si.company = %(company)s")
+        serie_conditions.append("s.empresa = %(company)s")
+    if series:
+        values["series"] = tuple(series) if isinstance(series, (list, tuple)) else (series,)
+        doc_conditions.append("si.pt_serie_fiscal IN %(series)s")
+        serie_conditions.append("s.name IN %(series)s")
+
+    report = {}
+    for row in frappe.db.sql(
+        SUMMARY_QUERY.format(doctype=doctype_name, conditions="".join(f" AND {c}" for c in serie_conditions)),
+        values, as_dict=True
+    ):
+        max_seq = cint(row.max_seq)
+        counter = cint(row.numero_sequencial_atual)
+        report[row.serie] = {
+            "serie": row.serie,
+            "prefixo_serie": row.prefixo_serie,
+            "documents": cint(row.documents),
+            "max_number": max_seq,
+            "numero_sequencial_atual": counter,
+            # Contador atrás do maior número: o próximo número atribuído será um duplicado
+            "counter_behind": max_seq > counter,
+            # Números reservados pelo contador sem documento correspondente
+            "unused_reserved": max(counter - max_seq, 0),
+            "counts": {"gap": 0, "missing_numbers": 0, "duplicate": 0, "date_out_of_order": 0,
+                       "atcud_mismatch": 0, "invalid_name": 0},
+            "details": [],
+        }
+
+    query = ANOMALY_QUERY.format(doctype=doctype_name, conditions="".join(f" AND {c}" for c in doc_conditions))
+    with frappe.db.unbuffered_cursor():
+        for row in frappe.db.sql(query, values, as_dict=True, as_iterator=True):
+            serie = report.get(row.serie)
+            if not serie:
+                continue
+            for anomaly in _classify(row):
+                serie["counts"][anomaly["type"]] += 1
+                if anomaly["type"] == "gap":
+                    serie["counts"]["missing_numbers"] += anomaly["missing"]
+                if len(serie["details"]) < max_details_per_serie:
+                    serie["details"].append(anomaly)
+
+    series_report = [
+        serie for serie in report.values()
+        if serie["counter_behind"] or serie["unused_reserved"] or any(serie["counts"].values())
+    ]
+    return {
+        "doctype": doctype_name,
+        "series_checked": len(report),
+        "series_with_issues": len(series_report),
+        "ok": not series_report,
+        "series": sorted(series_report, key=lambda serie: serie["serie"]),
+    }
+
+def _classify(row):
+    anomalies = []
+    if row.seq is None:
+        return [{"type": "invalid_name", "document": row.name}]
+
+    seq = cint(row.seq)
+    if row.prev_seq is None:
+        if seq != 1:
+            anomalies.append({"type": "gap", "document": row.name, "from": 1, "to": seq - 1, "missing": seq - 1})
+    else:
+        prev_seq = cint(row.prev_seq)
+        if seq == prev_seq:
+            anomalies.append({"type": "duplicate", "document": row.name, "other": row.prev_name, "number": seq})
+        elif seq - prev_seq > 1:
+            anomalies.append({"type": "gap", "document": row.name, "after": row.prev_name,
+                              "from": prev_seq + 1, "to": seq - 1, "missing": seq - prev_seq - 1})
+        if row.prev_date and row.posting_date and row.posting_date < row.prev_date:
+            anomalies.append({"type": "date_out_of_order", "document": row.name, "posting_date": str(row.posting_date),
+                              "previous": row.prev_name, "previous_date": str(row.prev_date)})
+
+    if row.expected_atcud and row.pt_atcud and row.pt_atcud != row.expected_atcud:
+        anomalies.append({"type": "atcud_mismatch", "document": row.name, "atcud": row.pt_atcud,
+                          "expected": row.expected_atcud})
+    return anomalies
@@ -0,0 +1,158 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Assinatura pela ordem dos números da série, dentro da transação da submissão.
+
+A cadeia de hashes de cada série segue a ordem dos números dos documentos. O número é o do nome
+do documento (naming series do ERPNext, com o prefixo da série); esta app não o atribui.
+
+Na submissão (sign_on_submit), antes de bloquear a série:
+
+1. Os documentos da série ainda por assinar com número entre a cabeça da cadeia e o documento
+   submetido são lidos com um bloqueio partilhado (LOCK IN SHARE MODE / FOR SHARE). Se algum
+   estiver a ser submetido noutra transação, a leitura espera pelo commit (ou rollback) dessa
+   transação. Submissões concorrentes da mesma série são assim assinadas pela ordem dos números,
+   cada uma na sua própria transação. O bloqueio é partilhado para que duas submissões que esperam
+   pelos mesmos documentos anteriores não se bloqueiem uma à outra.
+2. A linha da série é bloqueada (FOR UPDATE) e a cabeça da cadeia é lida. Os números entre a
+   cabeça e o documento que continuam sem documento submetido (documento apagado, cancelado sem
+   assinatura ou rascunho) já não podem ser preenchidos antes dele: são saltados e registados no
+   Compliance Audit Log.
+3. Um documento cujo número já ficou para trás da cabeça (rascunho saltado e submetido depois) não
+   é assinado fora de ordem: a submissão é recusada e o caso fica no Compliance Audit Log para
+   tratamento manual.
+
+A assinatura é feita na transação da submissão: se falhar, a submissão falha e nenhum documento
+fica submetido sem assinatura. A tarefa agendada sign_pending_series_documents assina, pela mesma
+ordem, os documentos submetidos sem assinatura deixados por versões anteriores.
+
+Não há agrupamento de submissões concorrentes sob um único lock: cada submissão tem a sua
+transação e uma transação não pode gravar a assinatura de um documento que outra ainda não
+confirmou. Assinar depois do commit permitiria agrupar, mas deixaria documentos submetidos sem
+assinatura sempre que a assinatura falhasse.
+"""
+
+import frappe
+from frappe.utils import cint
+
+from .fiscal_signature import get_documents_for_signing
+from .signing_engine import sign_documents
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import get_chain_head
+from ..saft.utils import get_sequential_number_from_name
+
+SERIE_DOCTYPE = "Serie de Documento Fiscal"
+# Documentos para trás da cabeça: registados no Compliance Audit Log uma vez por dia
+BEHIND_HEAD_LOG_TTL = 24 * 3600
+
+class DocumentBehindChainHead(frappe.ValidationError):
+    pass
+
+def sign_in_chain_order(doc, doctype_name=None):
+    """on_submit: assina o documento a seguir à cabeça da cadeia da sua série, depois de esperar
+    pelos documentos anteriores que estejam a ser submetidos. Falha se não o puder assinar."""
+    doctype_name, serie_name = doctype_name or doc.doctype, doc.pt_serie_fiscal
+    # Leitura sem bloqueio: apenas delimita os documentos anteriores a esperar
+    head = get_chain_head(serie_name, for_update=False)
+    prefix = f"{head.prefixo_serie}/"
+    number = get_document_number(doc.name, prefix)
+    lowest = cint(head.ultimo_numero_assinado) if head.ultimo_hash_assinado else 0
+
+    predecessors = lock_pending_predecessors(doctype_name, serie_name, prefix, lowest, number)
+    unsigned = [row.name for row in predecessors if row.docstatus == 1 and not row.pt_hash_dados_documento_sha1]
+    if unsigned:
+        frappe.throw(frappe._("Os documentos anteriores da série {0} estão submetidos sem assinatura: {1}. "
+                              "Devem ser assinados antes de {2}.").format(serie_name, ", ".join(unsigned), doc.name))
+
+    head = get_chain_head(serie_name, for_update=True)
+    if head.ultimo_hash_assinado:
+        head_number = cint(head.ultimo_numero_assinado)
+        if number <= head_number:
+            flag_document_behind_head(doctype_name, doc.name, serie_name, head)
+            frappe.throw(frappe._("O número do documento {0} já ficou para trás da cadeia de assinaturas da série {1} "
+                                  "(último documento assinado: {2}). O documento não pode ser assinado fora de ordem; "
+                                  "o caso foi registado para tratamento manual.").format(doc.name, serie_name, head.ultimo_documento_assinado),
+                         exc=DocumentBehindChainHead)
+        skipped_range = range(head_number + 1, number)
+        if skipped_range:
+            log_skipped_gap(serie_name, head_number + 1, number - 1, doc.name, head.ultimo_documento_assinado)
+    else:
+        skipped_range = None
+
+    sign_documents([doc], doctype_name, skipped_range=skipped_range)
+
+def lock_pending_predecessors(doctype_name, serie_name, prefix, lowest, number):
+    """Documentos da série por assinar com número entre 'lowest' e 'number' (exclusive), lidos com
+    bloqueio partilhado por chave primária: a leitura espera pelas submissões em curso desses
+    documentos e devolve o seu estado já confirmado."""
+    names = [
+        name for name in frappe.db.sql_list(f"""
+            SELECT name
+            FROM `tab{doctype_name}`
+            WHERE pt_serie_fiscal = %s AND docstatus < 2
+              AND IFNULL(pt_hash_dados_documento_sha1, '') = ''""", serie_name)
+        if lowest < get_document_number(name, prefix) < number
+    ]
+    if not names:
+        return []
+    share_clause = "FOR SHARE" if frappe.db.db_type == "postgres" else "LOCK IN SHARE MODE"
+    return frappe.db.sql(f"""
+        SELECT name, docstatus, pt_hash_dados_documento_sha1
+        FROM `tab{doctype_name}`
+        WHERE name IN %(names)s
+        {share_clause}""", {"names": tuple(names)}, as_dict=True)
+
+def get_document_number(doc_name, prefix):
+    return cint(get_sequential_number_from_name(doc_name, prefix))
+
+def log_skipped_gap(serie_name, first, last, doc_name, previous_name):
+    create_compliance_log(
+        "Series Sequence Gap", SERIE_DOCTYPE, serie_name,
+        details=f"Números {first} a {last} sem documento submetido: saltados na cadeia de assinaturas "
+                f"(o documento {doc_name} é assinado a seguir a {previous_name or '-'})."
+    )
+
+def flag_document_behind_head(doctype_name, doc_name, serie_name, head):
+    """Regista (uma vez por dia) um documento que já não pode ser assinado pela ordem da série.
+    O registo é feito num job: a transação da submissão recusada é revertida."""
+    cache_key = f"pt_series_behind_head:{doctype_name}:{doc_name}"
+    if frappe.cache().get_value(cache_key):
+        return
+    frappe.cache().set_value(cache_key, 1, expires_in_sec=BEHIND_HEAD_LOG_TTL)
+    frappe.enqueue(
+        "portugal_compliance.doctype.compliance_audit_log.compliance_audit_log.create_compliance_log",
+        event_type="Series Sequence Gap",
+        reference_doctype=doctype_name,
+        reference_name=doc_name,
+        details=f"O número do documento já ficou para trás da cabeça da cadeia da série {serie_name} "
+                f"(último documento assinado: {head.ultimo_documento_assinado}, número {head.ultimo_numero_assinado}). "
+                f"Não foi assinado; requer tratamento manual."
+    )
+
+def sign_pending_series_documents(doctype_name="Sales Invoice"):
+    """Tarefa agendada: assina, pela ordem da série, os documentos submetidos sem assinatura."""
+    series = frappe.db.sql_list(f"""
+        SELECT DISTINCT pt_serie_fiscal
+        FROM `tab{doctype_name}`
+        WHERE docstatus = 1 AND IFNULL(pt_serie_fiscal, '') != ''
+          AND IFNULL(pt_hash_dados_documento_sha1, '') = ''""")
+    for serie_name in series:
+        names = frappe.db.sql_list(f"""
+            SELECT name
+            FROM `tab{doctype_name}`
+            WHERE pt_serie_fiscal = %s AND docstatus = 1
+              AND IFNULL(pt_hash_dados_documento_sha1, '') = ''
+            ORDER BY CHAR_LENGTH(name), name""", serie_name)
+        if not names:
+            continue
+        try:
+            # Uma transação por série
+            for document in get_documents_for_signing(doctype_name, names):
+                try:
+                    sign_in_chain_order(document, doctype_name)
+                except DocumentBehindChainHead:
+                    frappe.clear_messages()
+            frappe.db.commit()
+        except Exception:
+            frappe.db.rollback()
+            frappe.log_error(frappe.get_traceback(), f"Assinatura pendente: erro ao assinar a série {serie_name}")
@@ -0,0 +1,205 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import base64
+import hashlib
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import frappe
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding
+
+from .fiscal_signature import create_signature_string, format_posting_time
+from .signing_key_cache import load_certificate_keys
+from ..doctype.compliance_audit_log.compliance_audit_log import create_compliance_log
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import validate_fiscal_doctype
+
+# Número máximo de quebras detalhadas por série no relatório (o total é sempre contado)
+MAX_BREAKS_PER_SERIE = 100
+REPORT_CACHE_TTL = 7 * 24 * 3600
+
+# --- Motor de verificação da cadeia de hashes e das assinaturas RSA ---
+
+@frappe.whitelist()
+def enqueue_signature_verification(company=None, series=None, processes=None, doctype_name="Sales Invoice"):
+    """Agenda a verificação num worker 'long' e devolve o identificador do relatório."""
+    frappe.only_for("System Manager")
+    validate_fiscal_doctype(doctype_name)
+    report_id = frappe.generate_hash(length=12)
+    frappe.enqueue(
+        "portugal_compliance.utils.signature_verification.verify_signatures",
+        queue="long",
+        timeout=6 * 3600,
+        company=company,
+        series=frappe.parse_json(series) if isinstance(series, str) and series.startswith("[") else series,
+        processes=processes,
+        doctype_name=doctype_name,
+        report_id=report_id
+    )
+    return {"report_id": report_id}
+
+@frappe.whitelist()
+def get_signature_verification_report(report_id):
+    frappe.only_for("System Manager")
+    return frappe.cache().get_value(f"pt_signature_verification:{report_id}")
+
+def verify_signatures(company=None, series=None, processes=None, doctype_name="Sales Invoice", report_id=None):
+    """Verifica todas as séries (ou as indicadas) e devolve um relatório de quebras com débito.
+
+       Cada série é percorrida por ordem de número numa única consulta em streaming; o trabalho é
+       distribuído por séries num pool de processos, cada um com a sua ligação à base de dados.
+    """
+    started = time.perf_counter()
+    series_rows = _get_series_to_verify(company, series)
+    public_keys = _get_public_keys_by_company({row.empresa for row in series_rows})
+
+    processes = int(processes or os.cpu_count() or 1)
+    tasks = [(doctype_name, row.name, row.prefixo_serie, public_keys.get(row.empresa, [])) for row in series_rows]
+
+    results = []
+    if processes <= 1 or len(tasks) <= 1:
+        results = [verify_serie(*task) for task in tasks]
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=min(processes, len(tasks)),
+            # 'spawn' evita herdar a ligação à BD e o estado do frappe do processo pai
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(frappe.local.site, frappe.local.sites_path)
+        )
+        with executor:
+            futures = [executor.submit(verify_serie, *task) for task in tasks]
+            for future in as_completed(futures):
+                results.append(future.result())
+
+    elapsed = time.perf_counter() - started
+    total_documents = sum(result["documents"] for result in results)
+    total_breaks = sum(result["break_count"] for result in results)
+    report = {
+        "report_id": report_id,
+        "doctype": doctype_name,
+        "company": company,
+        "series": sorted(results, key=lambda result: result["serie"]),
+        "documents": total_documents,
+        "breaks": total_breaks,
+        "processes": processes,
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(total_documents / elapsed, 1) if elapsed else 0.0,
+        "status": "OK" if not total_breaks else "BREAKS_FOUND"
+    }
+
+    create_compliance_log(
+        "Signature Verification", "DocType", doctype_name,
+        details=f"Verificados {total_documents} documentos em {len(results)} séries; {total_breaks} quebras; "
+                f"{report['docs_per_second']} docs/s."
+    )
+    if report_id:
+        frappe.cache().set_value(f"pt_signature_verification:{report_id}", report, expires_in_sec=REPORT_CACHE_TTL)
+    return report
+
+def verify_serie(doctype_name, serie_name, prefixo_serie, public_keys_pem):
+    """Recalcula a string de dados e a cadeia SHA-1 de uma série e valida cada assinatura RSA-SHA256."""
+    started = time.perf_counter()
+    public_keys = [serialization.load_pem_public_key(pem) for pem in public_keys_pem]
+    rsa_padding = padding.PKCS1v15()
+    rsa_hash = hashes.SHA256()
+
+    breaks = []
+    break_count = 0
+    documents = 0
+    previous_hash = "0"
+
+    def record_break(doc_name, break_type, **details):
+        nonlocal break_count
+        break_count += 1
+        if len(breaks) < MAX_BREAKS_PER_SERIE:
+            breaks.append(dict(document=doc_name, type=break_type, **details))
+
+    # Ordem numérica: para o mesmo prefixo, (comprimento, nome) ordena como o número sequencial
+    query = f"""
+        SELECT name, posting_date, posting_time, grand_total,
+               pt_hash_dados_documento_sha1, pt_assinatura_digital_rsa
+        FROM `tab{doctype_name}`
+        WHERE pt_serie_fiscal = %s AND docstatus = 1
+        ORDER BY CHAR_LENGTH(name), name"""
+
+    with frappe.db.unbuffered_cursor():
+        for doc in frappe.db.sql(query, serie_name, as_dict=True, as_iterator=True):
+            documents += 1
+            data_to_sign_bytes = create_signature_string(
+                doc.posting_date,
+                format_posting_time(doc.posting_time),
+                doc.name,
+                doc.grand_total,
+                previous_hash
+            )
+            expected_hash = hashlib.sha1(data_to_sign_bytes).hexdigest()
+            stored_hash = doc.pt_hash_dados_documento_sha1
+
+            if not stored_hash:
+                record_break(doc.name, "unsigned")
+            elif stored_hash != expected_hash:
+                record_break(doc.name, "hash_mismatch", expected=expected_hash, stored=stored_hash)
+            elif not _verify_rsa_signature(public_keys, doc.pt_assinatura_digital_rsa, data_to_sign_bytes, rsa_padding, rsa_hash):
+                record_break(doc.name, "invalid_signature")
+
+            # Continua a cadeia a partir do valor guardado, para que uma quebra não se propague às seguintes
+            previous_hash = stored_hash or expected_hash
+
+    elapsed = time.perf_counter() - started
+    return {
+        "serie": serie_name,
+        "prefixo_serie": prefixo_serie,
+        "documents": documents,
+        "break_count": break_count,
+        "breaks": breaks,
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(documents / elapsed, 1) if elapsed else 0.0
+    }
+
+def _verify_rsa_signature(public_keys, signature_b64, data_bytes, rsa_padding, rsa_hash):
+    if not signature_b64 or not public_keys:
+        return False
+    try:
+        signature = base64.b64decode(signature_b64)
+    except ValueError:
+        return False
+    # Documentos antigos podem ter sido assinados por um certificado entretanto substituído
+    for public_key in public_keys:
+        try:
+            public_key.verify(signature, data_bytes, rsa_padding, rsa_hash)
+            return True
+        except InvalidSignature:
+            continue
+    return False
+
+def _get_series_to_verify(company=None, series=None):
+    filters = {}
+    if company:
+        filters["empresa"] = company
+    if series:
+        filters["name"] = ["in", series if isinstance(series, (list, tuple)) else [series]]
+    return frappe.get_all("Serie de Documento Fiscal", filters=filters, fields=["name", "prefixo_serie", "empresa"])
+
+def _get_public_keys_by_company(companies):
+    """Chaves públicas (PEM) de todos os certificados, ativos ou não, de cada empresa."""
+    public_keys = {}
+    for cert in frappe.get_all("Certificado Digital Qualificado", filters={"empresa": ["in", list(companies)]},
+                               fields=["name", "empresa"], order_by="valido_ate desc"):
+        try:
+            _, certificate = load_certificate_keys(cert.name)
+        except Exception:
+            frappe.log_error(frappe.get_traceback(), f"Verificação de assinaturas: certificado {cert.name} ilegível")
+            continue
+        pem = certificate.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo)
+        public_keys.setdefault(cert.empresa, []).append(pem)
+    return public_keys
+
+def _init_worker(site, sites_path):
+    frappe.init(site=site, sites_path=sites_path)
+    frappe.connect()
@@ -0,0 +1,185 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Benchmark do débito e da latência da assinatura de documentos.
+
+Corre o mesmo pipeline da assinatura (string de dados -> SHA-1 -> RSA-SHA256 -> 4 caracteres ->
+string do QR Code -> imagem PNG do QR Code) com uma chave RSA efémera gerada no arranque e
+documentos em memória. Não precisa de site nem de base de dados.
+
+    python -m portugal_compliance.utils.signing_benchmark --documents 2000 --workers 4
+
+Mede 1 thread, N threads e N processos e apresenta docs/s e p50/p95/p99 de cada etapa.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, timedelta
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .fiscal_signature import (
+    create_signature_string,
+    generate_qr_code_string,
+    get_data_hash_4_chars,
+    sign_data_rsa_sha256,
+)
+from .qr_image_cache import generate_qr_code_image_bytes
+
+STAGES = ["data_string", "sha1", "rsa", "hash_4_chars", "qr_string", "qr_image"]
+
+def generate_ephemeral_key(key_size=2048):
+    return rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+
+def make_documents(count, start=1, prefix="FT BENCH"):
+    """Documentos em memória com os campos usados na assinatura."""
+    base_date = date(2025, 1, 1)
+    return [
+        {
+            "name": f"{prefix}/{number:08d}",
+            "posting_date": base_date + timedelta(days=number % 365),
+            "posting_time": "{:02d}:{:02d}:{:02d}".format(number % 24, number % 60, (number * 7) % 60),
+            "grand_total": 100 + (number % 1000) * 1.23,
+            "net_total": 81.3 + (number % 1000),
+            "pt_atcud": f"AAJFJMVNTN-{number}",
+            "tax_id": "123456789" if number % 3 else "999999990",
+        }
+        for number in range(start, start + count)
+    ]
+
+def sign_documents_timed(private_key, documents, previous_hash="0"):
+    """Assina os documentos em cadeia e devolve os tempos (ns) de cada etapa por documento."""
+    timings = {stage: [] for stage in STAGES}
+    clock = time.perf_counter_ns
+
+    for doc in documents:
+        t0 = clock()
+        data_bytes = create_signature_string(
+            doc["posting_date"], doc["posting_time"], doc["name"], doc["grand_total"], previous_hash)
+        t1 = clock()
+        previous_hash = hashlib.sha1(data_bytes).hexdigest()
+        t2 = clock()
+        sign_data_rsa_sha256(private_key, data_bytes)
+        t3 = clock()
+        hash_4_chars = get_data_hash_4_chars(data_bytes)
+        t4 = clock()
+        qr_string = generate_qr_code_string(
+            atcud=doc["pt_atcud"],
+            nif_emitter="500000000",
+            nif_acquirer=doc["tax_id"],
+            country_emitter="PT",
+            country_acquirer="PT",
+            doc_type_code="FT",
+            doc_status="N",
+            doc_date_obj=doc["posting_date"],
+            doc_number=doc["name"],
+            taxable_amount_float=doc["net_total"],
+            vat_amount_float=doc["grand_total"] - doc["net_total"],
+            gross_total_float=doc["grand_total"],
+            signature_hash_4_chars=hash_4_chars,
+            software_cert_number="0000"
+        )
+        t5 = clock()
+        generate_qr_code_image_bytes(qr_string)
+        t6 = clock()
+
+        for stage, elapsed in zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t6 - t5)):
+            timings[stage].append(elapsed)
+
+    return timings
+
+def _process_worker(private_key_pem, documents):
+    # Cada processo carrega a chave uma vez, como um worker com a chave em cache
+    private_key = serialization.load_pem_private_key(private_key_pem, password=None)
+    return sign_documents_timed(private_key, documents)
+
+def run_scenario(mode, workers, private_key, documents):
+    """Corre um cenário ('threads' ou 'processes') e devolve docs/s e percentis por etapa."""
+    # Cada worker assina a sua própria série (cadeia independente), como séries distintas em produção
+    chunks = [documents[index::workers] for index in range(workers)]
+
+    started = time.perf_counter()
+    if mode == "processes":
+        private_key_pem = private_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_process_worker, [private_key_pem] * workers, chunks))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(lambda chunk: sign_documents_timed(private_key, chunk), chunks))
+    elapsed = time.perf_counter() - started
+
+    merged = {stage: [] for stage in STAGES}
+    for timings in results:
+        for stage in STAGES:
+            merged[stage].extend(timings[stage])
+    stages_ms = {stage: summarize(merged[stage]) for stage in STAGES}
+    stages_ms["total"] = summarize([sum(values) for values in zip(*(merged[stage] for stage in STAGES))])
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "documents": len(documents),
+        "seconds": round(elapsed, 3),
+        "docs_per_second": round(len(documents) / elapsed, 1) if elapsed else 0.0,
+        "stages_ms": stages_ms,
+    }
+
+def summarize(values_ns):
+    values = sorted(values_ns)
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "mean": 0.0}
+    def percentile(p):
+        return round(values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))] / 1e6, 4)
+    return {
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "mean": round(sum(values) / len(values) / 1e6, 4),
+    }
+
+def run_benchmark(documents=1000, workers=None, key_size=2048):
+    workers = workers or os.cpu_count() or 1
+    private_key = generate_ephemeral_key(key_size)
+    docs = make_documents(documents)
+    # Aquecimento: imports preguiçosos do qrcode/PIL e caches do OpenSSL
+    sign_documents_timed(private_key, make_documents(5, prefix="FT WARMUP"))
+
+    scenarios = [("threads", 1), ("threads", workers), ("processes", workers)]
+    return {
+        "key_size": key_size,
+        "cpu_count": os.cpu_count(),
+        "results": [run_scenario(mode, count, private_key, docs) for mode, count in scenarios],
+    }
+
+def print_report(report):
+    print(f"Chave RSA {report['key_size']} bits, {report['cpu_count']} CPUs")
+    for result in report["results"]:
+        print()
+        print(f"{result['mode']} x{result['workers']}: {result['documents']} documentos em "
+              f"{result['seconds']} s -> {result['docs_per_second']} docs/s")
+        print(f"  {'etapa':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'média ms':>10}")
+        for stage, stats in result["stages_ms"].items():
+            print(f"  {stage:<14}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}{stats['mean']:>10}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark da assinatura de documentos (Portugal Compliance)")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=None, help="N threads / N processos (por omissão, nº de CPUs)")
+    parser.add_argument("--key-size", type=int, default=2048)
+    parser.add_argument("--json", action="store_true", help="Relatório em JSON")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.documents, args.workers, args.key_size)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == "__main__":
+    main()
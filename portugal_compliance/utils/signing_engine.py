@@ -0,0 +1,310 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Motor único de assinatura dos documentos fiscais.
+
+Um perfil define como se constrói a string de dados, como se calcula o hash e que campos são
+gravados; um backend define onde é feita a assinatura RSA. O motor trata do resto de forma
+igual para todos os chamadores: bloqueio e cabeça da cadeia da série, encadeamento dos hashes,
+uma única chamada ao backend por lote e gravação dos campos. A cabeça da cadeia da série só é
+usada pelo perfil RSA; o legacy_sha1 mantém a sua cadeia nos campos custom_*.
+
+Perfis:
+    rsa_sha256   - Data;Hora;Número;Total;HashAnterior, SHA-1 para o encadeamento, assinatura
+                   RSA-SHA256 e QR Code; campos pt_* (utils/fiscal_signature.py).
+    legacy_sha1  - Data;DataHoraCriação;Número;Total;HashAnterior, apenas SHA-1 (maiúsculas);
+                   campos custom_* (signing.py / doc_events.py).
+
+Backends (assinatura RSA):
+    in_process   - chave decifrada em cache no próprio processo (utils/signing_key_cache.py).
+    worker_pool  - serviço local de assinatura (utils/signing_service.py), com recurso ao
+                   in_process se o serviço estiver indisponível.
+    Em ambos, um lote de documentos é assinado numa única chamada ao backend.
+"""
+
+import hashlib
+from datetime import datetime
+
+import frappe
+from frappe.utils import cint
+
+from .fiscal_signature import (
+    advance_series_chain_head,
+    attach_qr_code_image,
+    build_signature_values,
+    get_previous_document_data_hash_from_documents,
+    get_signing_context,
+    prepare_signature_data,
+    sign_data_rsa_sha256,
+)
+from .fiscal_fingerprint import FINGERPRINT_FIELD, store_fiscal_fingerprint
+from .qr_image_cache import enqueue_qr_image_render
+from .signing_key_cache import get_signing_key
+from .signing_service import SigningServiceUnavailable, is_signing_service_enabled, sign_payloads_with_service
+from ..doctype.serie_de_documento_fiscal.serie_de_documento_fiscal import get_chain_head
+from ..saft.utils import get_sequential_number_from_name
+
+# As per Despacho 8632/2014, point 4.1.1, the initial hash value for the first document in a series is "0"
+INITIAL_HASH = "0"
+
+# --- Perfis ---
+
+class RSASigningProfile:
+    name = "rsa_sha256"
+    hash_field = "pt_hash_dados_documento_sha1"
+    requires_series = True
+    # A cabeça da cadeia da série (ultimo_*_assinado) guarda hashes deste perfil
+    uses_chain_head = True
+    requires_key = True
+
+    def get_context(self, company, serie_fiscal, doctype_name):
+        context = get_signing_context(company, serie_fiscal)
+        context.doctype = doctype_name
+        return context
+
+    def get_fallback_previous_hash(self, doc):
+        return get_previous_document_data_hash_from_documents(doc)
+
+    def build_payload(self, doc, previous_hash):
+        return prepare_signature_data(doc, previous_hash)
+
+    def build_values(self, doc, data_bytes, doc_hash, signature, previous_hash, context):
+        values = build_signature_values(doc, data_bytes, doc_hash, signature, context)
+        values["pt_qr_code_imagem"] = attach_qr_code_image(context.doctype, doc.name, values["pt_qr_code_string"])
+        return values
+
+class LegacySHA1SigningProfile:
+    name = "legacy_sha1"
+    hash_field = "custom_document_hash"
+    requires_series = False
+    # Cadeia própria (campos custom_*): o hash anterior é sempre procurado nos documentos
+    uses_chain_head = False
+    requires_key = False
+
+    def get_context(self, company, serie_fiscal, doctype_name):
+        return frappe._dict({"doctype": doctype_name})
+
+    def get_fallback_previous_hash(self, doc):
+        return get_previous_hash_for_series(doc.doctype, doc.name, doc.get("naming_series"))
+
+    def build_payload(self, doc, previous_hash):
+        # Fields based on Despacho n.º 8632/2014, Anexo II, 4.1. Assinatura dos documentos.
+        # DataDeEmissao;DataHoraDeEmissao;IdentificadorUnicoDoc;ValorTotalDocumento;HashAnterior
+        data_string = "{0};{1};{2};{3:.2f};{4}".format(
+            format_date_for_hash(doc.get("posting_date")),
+            format_datetime_for_hash(doc.get("creation")),
+            doc.name,
+            doc.get("grand_total") or 0.00,
+            previous_hash
+        )
+        data_bytes = data_string.encode("utf-8")
+        return data_bytes, hashlib.sha1(data_bytes).hexdigest().upper()
+
+    def build_values(self, doc, data_bytes, doc_hash, signature, previous_hash, context):
+        return {
+            "custom_previous_hash": previous_hash,
+            "custom_document_hash": doc_hash,
+            "custom_digital_signature": doc_hash # As this is the value required by AT for SAF-T Hash field
+        }
+
+SIGNING_PROFILES = {
+    RSASigningProfile.name: RSASigningProfile(),
+    LegacySHA1SigningProfile.name: LegacySHA1SigningProfile(),
+}
+
+def get_signing_profile(profile=None):
+    if profile is None:
+        return SIGNING_PROFILES[RSASigningProfile.name]
+    if isinstance(profile, str):
+        if profile not in SIGNING_PROFILES:
+            frappe.throw(frappe._("Perfil de assinatura desconhecido: {0}").format(profile))
+        return SIGNING_PROFILES[profile]
+    return profile
+
+# --- Backends de assinatura RSA ---
+
+class InProcessKeyBackend:
+    name = "in_process"
+
+    def is_available(self):
+        return True
+
+    def sign(self, company, payloads):
+        private_key, _ = get_signing_key(company)
+        return [sign_data_rsa_sha256(private_key, payload) for payload in payloads]
+
+class WorkerPoolBackend:
+    name = "worker_pool"
+
+    def is_available(self):
+        return is_signing_service_enabled()
+
+    def sign(self, company, payloads):
+        return sign_payloads_with_service(company, payloads)
+
+SIGNING_BACKENDS = {
+    InProcessKeyBackend.name: InProcessKeyBackend(),
+    WorkerPoolBackend.name: WorkerPoolBackend(),
+}
+
+def get_signing_backend():
+    """Backend configurado em site_config ("pt_signing_backend"); por omissão o serviço local,
+    se estiver configurado, ou a chave em cache no próprio processo."""
+    name = frappe.conf.get("pt_signing_backend")
+    if not name:
+        name = WorkerPoolBackend.name if SIGNING_BACKENDS[WorkerPoolBackend.name].is_available() else InProcessKeyBackend.name
+    backend = SIGNING_BACKENDS.get(name)
+    if not backend:
+        frappe.throw(frappe._("Backend de assinatura desconhecido: {0}").format(name))
+    return backend
+
+def sign_payloads(company, payloads):
+    """Assina as strings de dados com RSA-SHA256 numa única chamada ao backend."""
+    backend = get_signing_backend()
+    if backend.name != InProcessKeyBackend.name:
+        try:
+            return backend.sign(company, payloads)
+        except SigningServiceUnavailable:
+            frappe.log_error(frappe.get_traceback(), "Serviço de assinatura indisponível; a assinar no processo")
+    return SIGNING_BACKENDS[InProcessKeyBackend.name].sign(company, payloads)
+
+# --- Motor ---
+
+def sign_documents(documents, doctype_name, profile=None, skipped_range=None):
+    """Assina uma lista ordenada de documentos da mesma série e grava os campos de assinatura.
+
+       'documents' pode conter Documents ou linhas (frappe._dict). A série é bloqueada uma vez,
+       a cadeia de hashes é calculada em memória e as assinaturas são pedidas numa só chamada.
+       Os documentos têm de continuar a cadeia sem falhas; 'skipped_range' são números antes do
+       primeiro documento que o chamador confirmou já não poderem ser preenchidos.
+       Devolve {nome do documento: campos gravados}.
+    """
+    profile = get_signing_profile(profile)
+    if not documents:
+        return {}
+
+    for doc in documents:
+        # Linhas lidas com frappe.get_all/sql não trazem o doctype (usado na procura do hash anterior)
+        if not doc.get("doctype"):
+            doc.doctype = doctype_name
+
+    first_doc = documents[0]
+    serie_fiscal = first_doc.get("pt_serie_fiscal")
+    if profile.requires_series and not serie_fiscal:
+        frappe.throw(frappe._("Campo 'Série Fiscal' (pt_serie_fiscal) não preenchido no documento {0}.").format(first_doc.name))
+
+    context = profile.get_context(first_doc.company, serie_fiscal, doctype_name)
+
+    # Hash do documento anterior: cabeça da cadeia da série (linha bloqueada até ao fim da transação)
+    chain_head = get_chain_head(serie_fiscal, for_update=True) if serie_fiscal and profile.uses_chain_head else None
+    if chain_head and chain_head.ultimo_hash_assinado:
+        check_chain_continuity(documents, chain_head, skipped_range)
+        previous_hash = chain_head.ultimo_hash_assinado
+    else:
+        previous_hash = profile.get_fallback_previous_hash(first_doc)
+
+    chain = []
+    for doc in documents:
+        data_bytes, doc_hash = profile.build_payload(doc, previous_hash)
+        chain.append((doc, data_bytes, doc_hash, previous_hash))
+        previous_hash = doc_hash
+
+    if profile.requires_key:
+        signatures = sign_payloads(first_doc.company, [data_bytes for _, data_bytes, _, _ in chain])
+    else:
+        signatures = [None] * len(chain)
+
+    doc_updates = {}
+    for (doc, data_bytes, doc_hash, doc_previous_hash), signature in zip(chain, signatures):
+        values = profile.build_values(doc, data_bytes, doc_hash, signature, doc_previous_hash, context)
+        doc.update(values)
+        doc_updates[doc.name] = values
+
+    if len(doc_updates) == 1:
+        frappe.db.set_value(doctype_name, first_doc.name, doc_updates[first_doc.name])
+    else:
+        frappe.db.bulk_update(doctype_name, doc_updates, update_modified=False)
+
+    # Avança a cabeça da cadeia (ainda sob o lock obtido acima)
+    if chain_head:
+        advance_series_chain_head(documents[-1], chain_head, previous_hash)
+
+    # Modo diferido: as imagens do QR Code do lote são geradas num job depois do commit
+    deferred_qr = [name for name, values in doc_updates.items() if "pt_qr_code_imagem" in values and not values["pt_qr_code_imagem"]]
+    if deferred_qr:
+        enqueue_qr_image_render(doctype_name, deferred_qr)
+
+    return doc_updates
+
+def check_chain_continuity(documents, head, skipped_range=None):
+    """O primeiro documento tem de ser o seguinte à cabeça da cadeia (lida sob o lock da série) e
+    os restantes consecutivos."""
+    prefix = f"{head.prefixo_serie}/"
+    expected = cint(head.ultimo_numero_assinado) + 1
+    for doc in documents:
+        number = cint(get_sequential_number_from_name(doc.name, prefix))
+        if skipped_range and number > expected and expected in skipped_range and number - 1 in skipped_range:
+            expected = number
+        if number != expected:
+            frappe.throw(frappe._("O documento {0} não continua a cadeia de assinaturas da série {1}: era esperado o número {2} "
+                                  "(último documento assinado: {3}).").format(doc.name, head.name, expected, head.ultimo_documento_assinado))
+        expected = number + 1
+
+def sign_on_submit(doc, method=None):
+    """Hook on_submit dos documentos fiscais (perfil RSA)."""
+    # Impressão digital sobre o documento em memória (a assinatura em grupo só lê o cabeçalho)
+    if not doc.get(FINGERPRINT_FIELD):
+        store_fiscal_fingerprint(doc)
+
+    if doc.get("pt_hash_dados_documento_sha1"):
+        return
+
+    if doc.get("pt_serie_fiscal"):
+        # Pela ordem dos números da série, na transação da submissão (ver utils/series_sequencer.py)
+        from .series_sequencer import sign_in_chain_order
+        sign_in_chain_order(doc)
+        return
+
+    sign_documents([doc], doc.doctype)
+
+# --- Funções auxiliares do perfil legacy_sha1 ---
+
+# Helper function to format date as YYYY-MM-DD
+# Assuming doc.posting_date is a date object or string that can be parsed to one.
+def format_date_for_hash(date_obj):
+    if isinstance(date_obj, str):
+        dt_obj = datetime.strptime(date_obj, '%Y-%m-%d') # Adjust format if ERPNext stores differently
+        return dt_obj.strftime('%Y-%m-%d')
+    elif isinstance(date_obj, datetime):
+        return date_obj.strftime('%Y-%m-%d')
+    return str(date_obj) # Fallback, assuming it's already in a suitable string format
+
+# Helper function to format datetime as YYYY-MM-DDTHH:MM:SS
+# Assuming doc.creation is a datetime object.
+def format_datetime_for_hash(datetime_obj):
+    if isinstance(datetime_obj, datetime):
+        return datetime_obj.strftime("%Y-%m-%dT%H:%M:%S")
+    return str(datetime_obj) # Fallback
+
+def get_previous_hash_for_series(doctype_name, current_doc_name, series):
+    """
+    Retrieves the custom_document_hash from the latest submitted document
+    of the same naming series that precedes the current document.
+    Only used when the series chain head is not available.
+    """
+    previous_docs = frappe.get_all(
+        doctype_name,
+        filters={
+            'name': ['<', current_doc_name],
+            'naming_series': series,
+            'docstatus': 1 # Assuming 1 means submitted/finalized
+        },
+        fields=['name', 'custom_document_hash', 'creation'],
+        order_by='creation desc', # Get the most recent one first
+        limit_page_length=1
+    )
+
+    if previous_docs and previous_docs[0].get('custom_document_hash'):
+        return previous_docs[0].get('custom_document_hash')
+
+    return INITIAL_HASH # Default for the first document or if no valid previous found
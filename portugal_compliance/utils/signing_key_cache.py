@@ -0,0 +1,124 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+import threading
+
+import frappe
+from frappe.utils import getdate, nowdate
+from cryptography.hazmat.primitives.serialization.pkcs12 import load_key_and_certificates
+from cryptography.hazmat.backends import default_backend
+
+# Cache das chaves de assinatura já decifradas, por processo.
+# Chave: (empresa, nome do certificado, modified do certificado). Qualquer gravação do
+# certificado altera o 'modified', pelo que uma entrada antiga nunca é reutilizada,
+# mesmo noutros processos que não receberam a invalidação explícita do on_update.
+_cache_lock = threading.Lock()
+_signing_keys = {}
+_stats = {"hits": 0, "misses": 0, "invalidations": 0, "expired": 0}
+
+
+def get_signing_key(company):
+    """Devolve (private_key, certificate) do certificado ativo da empresa.
+
+    Apenas a linha do certificado ativo (name, modified, valido_ate) é lida da base de dados;
+    o ficheiro .pfx só é lido e decifrado quando não existe entrada válida na cache.
+    """
+    cert = get_valid_certificate_row(company)
+
+    cache_key = (company, cert.name, str(cert.modified))
+    with _cache_lock:
+        entry = _signing_keys.get(cache_key)
+        if entry:
+            _stats["hits"] += 1
+            return entry["private_key"], entry["certificate"]
+        _stats["misses"] += 1
+
+    private_key, certificate = load_certificate_keys(cert.name)
+
+    with _cache_lock:
+        # Só pode existir uma versão do certificado ativo por empresa
+        _discard(company=company)
+        _signing_keys[cache_key] = {
+            "private_key": private_key,
+            "certificate": certificate,
+            "valido_ate": cert.valido_ate,
+        }
+    return private_key, certificate
+
+
+def get_valid_certificate_row(company):
+    """Linha do certificado ativo da empresa; falha se não existir ou se já tiver expirado (valido_ate)."""
+    cert = get_active_certificate_row(company)
+    if not cert:
+        frappe.throw(frappe._("Nenhum certificado digital ativo encontrado para a empresa {0}.").format(company))
+
+    if cert.valido_ate and getdate(cert.valido_ate) < getdate(nowdate()):
+        with _cache_lock:
+            _stats["expired"] += 1
+            _discard(company=company)
+        frappe.throw(frappe._("O certificado digital {0} da empresa {1} expirou em {2}.").format(
+            cert.name, company, cert.valido_ate))
+    return cert
+
+
+def get_active_certificate_row(company):
+    """Obtém name, modified e valido_ate do certificado ativo da empresa (uma única query)."""
+    rows = frappe.get_all(
+        "Certificado Digital Qualificado",
+        filters={"empresa": company, "ativo": 1},
+        fields=["name", "modified", "valido_ate"],
+        order_by="valido_ate desc",
+        limit_page_length=1
+    )
+    return rows[0] if rows else None
+
+
+def load_certificate_keys(certificate_name):
+    """Lê o ficheiro .pfx do certificado e decifra a chave privada (sem cache)."""
+    cert_doc = frappe.get_doc("Certificado Digital Qualificado", certificate_name)
+    pfx_data, pfx_password = cert_doc.get_certificate_data()
+
+    password_bytes = pfx_password.encode("utf-8") if pfx_password else None
+
+    private_key, certificate, _ = load_key_and_certificates(
+        pfx_data,
+        password_bytes,
+        default_backend()
+    )
+    return private_key, certificate
+
+
+def invalidate_signing_key_cache(company=None, certificate=None):
+    """Remove da cache as chaves da empresa e/ou do certificado indicados (todas, se nenhum for indicado)."""
+    with _cache_lock:
+        _stats["invalidations"] += 1
+        _discard(company=company, certificate=certificate)
+
+
+def _discard(company=None, certificate=None):
+    # Deve ser chamada com _cache_lock adquirido
+    if not company and not certificate:
+        _signing_keys.clear()
+        return
+    for key in list(_signing_keys):
+        if (company and key[0] == company) or (certificate and key[1] == certificate):
+            del _signing_keys[key]
+
+
+@frappe.whitelist()
+def get_signing_key_cache_stats():
+    """Estatísticas da cache de chaves de assinatura deste processo."""
+    frappe.only_for("System Manager")
+    with _cache_lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            "hits": _stats["hits"],
+            "misses": _stats["misses"],
+            "invalidations": _stats["invalidations"],
+            "expired": _stats["expired"],
+            "hit_ratio": round(_stats["hits"] / lookups, 4) if lookups else 0.0,
+            "entries": [
+                {"empresa": key[0], "certificado": key[1], "modified": key[2], "valido_ate": str(entry["valido_ate"] or "")}
+                for key, entry in _signing_keys.items()
+            ],
+        }
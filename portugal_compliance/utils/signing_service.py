@@ -0,0 +1,299 @@
+# Copyright (c) 2025, Manus Team and contributors
+# For license information, please see license.txt
+
+"""Serviço local de assinatura RSA, fora do caminho dos pedidos web.
+
+Um processo dedicado mantém um pool de processos com as chaves já decifradas. Os workers web
+(hook on_submit) enviam as strings de dados por um socket Unix local e aguardam as assinaturas.
+Pedidos que chegam ao mesmo tempo são agrupados e assinados em lote.
+
+Arranque (ex: num programa do supervisor):
+
+    PT_SIGNING_SERVICE_AUTHKEY=... python -m portugal_compliance.utils.signing_service \\
+        --socket /home/frappe/frappe-bench/sites/pt_signing.sock --processes 4
+
+Configuração do site (site_config.json):
+
+    "pt_signing_service_socket": "/home/frappe/frappe-bench/sites/pt_signing.sock",
+    "pt_signing_service_authkey": "...",
+    "pt_signing_service_timeout": 10
+
+Sem resposta dentro de 'pt_signing_service_timeout' segundos o serviço é dado como indisponível
+e a assinatura é feita no próprio processo.
+
+Sem "pt_signing_service_socket" a assinatura continua a ser feita no próprio processo web.
+"""
+
+import argparse
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+import frappe
+from frappe.utils import flt
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import padding
+from cryptography.hazmat.primitives.serialization.pkcs12 import load_key_and_certificates
+
+DEFAULT_BATCH_WINDOW_MS = 2
+DEFAULT_MAX_BATCH = 256
+DEFAULT_CLIENT_TIMEOUT = 10
+LATENCY_SAMPLES = 10000
+
+# --- Lado do servidor ---
+
+# Chaves decifradas em cada processo do pool: key_id -> private_key
+_worker_keys = {}
+
+def _worker_sign_batch(key_id, pfx_data, pfx_password, payloads):
+    private_key = _worker_keys.get(key_id)
+    if private_key is None:
+        password_bytes = pfx_password.encode("utf-8") if pfx_password else None
+        private_key, _, _ = load_key_and_certificates(pfx_data, password_bytes)
+        _worker_keys[key_id] = private_key
+    rsa_padding = padding.PKCS1v15()
+    return [private_key.sign(payload, rsa_padding, hashes.SHA256()) for payload in payloads]
+
+class _PendingRequest:
+    __slots__ = ("key_id", "payloads", "received", "event", "response")
+
+    def __init__(self, key_id, payloads):
+        self.key_id = key_id
+        self.payloads = payloads
+        self.received = time.perf_counter()
+        self.event = threading.Event()
+        self.response = None
+
+class SigningServer:
+    def __init__(self, address, authkey, processes=None, batch_window_ms=DEFAULT_BATCH_WINDOW_MS, max_batch=DEFAULT_MAX_BATCH):
+        self.address = address
+        self.authkey = authkey
+        self.processes = processes or os.cpu_count() or 1
+        self.batch_window = batch_window_ms / 1000.0
+        self.max_batch = max_batch
+        self._keys = {} # key_id -> (pfx_data, pfx_password)
+        self._queue = queue.Queue()
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._batch_sizes = deque(maxlen=LATENCY_SAMPLES)
+        self._counters = {"requests": 0, "signatures": 0, "batches": 0, "errors": 0}
+        self._executor = ProcessPoolExecutor(max_workers=self.processes)
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        os.chmod(self.address, 0o600)
+        threading.Thread(target=self._batch_loop, name="pt-signing-batcher", daemon=True).start()
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception:
+                # Falha de autenticação ou ligação abortada: não afeta os restantes clientes
+                continue
+            threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+    def _handle_connection(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                conn.send(self._handle_request(request))
+
+    def _handle_request(self, request):
+        op = request.get("op")
+        if op == "sign":
+            if request["key_id"] not in self._keys:
+                return {"ok": False, "error": "unknown_key"}
+            pending = _PendingRequest(request["key_id"], request["payloads"])
+            self._queue.put(pending)
+            pending.event.wait()
+            return pending.response
+        if op == "load_key":
+            self._keys[request["key_id"]] = (request["pfx_data"], request["pfx_password"])
+            # Pré-carrega a chave nos processos do pool
+            for _ in range(self.processes):
+                self._executor.submit(_worker_sign_batch, request["key_id"], request["pfx_data"], request["pfx_password"], [])
+            return {"ok": True}
+        if op == "stats":
+            return {"ok": True, "stats": self.get_stats()}
+        return {"ok": False, "error": "unknown_op"}
+
+    def _batch_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            signatures = len(batch[0].payloads)
+            deadline = time.perf_counter() + self.batch_window
+            # Agrupa os pedidos que chegam dentro da janela, até max_batch assinaturas
+            while signatures < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(pending)
+                signatures += len(pending.payloads)
+
+            by_key = {}
+            for pending in batch:
+                by_key.setdefault(pending.key_id, []).append(pending)
+            for key_id, pendings in by_key.items():
+                self._dispatch(key_id, pendings)
+
+    def _dispatch(self, key_id, pendings):
+        payloads = [payload for pending in pendings for payload in pending.payloads]
+        pfx_data, pfx_password = self._keys[key_id]
+        with self._lock:
+            self._in_flight += len(pendings)
+            self._counters["batches"] += 1
+            self._batch_sizes.append(len(payloads))
+        future = self._executor.submit(_worker_sign_batch, key_id, pfx_data, pfx_password, payloads)
+        future.add_done_callback(lambda f: self._complete(f, pendings))
+
+    def _complete(self, future, pendings):
+        error = future.exception()
+        signatures = None if error else future.result()
+        offset = 0
+        now = time.perf_counter()
+        with self._lock:
+            for pending in pendings:
+                if error:
+                    pending.response = {"ok": False, "error": str(error)}
+                    self._counters["errors"] += 1
+                else:
+                    count = len(pending.payloads)
+                    pending.response = {"ok": True, "signatures": signatures[offset:offset + count]}
+                    offset += count
+                    self._counters["signatures"] += count
+                self._counters["requests"] += 1
+                self._latencies.append((now - pending.received) * 1000.0)
+                self._in_flight -= 1
+        for pending in pendings:
+            pending.event.set()
+
+    def get_stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            batch_sizes = list(self._batch_sizes)
+            stats = dict(self._counters)
+            stats.update({
+                "queue_depth": self._queue.qsize(),
+                "in_flight": self._in_flight,
+                "processes": self.processes,
+                "keys_loaded": len(self._keys),
+                "avg_batch_size": round(sum(batch_sizes) / len(batch_sizes), 2) if batch_sizes else 0.0,
+                "latency_ms": {
+                    "p50": _percentile(latencies, 50),
+                    "p95": _percentile(latencies, 95),
+                    "p99": _percentile(latencies, 99),
+                    "max": round(latencies[-1], 3) if latencies else 0.0,
+                    "samples": len(latencies)
+                }
+            })
+        return stats
+
+def _percentile(sorted_values, percentile):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(percentile / 100.0 * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 3)
+
+# --- Lado do cliente (workers web / background) ---
+
+_client_local = threading.local()
+
+class SigningServiceUnavailable(Exception):
+    pass
+
+def is_signing_service_enabled():
+    return bool(frappe.conf.get("pt_signing_service_socket"))
+
+def sign_payloads_with_service(company, payloads):
+    """Assina as strings de dados no serviço local. Devolve a lista de assinaturas (bytes)."""
+    from .signing_key_cache import get_valid_certificate_row
+
+    cert = get_valid_certificate_row(company)
+    key_id = f"{company}|{cert.name}|{cert.modified}"
+    request = {"op": "sign", "key_id": key_id, "payloads": list(payloads)}
+
+    response = _request(request)
+    if not response["ok"] and response.get("error") == "unknown_key":
+        _register_key(key_id, cert.name)
+        response = _request(request)
+    if not response["ok"]:
+        raise SigningServiceUnavailable(response.get("error"))
+    return response["signatures"]
+
+def _register_key(key_id, certificate_name):
+    cert_doc = frappe.get_doc("Certificado Digital Qualificado", certificate_name)
+    pfx_data, pfx_password = cert_doc.get_certificate_data()
+    _request({"op": "load_key", "key_id": key_id, "pfx_data": pfx_data, "pfx_password": pfx_password})
+
+def _request(request):
+    # Uma ligação por thread; em caso de falha tenta uma nova ligação uma vez
+    for attempt in range(2):
+        conn = getattr(_client_local, "conn", None)
+        try:
+            if conn is None:
+                conn = Client(
+                    frappe.conf.get("pt_signing_service_socket"),
+                    family="AF_UNIX",
+                    authkey=(frappe.conf.get("pt_signing_service_authkey") or "").encode("utf-8")
+                )
+                _client_local.conn = conn
+            conn.send(request)
+            timeout = flt(frappe.conf.get("pt_signing_service_timeout")) or DEFAULT_CLIENT_TIMEOUT
+            if not conn.poll(timeout):
+                # A resposta tardia chegaria ao pedido seguinte: a ligação é descartada
+                _client_local.conn = None
+                conn.close()
+                raise SigningServiceUnavailable(f"Sem resposta do serviço de assinatura em {timeout}s")
+            return conn.recv()
+        except (OSError, EOFError) as e:
+            _client_local.conn = None
+            if attempt:
+                raise SigningServiceUnavailable(str(e))
+
+@frappe.whitelist()
+def get_signing_service_stats():
+    """Profundidade da fila, lotes e percentis de latência do serviço de assinatura."""
+    frappe.only_for("System Manager")
+    if not is_signing_service_enabled():
+        return {"enabled": False}
+    try:
+        response = _request({"op": "stats"})
+    except SigningServiceUnavailable as e:
+        return {"enabled": True, "available": False, "error": str(e)}
+    return dict(enabled=True, available=True, **response.get("stats", {}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Serviço local de assinatura RSA (Portugal Compliance)")
+    parser.add_argument("--socket", required=True, help="Caminho do socket Unix")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--window-ms", type=float, default=DEFAULT_BATCH_WINDOW_MS)
+    parser.add_argument("--max-batch", type=int, default=DEFAULT_MAX_BATCH)
+    args = parser.parse_args()
+
+    authkey = os.environ.get("PT_SIGNING_SERVICE_AUTHKEY")
+    if not authkey:
+        parser.error("PT_SIGNING_SERVICE_AUTHKEY não definido")
+
+    SigningServer(
+        args.socket,
+        authkey.encode("utf-8"),
+        processes=args.processes,
+        batch_window_ms=args.window_ms,
+        max_batch=args.max_batch
+    ).serve_forever()
+
+if __name__ == "__main__":
+    main()